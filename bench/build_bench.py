@@ -0,0 +1,501 @@
+# -*- coding: utf-8; -*-
+
+"""
+Build pipeline benchmark.
+
+Synthetic projects of several sizes (sketches, libraries in `lib', depth
+of source trees) are built against a fake Arduino distribution with many
+boards.txt files and a stub toolchain: the compiler writes empty objects,
+follows #include lines for -MM and the linker copies a tiny ELF file. So
+what is measured is ino's own overhead.
+
+`ino build' and `ino list-models' run in-process the way ino.runner runs
+them. Reported is wall time of build phases (discover, setup_flags,
+create_jinja, preprocess_sketches, scan_dependencies, make_hex), of
+loading and dumping the environment and time summed over all calls of
+board_models (boards.txt parsing), make (dependency scans included),
+render_template and the glob and filemap filters. The latter overlap the
+phases they are called from.
+
+Builds are timed from scratch (clean), with nothing to do (no-op), after
+a library source is touched (touch) and after it is edited (edit). Wall
+time of the CLI including interpreter start-up is reported for no-op
+builds and list-models. Finally Makefiles are rendered for up to 10k
+generated sources to check that generation scales linearly.
+
+Run from the source tree:
+
+    python -m bench.build_bench --json results.json
+"""
+
+import os
+import sys
+import stat
+import struct
+import shutil
+import argparse
+import tempfile
+import functools
+import subprocess
+
+from contextlib import contextmanager
+
+from bench.common import INO, Report, arg_parser, ino_env
+
+import ino.filters
+import ino.commands.build
+
+from ino.builddb import Manifest
+from ino.commands.build import Build
+from ino.commands.listmodels import ListModels
+from ino.environment import Environment
+from ino.filters import glob_cache
+from ino.utils import Timings, monotonic
+
+
+sizes = {
+    # sketches, libraries, tree depth, sources per directory,
+    # boards.txt files, models per boards.txt
+    'small': dict(sketches=1, libs=2, depth=1, files=2, boards_files=5, models=10),
+    'medium': dict(sketches=5, libs=10, depth=3, files=4, boards_files=20, models=20),
+    'large': dict(sketches=20, libs=40, depth=5, files=8, boards_files=100, models=40),
+}
+
+uno = """\
+uno.name=Arduino Uno
+uno.upload.protocol=arduino
+uno.upload.maximum_size=32256
+uno.upload.speed=115200
+uno.build.mcu=atmega328p
+uno.build.f_cpu=16000000L
+uno.build.core=arduino
+uno.build.variant=standard
+"""
+
+model = """\
+{name}.name=Arduino Synthetic {name}
+{name}.vid.0=0x2341
+{name}.pid.0=0x{pid:04x}
+{name}.upload.tool=avrdude
+{name}.upload.protocol=arduino
+{name}.upload.maximum_size=32256
+{name}.upload.maximum_data_size=2048
+{name}.upload.speed=115200
+{name}.bootloader.tool=avrdude
+{name}.bootloader.low_fuses=0xFF
+{name}.bootloader.high_fuses=0xDE
+{name}.bootloader.extended_fuses=0x05
+{name}.bootloader.file=optiboot/optiboot_atmega328.hex
+{name}.build.mcu=atmega328p
+{name}.build.f_cpu=16000000L
+{name}.build.board=AVR_SYNTHETIC
+{name}.build.core=arduino
+{name}.build.variant=standard
+{name}.menu.cpu.atmega328=ATmega328
+{name}.menu.cpu.atmega328.upload.maximum_size=30720
+{name}.menu.cpu.atmega168=ATmega168
+{name}.menu.cpu.atmega168.upload.maximum_size=14336
+{name}.menu.cpu.atmega168.build.mcu=atmega168
+
+"""
+
+# stands for avr-gcc and avr-g++
+stub_cc = """\
+#!/bin/sh
+out= mode=link src= dirs=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) out=$2; shift ;;
+        -c) mode=compile ;;
+        -MM) mode=deps ;;
+        -iquote) dirs="$dirs $2"; shift ;;
+        -I*) dirs="$dirs ${1#-I}" ;;
+        -*) ;;
+        *) src=$1 ;;
+    esac
+    shift
+done
+case $mode in
+    compile) : > "$out" ;;
+    link) cp "$(dirname "$0")/firmware.elf" "$out" ;;
+    deps)
+        deps=$src
+        for name in $(sed -n 's/^#include *[<"]\\([^>"]*\\)[>"].*/\\1/p' "$src"); do
+            for dir in $(dirname "$src") $dirs; do
+                if [ -f "$dir/$name" ]; then deps="$deps $dir/$name"; break; fi
+            done
+        done
+        obj=$(basename "$src")
+        echo "${obj%.*}.o: $deps" ;;
+esac
+"""
+
+# stands for avr-ar rcs ARCHIVE OBJECTS...
+stub_ar = """\
+#!/bin/sh
+: > "$2"
+"""
+
+# stands for avr-objcopy ... INPUT OUTPUT
+stub_objcopy = """\
+#!/bin/sh
+for arg; do out=$arg; done
+: > "$out"
+"""
+
+
+def minimal_elf(size):
+    """
+    Return a little-endian 32-bit ELF file with a single loadable .text
+    section of `size` bytes.
+    """
+    text = os.urandom(size)
+    strtab = '\0.text\0.shstrtab\0'
+    text_offset = 52 + 32
+    strtab_offset = text_offset + size
+    sh_offset = strtab_offset + len(strtab)
+
+    ident = '\x7fELF\x01\x01\x01' + '\0' * 9
+    header = struct.pack('<HHIIIIIHHHHHH', 2, 83, 1, 0, 52, sh_offset, 0, 52, 32, 1, 40, 3, 2)
+    program = struct.pack('<IIIIIIII', 1, text_offset, 0, 0, size, size, 5, 1)
+    sections = [
+        (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        (1, 1, 6, 0, text_offset, size, 0, 0, 2, 0),
+        (7, 3, 0, 0, strtab_offset, len(strtab), 0, 0, 1, 0),
+    ]
+    return ident + header + program + text + strtab + \
+        ''.join(struct.pack('<IIIIIIIIII', *s) for s in sections)
+
+
+def write(path, contents, mode=None):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    if mode:
+        os.chmod(path, os.stat(path).st_mode | mode)
+
+
+def write_sources(dirname, name, files, depth, includes=()):
+    """
+    Write `files` sources and headers in each of `depth` nested directories
+    of `dirname`. Sources in the top directory include `includes`.
+    """
+    for level in range(depth):
+        subdir = os.path.join(dirname, *['sub%d' % i for i in range(level)])
+        for i in range(files):
+            base = '%s_%d_%d' % (name, level, i)
+            lines = ['#include "%s.h"' % base]
+            if level == 0:
+                lines += ['#include <%s>' % h for h in includes]
+            lines.append('int %s(int x) { return x + %d; }' % (base, i))
+            write(os.path.join(subdir, base + '.h'), 'int %s(int x);\n' % base)
+            write(os.path.join(subdir, base + '.cpp'), '\n'.join(lines) + '\n')
+
+
+def make_dist(root, size):
+    dist = os.path.join(root, 'arduino')
+    write(os.path.join(dist, 'lib', 'version.txt'), '1.0.5\n')
+
+    hardware = os.path.join(dist, 'hardware')
+    write(os.path.join(hardware, 'arduino', 'boards.txt'), uno)
+    core = os.path.join(hardware, 'arduino', 'cores', 'arduino')
+    write(os.path.join(core, 'Arduino.h'), '#include "wiring.h"\n')
+    write_sources(core, 'wiring', size['files'] * 2, 1)
+    write(os.path.join(core, 'wiring.h'), '')
+    write(os.path.join(hardware, 'arduino', 'variants', 'standard', 'pins_arduino.h'), '')
+
+    pid = 0
+    for i in range(size['boards_files']):
+        contents = []
+        for _ in range(size['models']):
+            pid += 1
+            contents.append(model.format(name='synthetic%d' % pid, pid=pid))
+        write(os.path.join(hardware, 'vendor%d' % i, 'avr', 'boards.txt'), ''.join(contents))
+
+    # standard libraries no sketch uses still have to be scanned
+    for i in range(size['libs']):
+        write_sources(os.path.join(dist, 'libraries', 'Standard%d' % i), 'Standard%d' % i,
+                      size['files'], size['depth'])
+
+    bin_dir = os.path.join(hardware, 'tools', 'avr', 'bin')
+    for name in ('avr-gcc', 'avr-g++'):
+        write(os.path.join(bin_dir, name), stub_cc, stat.S_IXUSR)
+    write(os.path.join(bin_dir, 'avr-ar'), stub_ar, stat.S_IXUSR)
+    write(os.path.join(bin_dir, 'avr-objcopy'), stub_objcopy, stat.S_IXUSR)
+    write(os.path.join(bin_dir, 'firmware.elf'), minimal_elf(16 * 1024))
+    return dist
+
+
+def make_project(root, size):
+    """
+    Create a project whose sketches use every library in `lib'. Each
+    library uses the next one, so dependencies of libraries are scanned
+    too. Return the project path and a library source to touch.
+    """
+    project = os.path.join(root, 'project')
+    libs = ['Lib%d' % i for i in range(size['libs'])]
+    for i, lib in enumerate(libs):
+        includes = [libs[i + 1] + '.h'] if i + 1 < len(libs) else []
+        lib_dir = os.path.join(project, 'lib', lib)
+        write(os.path.join(lib_dir, lib + '.h'), 'int %s(int x);\n' % lib)
+        write_sources(lib_dir, lib, size['files'], size['depth'], includes)
+
+    src = os.path.join(project, 'src')
+    for i in range(size['sketches']):
+        lines = ['#include <%s.h>' % lib for lib in libs[i::size['sketches']]]
+        lines.append('int sketch%d(int x) { return x; }' % i)
+        if i == 0:
+            lines += ['void setup() {}', 'void loop() {}']
+        write(os.path.join(src, 'sketch%d.ino' % i), '\n'.join(lines) + '\n')
+    write_sources(src, 'module', size['files'], size['depth'])
+
+    touched = os.path.join(project, 'lib', libs[-1], '%s_0_0.cpp' % libs[-1]) if libs else None
+    return project, touched
+
+
+def timed(timings, name, func):
+    """
+    Wrap `func` so that time spent in it is added to `timings` as `name`.
+    Recursive calls are not counted twice.
+    """
+    depth = [0]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if depth[0]:
+            return func(*args, **kwargs)
+        depth[0] += 1
+        started = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            depth[0] -= 1
+            timings.add(name, monotonic() - started)
+    return wrapper
+
+
+@contextmanager
+def instrumented_filters(timings):
+    """
+    Time the glob and filemap filters wherever they are called from.
+    """
+    patched = []
+    for module in (ino.filters, ino.commands.build):
+        for name in ('glob', 'filemap'):
+            func = getattr(module, name)
+            patched.append((module, name, func))
+            setattr(module, name, timed(timings, name, func))
+    try:
+        yield
+    finally:
+        for module, name, func in patched:
+            setattr(module, name, func)
+
+
+@contextmanager
+def quiet():
+    """
+    Send output of ino and make to /dev/null.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def run_command(cls, argv, timings, phases=()):
+    """
+    Run ino command `cls` with `argv` in-process the way ino.runner does,
+    timing its methods named in `phases`.
+    """
+    with timings.phase('load'):
+        e = Environment()
+        e.load()
+    command = cls(e)
+    parser = argparse.ArgumentParser()
+    command.setup_arg_parser(parser)
+    args = parser.parse_args(argv)
+
+    for name in phases:
+        setattr(command, name, timed(timings, name, getattr(command, name)))
+    e.board_models = timed(timings, 'board_models', e.board_models)
+
+    try:
+        with quiet():
+            with timings.phase('process_args'):
+                e.process_args(args)
+            if cls is Build:
+                for path in (e.build_dir, e.lib_dir):
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+            with instrumented_filters(timings):
+                command.run(args)
+    finally:
+        with timings.phase('dump'):
+            e.dump()
+
+
+def report_timings(report, scenario, timings, **metrics):
+    for name, seconds in timings.items():
+        metrics['%s_ms' % name] = seconds * 1000
+    report.add(scenario, **metrics)
+
+
+def bench_build(report, label, dist, touched, iterations):
+    argv = ['-d', dist, '-m', 'uno']
+    phases = ['discover', 'setup_flags', 'create_jinja', 'preprocess_sketches',
+              'scan_dependencies', 'make', 'make_hex', 'render_template']
+
+    if os.path.isdir('.build'):
+        shutil.rmtree('.build')
+    for kind in ('clean', 'no-op', 'touch', 'edit'):
+        for i in range(iterations):
+            if kind == 'clean' and i:
+                shutil.rmtree('.build')
+            if kind == 'touch' and touched:
+                os.utime(touched, None)
+            if kind == 'edit' and touched:
+                with open(touched, 'a') as f:
+                    f.write('// edit %d\n' % i)
+            timings = Timings()
+            started = monotonic()
+            run_command(Build, argv, timings, phases)
+            report_timings(report, '%s build %s' % (label, kind), timings,
+                           total_ms=(monotonic() - started) * 1000)
+
+
+def bench_list_models(report, label, dist, iterations):
+    pickle = os.path.join('.build', 'environment.pickle')
+    for kind in ('cold', 'warm'):
+        for _ in range(iterations):
+            if kind == 'cold' and os.path.exists(pickle):
+                os.remove(pickle)
+            timings = Timings()
+            started = monotonic()
+            run_command(ListModels, ['-d', dist], timings)
+            report_timings(report, '%s list-models %s' % (label, kind), timings,
+                           total_ms=(monotonic() - started) * 1000)
+
+
+def bench_cli(report, label, dist, iterations):
+    """
+    Time ino as run from the command line, interpreter start-up included.
+    """
+    env = ino_env()
+    for scenario, argv in (('build no-op', ['build', '-d', dist, '-m', 'uno']),
+                           ('list-models', ['list-models', '-d', dist])):
+        times = []
+        for _ in range(iterations):
+            started = monotonic()
+            with open(os.devnull, 'w') as devnull:
+                ret = subprocess.call(INO + argv, stdout=devnull, env=env, close_fds=True)
+            times.append(monotonic() - started)
+            if ret != 0:
+                raise RuntimeError('ino %s failed with code %s' % (' '.join(argv), ret))
+        report.add('%s cli %s' % (label, scenario), iterations=iterations,
+                   mean_ms=1000 * sum(times) / len(times), min_ms=1000 * min(times))
+
+
+def bench_makefile(report, counts, iterations):
+    """
+    Time rendering of Makefile.deps and Makefile for a project of each
+    number of sources in `counts` to show how generation scales.
+    """
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        dist = make_dist(root, sizes['small'])
+        project = os.path.join(root, 'project')
+        for count in counts:
+            if os.path.isdir(project):
+                shutil.rmtree(project)
+            for i in range(count):
+                write(os.path.join(project, 'src', 'dir%d' % (i / 100), 'gen%d.cpp' % i),
+                      'int gen%d;\n' % i)
+            os.chdir(project)
+
+            e = Environment()
+            build = Build(e)
+            parser = argparse.ArgumentParser()
+            build.setup_arg_parser(parser)
+            args = parser.parse_args(['-d', dist, '-m', 'uno'])
+            with quiet():
+                e.process_args(args)
+                os.makedirs(e.build_dir)
+                build.jobs = 1
+                build.discover(args)
+                build.setup_flags(args)
+                build.setup_archives(args)
+                build.create_jinja(verbose=False)
+            e['used_libs'] = [e.arduino_core_dir]
+            e['core_cppflags'] = e.cppflags
+            inc_flags = build.recursive_inc_lib_flags(e.incflag, e.used_libs)
+
+            deps_times, make_times = [], []
+            for _ in range(iterations):
+                with glob_cache():
+                    started = monotonic()
+                    build.render_template('Makefile.deps.jinja', 'Makefile.deps', src_dir=e.src_dir,
+                                          inc_flags=inc_flags, manifest=Manifest())
+                    deps_times.append(monotonic() - started)
+                    started = monotonic()
+                    makefile = build.render_template('Makefile.jinja', 'Makefile', manifest=Manifest())
+                    make_times.append(monotonic() - started)
+            makefile_size = os.path.getsize(makefile)
+            os.chdir(cwd)
+
+            report.add('makefile %d sources' % count, sources=count,
+                       deps_render_ms=min(deps_times) * 1000,
+                       render_ms=min(make_times) * 1000,
+                       us_per_source=(min(deps_times) + min(make_times)) * 1e6 / count,
+                       makefile_kb=makefile_size / 1024.0)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+
+def main():
+    parser = arg_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='small,medium,large',
+                        help='Comma separated project sizes: %s, empty to skip' % ', '.join(sorted(sizes)))
+    parser.add_argument('--iterations', type=int, default=3,
+                        help='Number of runs in every scenario')
+    parser.add_argument('--sources', default='1000,2500,5000,10000',
+                        help='Comma separated numbers of sources to generate '
+                        'Makefiles for, empty to skip')
+    args = parser.parse_args()
+
+    report = Report('build')
+    cwd = os.getcwd()
+    for label in filter(None, args.sizes.split(',')):
+        size = sizes[label]
+        root = tempfile.mkdtemp()
+        try:
+            dist = make_dist(root, size)
+            project, touched = make_project(root, size)
+            os.chdir(project)
+            bench_build(report, label, dist, touched, args.iterations)
+            bench_list_models(report, label, dist, args.iterations)
+            bench_cli(report, label, dist, args.iterations)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root)
+
+    if args.sources:
+        bench_makefile(report, [int(n) for n in args.sources.split(',')], args.iterations)
+
+    if args.json:
+        report.dump(args.json)
+
+
+if __name__ == '__main__':
+    main()
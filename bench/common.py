@@ -0,0 +1,114 @@
+# -*- coding: utf-8; -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+
+from ino.environment import Environment
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INO = [sys.executable, os.path.join(ROOT, 'bin', 'ino')]
+
+
+def ino_env(**extra):
+    """
+    Environment to run ino from this source tree in.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    env.update(extra)
+    return env
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_opened(pid, path, timeout=10):
+    """
+    Wait for process `pid` to open `path`. Return False on timeout.
+    """
+    fd_dir = '/proc/%d/fd' % pid
+    if not os.path.isdir(fd_dir):
+        # no procfs, give the process a moment
+        time.sleep(1)
+        return True
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for fd in os.listdir(fd_dir):
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) == path:
+                    return True
+            except OSError:
+                pass
+        time.sleep(0.01)
+    return False
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Report(object):
+    """
+    Results of a benchmark run. Every result is a scenario name with a dict
+    of metrics. Results are printed as they come and could be dumped to
+    JSON for comparison between runs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.results = []
+
+    def add(self, scenario, **metrics):
+        self.results.append(dict(scenario=scenario, **metrics))
+        print '%-32s %s' % (scenario, '  '.join('%s=%s' % (k, self.format(v))
+                                                for k, v in sorted(metrics.iteritems())))
+        sys.stdout.flush()
+
+    def format(self, value):
+        if isinstance(value, float):
+            return '%.4g' % value
+        return str(value)
+
+    def dump(self, path):
+        data = {
+            'benchmark': self.name,
+            'python': sys.version.split()[0],
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': self.results,
+        }
+        if path == '-':
+            json.dump(data, sys.stdout, indent=2, sort_keys=True)
+            print
+        else:
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+
+
+def arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write results as JSON to FILE, - for stdout')
+    return parser
+
+
+class BenchEnvironment(Environment):
+    """
+    Environment that looks for serial ports matching `patterns`.
+    """
+
+    def __init__(self, patterns):
+        super(BenchEnvironment, self).__init__()
+        self.patterns = patterns
+
+    def serial_port_patterns(self):
+        return self.patterns
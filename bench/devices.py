@@ -0,0 +1,172 @@
+# -*- coding: utf-8; -*-
+
+"""
+Device emulators on pseudo terminals.
+"""
+
+import os
+import pty
+import tty
+import time
+import struct
+import termios
+import threading
+
+from ino.utils import monotonic
+
+
+# frame header: magic, sequence number, monotonic time the frame was sent at
+frame_header = struct.Struct('<2sId')
+frame_magic = 'SY'
+
+
+class SyntheticDevice(threading.Thread):
+    """
+    Stream frames of `frame_size` bytes at `rate` bytes per second into the
+    master side of a pty for `duration` seconds. Connect to `port`.
+
+    A pty never drops data, its writer blocks instead. So if the reader
+    can't keep up `sent` falls behind what `rate` allows.
+    """
+
+    def __init__(self, rate, frame_size=64, duration=5.0):
+        super(SyntheticDevice, self).__init__()
+        self.daemon = True
+        if frame_size < frame_header.size:
+            raise ValueError("Frame size should be at least %d bytes" % frame_header.size)
+        self.rate = rate
+        self.frame_size = frame_size
+        self.duration = duration
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.padding = 'U' * (frame_size - frame_header.size)
+        self.sent = 0
+        self.frames = 0
+        self.elapsed = None
+        self.stopped = False
+
+    def close(self):
+        self.stopped = True
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        start = monotonic()
+        end = start + self.duration
+        while not self.stopped:
+            now = monotonic()
+            if now >= end:
+                break
+            # send all frames that are due at once
+            due = int((now - start) * self.rate / self.frame_size) + 1 - self.frames
+            if due <= 0:
+                time.sleep(min(end - now, float(self.frame_size) / self.rate))
+                continue
+            data = ''.join(frame_header.pack(frame_magic, self.frames + i, monotonic()) + self.padding
+                           for i in xrange(due))
+            os.write(self.master, data)
+            self.frames += due
+            self.sent += len(data)
+        self.elapsed = monotonic() - start
+
+
+class FrameParser(object):
+    """
+    Parse frames of SyntheticDevice. `latencies` are differences between
+    the time frames were received at and the time they were sent at.
+    """
+
+    def __init__(self, frame_size):
+        self.frame_size = frame_size
+        self.buffer = ''
+        self.received = 0
+        self.frames = 0
+        self.missing_frames = 0
+        self.corrupted = 0
+        self.latencies = []
+        self.next_seq = 0
+
+    def feed(self, data, timestamp):
+        self.received += len(data)
+        buf = self.buffer + data
+        offset = 0
+        while len(buf) - offset >= self.frame_size:
+            magic, seq, sent_at = frame_header.unpack_from(buf, offset)
+            if magic != frame_magic:
+                # lost sync, look for the next frame
+                found = buf.find(frame_magic, offset + 1)
+                skip = (found if found >= 0 else len(buf)) - offset
+                self.corrupted += skip
+                offset += skip
+                continue
+            self.missing_frames += max(0, seq - self.next_seq)
+            self.next_seq = seq + 1
+            self.frames += 1
+            self.latencies.append(timestamp - sent_at)
+            offset += self.frame_size
+        self.buffer = buf[offset:]
+
+
+class ReenumeratingDevice(threading.Thread):
+    """
+    Emulate a board like Leonardo that, when its port is touched at 1200
+    bps, disappears and shows up as another port after `delay` seconds.
+
+    Ports are symlinks named `name` in `dirname` pointing to ptys. If a fake
+    `bootloader` is given, it is started and the new port points to it. The
+    time the new port appeared at is kept in `appeared`.
+    """
+
+    def __init__(self, dirname, name='ttyACM0', boot_name='ttyACM1', delay=0.0, bootloader=None):
+        super(ReenumeratingDevice, self).__init__()
+        self.daemon = True
+        self.dirname = dirname
+        self.delay = delay
+        self.bootloader = bootloader
+        self.port = os.path.join(dirname, name)
+        self.boot_port = os.path.join(dirname, boot_name)
+        self.ptys = []
+        self.appeared = None
+        self.stopped = False
+        self.attach(self.port)
+
+    def attach(self, link):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.ptys.append((master, slave))
+        os.symlink(os.ttyname(slave), link)
+        return slave
+
+    def run(self):
+        _, slave = self.ptys[0]
+        while not self.stopped:
+            if termios.tcgetattr(slave)[4] == termios.B1200:
+                break
+            time.sleep(0.001)
+        else:
+            return
+
+        os.remove(self.port)
+        time.sleep(self.delay)
+        if self.bootloader:
+            self.bootloader.start()
+            os.symlink(self.bootloader.port, self.boot_port)
+        else:
+            self.attach(self.boot_port)
+        self.appeared = monotonic()
+
+    def close(self):
+        self.stopped = True
+        if self.is_alive():
+            self.join()
+        if self.bootloader and self.bootloader.is_alive():
+            self.bootloader.stop()
+        for link in (self.port, self.boot_port):
+            if os.path.lexists(link):
+                os.remove(link)
+        for master, slave in self.ptys:
+            os.close(master)
+            os.close(slave)
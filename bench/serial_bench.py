@@ -0,0 +1,202 @@
+# -*- coding: utf-8; -*-
+
+"""
+Serial I/O benchmark.
+
+`ino serial` is run against a pty fed by a synthetic device at given
+rates and frame sizes, printing to a pipe (monitor) or recording to disk
+(capture). Reported are the rate the device managed to send at, sustained
+throughput, dropped bytes, CPU time of ino and end-to-end latency of
+frames. Reset sequences of `ino upload` are timed in-process against
+emulated boards.
+
+Run from the source tree:
+
+    python -m bench.serial_bench --json results.json
+"""
+
+import os
+import glob
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+from bench.common import INO, Report, BenchEnvironment, arg_parser, ino_env, \
+    children_cpu_time, wait_opened, percentile
+from bench.devices import SyntheticDevice, FrameParser, ReenumeratingDevice
+
+from ino.commands.upload import Upload
+from ino.utils import monotonic
+
+
+def run_serial(device, args, stdout=None):
+    """
+    Run `ino serial` on the device port for as long as the device streams.
+    Return CPU time ino used.
+    """
+    cpu_before = children_cpu_time()
+    baud_rate = str(device.rate * 10)
+    proc = subprocess.Popen(INO + ['serial', '-p', device.port, '-b', baud_rate] + args,
+                            stdin=open(os.devnull), stdout=stdout, env=ino_env(),
+                            close_fds=True)
+    try:
+        if not wait_opened(proc.pid, device.port):
+            raise RuntimeError("ino serial didn't open %s" % device.port)
+        device.start()
+        device.join()
+        # let the monitor drain what is buffered
+        threading.Event().wait(0.5)
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+        proc.wait()
+    return children_cpu_time() - cpu_before
+
+
+def report_stream(report, scenario, device, parser, cpu):
+    latencies = [l * 1000 for l in parser.latencies]
+    report.add(scenario,
+               target_rate=device.rate,
+               sent_rate=device.sent / device.elapsed,
+               throughput=parser.received / device.elapsed,
+               dropped=device.sent - parser.received,
+               missing_frames=parser.missing_frames,
+               latency_p50_ms=percentile(latencies, 50),
+               latency_p99_ms=percentile(latencies, 99),
+               latency_max_ms=max(latencies) if latencies else None,
+               cpu_s=cpu,
+               cpu_pct=100 * cpu / device.elapsed)
+
+
+def bench_monitor(report, rate, frame_size, duration):
+    device = SyntheticDevice(rate, frame_size, duration)
+    parser = FrameParser(frame_size)
+    try:
+        read_fd, write_fd = os.pipe()
+
+        def read_output():
+            while True:
+                data = os.read(read_fd, 1 << 16)
+                if not data:
+                    break
+                parser.feed(data, monotonic())
+
+        reader = threading.Thread(target=read_output)
+        reader.daemon = True
+        reader.start()
+        try:
+            cpu = run_serial(device, [], stdout=write_fd)
+        finally:
+            os.close(write_fd)
+            reader.join()
+            os.close(read_fd)
+    finally:
+        device.close()
+
+    report_stream(report, 'monitor %d B/s %d B' % (rate, frame_size), device, parser, cpu)
+
+
+def bench_capture(report, rate, frame_size, duration):
+    device = SyntheticDevice(rate, frame_size, duration)
+    parser = FrameParser(frame_size)
+    capture_dir = tempfile.mkdtemp()
+    try:
+        cpu = run_serial(device, ['-q', '--capture', capture_dir])
+        for ts_path in sorted(glob.glob(os.path.join(capture_dir, '*.ts'))):
+            read_capture(ts_path, parser)
+    finally:
+        device.close()
+        shutil.rmtree(capture_dir)
+
+    report_stream(report, 'capture %d B/s %d B' % (rate, frame_size), device, parser, cpu)
+
+
+def read_capture(ts_path, parser):
+    with open(ts_path[:-len('.ts')] + '.bin', 'rb') as f:
+        data = f.read()
+    with open(ts_path) as f:
+        chunks = [line.split() for line in f if not line.startswith('#')]
+    offsets = [int(offset) for offset, _ in chunks] + [len(data)]
+    for i, (_, timestamp) in enumerate(chunks):
+        parser.feed(data[offsets[i]:offsets[i + 1]], float(timestamp))
+
+
+def bench_reset(report, iterations):
+    dirname = tempfile.mkdtemp()
+    try:
+        e = BenchEnvironment([os.path.join(dirname, 'ttyACM*')])
+        upload = Upload(e)
+
+        # DTR pulse as done for boards with a USB-to-serial chip
+        board = {'upload': {'protocol': 'arduino'}}
+        device = ReenumeratingDevice(dirname)
+        try:
+            times = []
+            for _ in range(iterations):
+                start = monotonic()
+                upload.reset(board, device.port)
+                times.append(monotonic() - start)
+        finally:
+            device.close()
+        report.add('reset dtr', iterations=iterations,
+                   mean_ms=1000 * sum(times) / len(times), max_ms=1000 * max(times))
+
+        # 1200 bps touch followed by re-enumeration as done for Leonardo
+        board = {'upload': {'protocol': 'avr109'}}
+        times, detection = [], []
+        for _ in range(iterations):
+            device = ReenumeratingDevice(dirname)
+            device.start()
+            try:
+                start = monotonic()
+                port = upload.reset(board, device.port)
+                end = monotonic()
+                if port != device.boot_port:
+                    raise RuntimeError("Wrong bootloader port %s" % port)
+                times.append(end - start)
+                detection.append(end - device.appeared)
+            finally:
+                device.close()
+        report.add('reset touch', iterations=iterations,
+                   mean_ms=1000 * sum(times) / len(times), max_ms=1000 * max(times),
+                   detection_mean_ms=1000 * sum(detection) / len(detection),
+                   detection_max_ms=1000 * max(detection))
+    finally:
+        shutil.rmtree(dirname)
+
+
+def main():
+    parser = arg_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument('--rates', default='10000,100000,200000',
+                        help='Comma separated device rates in bytes per second')
+    parser.add_argument('--frame-sizes', default='16,64,1024',
+                        help='Comma separated frame sizes in bytes')
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='Seconds the device streams for in every scenario')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='Number of reset sequences to time')
+    parser.add_argument('--only', choices=['monitor', 'capture', 'reset'], action='append',
+                        help='Run only these scenarios')
+    args = parser.parse_args()
+
+    report = Report('serial')
+    only = args.only or ['monitor', 'capture', 'reset']
+    rates = [int(r) for r in args.rates.split(',')]
+    frame_sizes = [int(s) for s in args.frame_sizes.split(',')]
+    for rate in rates:
+        for frame_size in frame_sizes:
+            if 'monitor' in only:
+                bench_monitor(report, rate, frame_size, args.duration)
+            if 'capture' in only:
+                bench_capture(report, rate, frame_size, args.duration)
+    if 'reset' in only:
+        bench_reset(report, args.iterations)
+
+    if args.json:
+        report.dump(args.json)
+
+
+if __name__ == '__main__':
+    main()
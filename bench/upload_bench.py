@@ -0,0 +1,200 @@
+# -*- coding: utf-8; -*-
+
+"""
+Upload pipeline benchmark.
+
+`Upload.run` is run in-process end to end against fake bootloaders on ptys
+for an Uno-like board (stk500v1, DTR reset) and a Leonardo-like board
+(avr109, 1200 bps touch and re-enumeration), with the native programmer
+and with a fake `avrdude` script on $PATH. Reported is wall time of every
+upload phase: discovery, hupcl, dtr, touch, programming and flashlog.
+The first iteration of a scenario has no cached environment (cold), the
+rest reuse it (warm).
+
+Run from the source tree:
+
+    python -m bench.upload_bench --json results.json
+"""
+
+import os
+import stat
+import shutil
+import argparse
+import tempfile
+
+from bench.common import Report, BenchEnvironment, arg_parser
+from bench.devices import ReenumeratingDevice
+
+from ino.commands.upload import Upload
+from ino.hexfile import Image, write_hex
+from ino.utils import monotonic
+
+from tests.fake_bootloaders import FakeStk500v1, FakeAvr109
+
+
+boards_txt = """\
+uno.name=Arduino Uno
+uno.upload.protocol=arduino
+uno.upload.maximum_size=32256
+uno.upload.speed=115200
+uno.build.mcu=atmega328p
+uno.build.f_cpu=16000000L
+uno.build.core=arduino
+uno.build.variant=standard
+
+leonardo.name=Arduino Leonardo
+leonardo.upload.protocol=avr109
+leonardo.upload.maximum_size=28672
+leonardo.upload.speed=57600
+leonardo.upload.use_1200bps_touch=true
+leonardo.upload.wait_for_upload_port=true
+leonardo.build.mcu=atmega32u4
+leonardo.build.f_cpu=16000000L
+leonardo.build.vid=0x2341
+leonardo.build.pid=0x8036
+leonardo.build.core=arduino
+leonardo.build.variant=leonardo
+"""
+
+# stands for avrdude: checks the firmware file is readable and takes
+# $FAKE_AVRDUDE_DELAY seconds to "program" it
+fake_avrdude = """\
+#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in
+        flash:[wv]:*) file=${arg#flash:?:}; file=${file%:i} ;;
+    esac
+done
+test -r "$file" || { echo "avrdude: can't open $file" >&2; exit 1; }
+sleep ${FAKE_AVRDUDE_DELAY:-0}
+"""
+
+
+def make_tree(root, firmware_size):
+    """
+    Create a fake Arduino distribution, a bin directory with fake avrdude
+    and a project in `root`. Return their paths.
+    """
+    dist = os.path.join(root, 'arduino')
+    os.makedirs(os.path.join(dist, 'hardware', 'arduino'))
+    os.makedirs(os.path.join(dist, 'hardware', 'tools'))
+    with open(os.path.join(dist, 'hardware', 'arduino', 'boards.txt'), 'w') as f:
+        f.write(boards_txt)
+    open(os.path.join(dist, 'hardware', 'tools', 'avrdude.conf'), 'w').close()
+
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    avrdude = os.path.join(bin_dir, 'avrdude')
+    with open(avrdude, 'w') as f:
+        f.write(fake_avrdude)
+    os.chmod(avrdude, os.stat(avrdude).st_mode | stat.S_IXUSR)
+
+    project = os.path.join(root, 'project')
+    os.makedirs(os.path.join(project, 'src'))
+    with open(os.path.join(project, 'src', 'sketch.ino'), 'w') as f:
+        f.write('void setup() {}\nvoid loop() {}\n')
+
+    image = Image()
+    image.add(0, bytearray(os.urandom(firmware_size)))
+    return dist, bin_dir, project, image
+
+
+def run_upload(e, argv, image):
+    """
+    Run `ino upload` with `argv` the way ino.runner does. Return Upload
+    timings.
+    """
+    e.load()
+    upload = Upload(e)
+    parser = argparse.ArgumentParser()
+    upload.setup_arg_parser(parser)
+    args = parser.parse_args(argv)
+    e.process_args(args)
+
+    hex_path = e['hex_path']
+    if not os.path.exists(hex_path):
+        os.makedirs(os.path.dirname(hex_path))
+        write_hex(image, hex_path)
+
+    try:
+        upload.run(args)
+    finally:
+        e.dump()
+    return upload.timings
+
+
+def bench_scenario(report, root, model, programmer, iterations, image, dist):
+    dev_dir = os.path.join(root, 'dev')
+    os.makedirs(dev_dir)
+    pickle = os.path.join('.build', 'environment.pickle')
+    if os.path.exists(pickle):
+        os.remove(pickle)
+
+    try:
+        for i in range(iterations):
+            if model == 'uno':
+                bootloader = FakeStk500v1('atmega328p')
+                bootloader.start()
+                device = None
+                port = bootloader.port
+            else:
+                bootloader = FakeAvr109('atmega32u4')
+                device = ReenumeratingDevice(dev_dir, bootloader=bootloader)
+                device.start()
+                port = device.port
+
+            e = BenchEnvironment([os.path.join(dev_dir, 'ttyACM*')])
+            argv = ['-d', dist, '-m', model, '-p', port, '--force', '--programmer', programmer]
+            started = monotonic()
+            try:
+                timings = run_upload(e, argv, image)
+            finally:
+                if device:
+                    device.close()
+                elif bootloader.is_alive():
+                    bootloader.stop()
+            total = monotonic() - started
+
+            metrics = dict(('%s_ms' % name, seconds * 1000) for name, seconds in timings.items())
+            metrics['total_ms'] = total * 1000
+            report.add('%s %s %s' % (model, programmer, 'cold' if i == 0 else 'warm'), **metrics)
+    finally:
+        shutil.rmtree(dev_dir)
+
+
+def main():
+    parser = arg_parser(__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=3,
+                        help='Number of uploads in every scenario')
+    parser.add_argument('--firmware-size', type=int, default=16 * 1024,
+                        help='Firmware size in bytes')
+    parser.add_argument('--avrdude-delay', type=float, default=0.0,
+                        help='Seconds fake avrdude takes to program')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    home = os.environ.get('HOME')
+    report = Report('upload')
+    try:
+        dist, bin_dir, project, image = make_tree(root, args.firmware_size)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['HOME'] = root
+        os.environ['FAKE_AVRDUDE_DELAY'] = str(args.avrdude_delay)
+        os.chdir(project)
+
+        for model in ('uno', 'leonardo'):
+            for programmer in ('native', 'avrdude'):
+                bench_scenario(report, root, model, programmer, args.iterations, image, dist)
+    finally:
+        os.chdir(cwd)
+        if home is not None:
+            os.environ['HOME'] = home
+        shutil.rmtree(root)
+
+    if args.json:
+        report.dump(args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8; -*-
+
+"""
+Content based rebuild decisions. make decides what to rebuild by mtimes
+which fresh clones, checkouts and copied `.build' directories break. So
+ino keeps hashes of target inputs in a database and, before make runs,
+sets mtimes of targets so that make rebuilds exactly those whose input
+contents, included headers or commands have changed.
+
+Headers each source includes are kept in the same database, so make
+doesn't have to read a dependency file per object on every run.
+"""
+
+import os
+import re
+import time
+import errno
+import sqlite3
+import hashlib
+
+from ino.utils import counters
+
+
+class BuildDB(object):
+    """
+    SQLite database of file digests, target signatures, headers included
+    by sources and how long targets took to build, normally
+    `.build/<board>/build.db'.
+
+    Digests are cached along with file mtime and size, so a file is read
+    only if they change. Files modified a moment before they were hashed
+    aren't cached as they could change again within mtime resolution.
+    """
+
+    racy_interval = 2.0
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, mtime REAL, size INTEGER, digest TEXT);
+            CREATE TABLE IF NOT EXISTS targets (
+                target TEXT PRIMARY KEY, signature TEXT);
+            CREATE TABLE IF NOT EXISTS deps (
+                source TEXT, header TEXT);
+            CREATE INDEX IF NOT EXISTS deps_source ON deps (source);
+            CREATE TABLE IF NOT EXISTS timings (
+                target TEXT PRIMARY KEY, seconds REAL);
+        """)
+        self.files = dict((path, (mtime, size, digest)) for path, mtime, size, digest
+                          in self.conn.execute('SELECT path, mtime, size, digest FROM files'))
+        self.signatures = dict(self.conn.execute('SELECT target, signature FROM targets'))
+        self.timings = dict(self.conn.execute('SELECT target, seconds FROM timings'))
+        self.includes = None
+        self.changed_files = {}
+        self.changed_signatures = {}
+        self.changed_includes = {}
+        self.changed_timings = {}
+
+    def stat(self, path):
+        """
+        Return (mtime, size) of `path` or None if it doesn't exist.
+        """
+        counters.count('stat')
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+        return st.st_mtime, st.st_size
+
+    def digest(self, path, stat=None):
+        """
+        Return hex SHA-1 digest of `path` contents or None if it doesn't
+        exist. `stat` is the result of `stat(path)` if already known.
+        """
+        stat = stat or self.stat(path)
+        if stat is None:
+            return None
+        cached = self.files.get(path)
+        if cached and cached[:2] == stat:
+            return cached[2]
+
+        counters.count('hash')
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), ''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if stat[0] < time.time() - self.racy_interval:
+            self.files[path] = stat + (digest,)
+            self.changed_files[path] = stat + (digest,)
+        return digest
+
+    def set_mtime(self, path, mtime):
+        """
+        Set mtime of `path` keeping its cached digest valid.
+        """
+        os.utime(path, (mtime, mtime))
+        cached = self.files.get(path)
+        if cached:
+            stat = self.stat(path)
+            if stat and stat[1] == cached[1]:
+                self.files[path] = self.changed_files[path] = stat + cached[2:]
+
+    def signature(self, target):
+        return self.signatures.get(target)
+
+    def set_signature(self, target, signature):
+        self.signatures[target] = signature
+        self.changed_signatures[target] = signature
+
+    def timing(self, target, default=None):
+        """
+        Return seconds `target` took to build last time.
+        """
+        return self.timings.get(target, default)
+
+    def set_timing(self, target, seconds):
+        self.timings[target] = seconds
+        self.changed_timings[target] = seconds
+
+    def headers(self, source):
+        """
+        Return headers `source` includes as of its last dependency scan.
+        """
+        if self.includes is None:
+            self.includes = {}
+            for path, header in self.conn.execute('SELECT source, header FROM deps ORDER BY rowid'):
+                self.includes.setdefault(path, []).append(header)
+        return self.includes.get(source, [])
+
+    def set_headers(self, source, headers):
+        self.headers(source)
+        self.includes[source] = headers
+        self.changed_includes[source] = headers
+
+    def commit(self):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                  ((path,) + row for path, row in self.changed_files.iteritems()))
+            self.conn.executemany('INSERT OR REPLACE INTO targets VALUES (?, ?)',
+                                  self.changed_signatures.iteritems())
+            self.conn.executemany('INSERT OR REPLACE INTO timings VALUES (?, ?)',
+                                  self.changed_timings.iteritems())
+            self.conn.executemany('DELETE FROM deps WHERE source = ?',
+                                  ((source,) for source in self.changed_includes))
+            self.conn.executemany('INSERT INTO deps VALUES (?, ?)',
+                                  ((source, header) for source, headers in self.changed_includes.iteritems()
+                                   for header in headers))
+        self.changed_files = {}
+        self.changed_signatures = {}
+        self.changed_includes = {}
+        self.changed_timings = {}
+
+    def close(self):
+        self.conn.close()
+
+
+def read_deps(path):
+    """
+    Return prerequisites listed in make dependency file `path` generated
+    by `gcc -MM', an empty list if there is no such file.
+    """
+    try:
+        with open(path) as f:
+            contents = f.read()
+    except IOError:
+        return []
+    _, _, prerequisites = contents.replace('\\\n', ' ').partition(': ')
+    return prerequisites.split()
+
+
+class Manifest(object):
+    """
+    Targets of a Makefile with their inputs and commands. The Makefile
+    template registers them with `{% do manifest.add(...) %}'.
+
+    A target signature is a hash of its command and digests of its inputs,
+    including headers its source includes. Before make runs, `prepare'
+    compares signatures with recorded ones: targets with changed or no
+    recorded signatures get the oldest mtime possible, so make rebuilds
+    them, unchanged targets get the mtime of their newest input, so make
+    leaves them alone unless one of their inputs is rebuilt and really
+    changes. After a successful make `record' imports rebuilt dependency
+    files and saves signatures.
+
+    With a build cache, see ino.cache, stale targets whose inputs are up
+    to date are fetched from it before make runs and targets make builds
+    are uploaded to it after.
+
+    `path_map' is a list of (directory, name) pairs. Directories are
+    replaced with names in commands and paths that go into signatures, so
+    that signatures, and cache keys, don't depend on where the project
+    and tools are.
+    """
+
+    STALE, FRESH = 'stale', 'fresh'
+
+    # targets depending on stale ones whose other inputs were modified
+    # this recently are rebuilt, on file systems with coarse timestamps
+    # their mtime could be equal to mtimes of inputs make rebuilds
+    mtime_resolution = 1.0
+    mtime_epsilon = 1e-6
+
+    def __init__(self, cache=None, path_map=()):
+        self.cache = cache
+        # longer directories first, they could be inside shorter ones
+        self.path_map = sorted(path_map, key=lambda (dirname, _): -len(dirname))
+        self.command_map = [(re.compile(re.escape(dirname) + r'(?=[/=\s]|$)'), name)
+                            for dirname, name in self.path_map]
+        self.cacheable = set()
+        self.targets = {}
+        self.order = []
+        self.command_digests = {}
+        self.dependency_files = {}
+        self.updated = set()
+        self.rebuilt = []
+        self.affected = set()
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, target, inputs, command, headers_of=None, update=False, cacheable=True):
+        """
+        Register `target` path made of `inputs` paths by `command`. Headers
+        included by `headers_of` source are inputs too. `update` is true
+        for targets that `command` updates in place with changed inputs
+        only, such targets are removed rather than rebuilt if stale.
+        `cacheable` is false for targets that are no use on other machines.
+        """
+        if target not in self.targets:
+            self.order.append(target)
+        if command not in self.command_digests:
+            self.command_digests[command] = hashlib.sha1(self.relocate_command(command)).hexdigest()
+        self.targets[target] = (inputs, command, headers_of)
+        if update:
+            self.updated.add(target)
+        if cacheable:
+            self.cacheable.add(target)
+
+    def add_dependency_file(self, target, source, command):
+        """
+        Register `target` dependency file of `source` made by `command'.
+        """
+        self.add(target, [source], command, headers_of=source, cacheable=False)
+        self.dependency_files[target] = source
+
+    def relocate(self, path):
+        for dirname, name in self.path_map:
+            if path.startswith(dirname) and path[len(dirname):len(dirname) + 1] in ('', os.path.sep):
+                return name + path[len(dirname):]
+        return path
+
+    def relocate_command(self, command):
+        for regex, name in self.command_map:
+            command = regex.sub(name, command)
+        return command
+
+    def inputs(self, db, target):
+        inputs, _, headers_of = self.targets[target]
+        if headers_of:
+            return inputs + [h for h in db.headers(headers_of) if h not in inputs]
+        return inputs
+
+    def signature(self, db, target, inputs, stats):
+        h = hashlib.sha1(self.command_digests[self.targets[target][1]])
+        for path in inputs:
+            if path not in stats:
+                stats[path] = db.stat(path)
+            h.update('%s\0%s\n' % (self.relocate(path), db.digest(path, stats[path]) or '-'))
+        return h.hexdigest()
+
+    def prepare(self, db):
+        """
+        Set target mtimes according to their signatures. Return a dict of
+        targets by state.
+        """
+        stats = {}
+        states = {}
+        inputs = dict((target, self.inputs(db, target)) for target in self.order)
+
+        def state(target):
+            if target in states:
+                return states[target]
+            # a guard against dependency cycles
+            states[target] = self.STALE
+
+            # a target is compared with its inputs as they are now, inputs
+            # that are targets themselves are rebuilt by make if stale
+            input_states = [state(i) for i in inputs[target] if i in self.targets]
+            stat = stats[target] = db.stat(target)
+            recorded = db.signature(target)
+            signature = self.signature(db, target, inputs[target], stats)
+            if stat is not None and recorded == signature:
+                states[target] = self.FRESH
+            elif self.STALE not in input_states and self.fetch(db, target, signature):
+                stats[target] = db.stat(target)
+                states[target] = self.FRESH
+            return states[target]
+
+        by_state = {self.STALE: [], self.FRESH: []}
+        for target in self.order:
+            by_state[state(target)].append(target)
+
+        stale = set(by_state[self.STALE])
+        now = time.time()
+        mtimes = {}
+        retimed = set()
+        affected = set()
+
+        def mtime(path):
+            if path in stale:
+                return 0
+            if path not in self.targets:
+                return stats[path][0] if stats.get(path) else 0
+            if path not in mtimes:
+                mtimes[path] = 0   # a guard against dependency cycles
+                newest = max([0] + [mtime(i) for i in inputs[path]])
+                # float mtimes lose nanoseconds make compares, so a target
+                # is kept a bit newer than its inputs
+                current = stats[path][0]
+                if newest + self.mtime_epsilon / 2 <= current <= now:
+                    mtimes[path] = current
+                else:
+                    mtimes[path] = newest + self.mtime_epsilon
+                    retimed.add(path)
+                if any(i in stale or i in affected for i in inputs[path]):
+                    affected.add(path)
+            return mtimes[path]
+
+        recent = now - self.mtime_resolution
+        for target in by_state[self.FRESH][:]:
+            if mtime(target) > recent and target in affected:
+                stale.add(target)
+                by_state[self.FRESH].remove(target)
+                by_state[self.STALE].append(target)
+
+        for target in by_state[self.FRESH]:
+            if target in retimed:
+                db.set_mtime(target, mtimes[target])
+        for target in by_state[self.STALE]:
+            if stats[target] is None:
+                continue
+            if target in self.updated:
+                os.remove(target)
+            else:
+                os.utime(target, (0, 0))
+
+        db.commit()
+        self.rebuilt = by_state[self.STALE]
+        # fresh targets make rebuilds if stale inputs change
+        self.affected = affected - stale
+        return by_state
+
+    def fetch(self, db, target, signature):
+        """
+        Fetch `target` with `signature` from the cache. Return True if it
+        was found.
+        """
+        if self.cache is None or target not in self.cacheable:
+            return False
+        if not self.cache.get(self.cache.key(signature), target):
+            return False
+        db.set_signature(target, signature)
+        return True
+
+    def record(self, db):
+        """
+        Import rebuilt dependency files, record signatures of built targets
+        and upload them to the cache.
+        """
+        for target in self.rebuilt:
+            source = self.dependency_files.get(target)
+            if source:
+                db.set_headers(source, [h for h in read_deps(target) if h != source])
+
+        stats = {}
+        for target in self.order:
+            if not os.path.exists(target):
+                continue
+            signature = self.signature(db, target, self.inputs(db, target), stats)
+            if self.cache and target in self.cacheable and signature != db.signature(target):
+                self.cache.put(self.cache.key(signature), target)
+            db.set_signature(target, signature)
+        db.commit()
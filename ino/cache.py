@@ -0,0 +1,267 @@
+# -*- coding: utf-8; -*-
+
+"""
+Build cache shared over HTTP. `ino cache-server' keeps build artifacts in
+a directory and serves them with GET and PUT requests on `/<key>' where
+the key is a SHA-1 hex digest of everything the artifact is made from:
+the toolchain, the command with its flags and digests of the inputs.
+`ino build --cache URL' fetches artifacts before make and uploads the
+ones it built after. A cache can also be a local directory of the same
+layout, which is what workspace builds share by default.
+"""
+
+import os
+import re
+import sys
+import errno
+import shutil
+import socket
+import hashlib
+import urllib2
+import tempfile
+import BaseHTTPServer
+import SocketServer
+
+from ino.filters import colorize
+from ino.utils import counters
+
+
+class LimitedReader(object):
+    """
+    File object reading `length` bytes of `f`, a request body.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.length = length
+
+    def read(self, size):
+        if self.length <= 0:
+            return ''
+        data = self.f.read(min(size, self.length))
+        if not data:
+            raise IOError('Request body is truncated')
+        self.length -= len(data)
+        return data
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    key_re = re.compile(r'^/([0-9a-f]{40})$')
+
+    def artifact_path(self):
+        match = self.key_re.match(self.path)
+        if not match:
+            self.send_error(400, 'Expected /<sha1 hex digest>')
+            return None
+        key = match.group(1)
+        return os.path.join(self.server.root, key[:2], key)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        path = self.artifact_path()
+        if path is None:
+            return
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if body:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        if self.server.read_only:
+            self.send_error(403, 'The cache is read-only')
+            return
+        path = self.artifact_path()
+        if path is None:
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+
+        copy_atomically(LimitedReader(self.rfile, length), path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CacheHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, read_only=False, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.root = root
+        self.read_only = read_only
+        self.verbose = verbose
+
+
+def open_cache(location, salt='', read_only=False):
+    """
+    Return a cache served at `location` URL or kept in `location`
+    directory.
+    """
+    if re.match(r'^https?://', location):
+        return RemoteCache(location, salt, read_only)
+    return LocalCache(location, salt, read_only)
+
+
+def copy_atomically(source, path):
+    """
+    Copy `source` file object to `path` through a temporary file, so that
+    concurrent readers never see a part.
+    """
+    dirname = os.path.dirname(path) or '.'
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(source, f)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class Cache(object):
+    """
+    Build cache at `location'. Keys are salted with `salt', normally
+    digests of the toolchain. A read-only cache only fetches.
+
+    The cache is an optimization, so an error reaching it just disables
+    it for the rest of the build with a warning. A cache refusing uploads
+    is only used for reading from then on.
+    """
+
+    def __init__(self, location, salt='', read_only=False):
+        self.location = location
+        self.salt = salt
+        self.read_only = read_only
+        self.enabled = True
+
+    def key(self, signature):
+        return hashlib.sha1(self.salt + '\0' + signature).hexdigest()
+
+    def disable(self, error):
+        print >>sys.stderr, colorize('Build cache %s is disabled: %s' % (self.location, error), 'yellow')
+        self.enabled = False
+
+    def disable_writes(self, error):
+        print >>sys.stderr, colorize('Build cache %s is read-only: %s' % (self.location, error), 'yellow')
+        self.read_only = True
+
+
+class LocalCache(Cache):
+    """
+    Build cache kept in a directory, laid out as `ino cache-server' does.
+    """
+
+    def artifact_path(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def get(self, key, path):
+        if not self.enabled:
+            return False
+        try:
+            f = open(self.artifact_path(key), 'rb')
+        except IOError:
+            counters.count('cache miss')
+            return False
+        try:
+            with f:
+                copy_atomically(f, path)
+        except (IOError, OSError) as e:
+            self.disable(e)
+            return False
+        counters.count('cache hit')
+        return True
+
+    def put(self, key, path):
+        if not self.enabled or self.read_only:
+            return
+        try:
+            with open(path, 'rb') as f:
+                copy_atomically(f, self.artifact_path(key))
+        except (IOError, OSError) as e:
+            self.disable(e)
+            return
+        counters.count('cache put')
+
+
+class RemoteCache(Cache):
+    """
+    Client of `ino cache-server' at a URL.
+    """
+
+    timeout = 10
+
+    def __init__(self, url, salt='', read_only=False):
+        super(RemoteCache, self).__init__(url.rstrip('/') + '/', salt, read_only)
+
+    def get(self, key, path):
+        """
+        Fetch artifact `key` to `path`. Return True if it was found.
+        """
+        if not self.enabled:
+            return False
+        try:
+            response = urllib2.urlopen(self.location + key, timeout=self.timeout)
+        except urllib2.HTTPError:
+            # not found, or a server error that could be transient
+            counters.count('cache miss')
+            return False
+        except (urllib2.URLError, socket.error) as e:
+            self.disable(e)
+            return False
+
+        try:
+            copy_atomically(response, path)
+        except (IOError, OSError, socket.error) as e:
+            self.disable(e)
+            return False
+        finally:
+            response.close()
+        counters.count('cache hit')
+        return True
+
+    def put(self, key, path):
+        """
+        Upload `path` as artifact `key` unless the cache is read-only.
+        """
+        if not self.enabled or self.read_only:
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        request = urllib2.Request(self.location + key, data,
+                                  {'Content-Type': 'application/octet-stream'})
+        request.get_method = lambda: 'PUT'
+        try:
+            urllib2.urlopen(request, timeout=self.timeout).close()
+        except urllib2.HTTPError as e:
+            if 400 <= e.code < 500:
+                # e.g. 403 of a read-only server, reads still work
+                self.disable_writes(e)
+            counters.count('cache put failed')
+            return
+        except (urllib2.URLError, socket.error) as e:
+            self.disable(e)
+            return
+        counters.count('cache put')
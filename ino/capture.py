@@ -0,0 +1,198 @@
+# -*- coding: utf-8; -*-
+
+"""
+Recording of a serial stream to disk. Objects here are Monitor handlers.
+
+A capture is a pair of files: `.bin` with raw device data and `.ts` with
+one "offset timestamp" line per chunk read, where offset is the position
+of the chunk in `.bin` and timestamp is monotonic time it was read at.
+The first line of `.ts` maps monotonic time to wall clock time.
+"""
+
+import os
+import re
+import gzip
+import time
+
+from collections import deque
+
+from ino.utils import monotonic
+
+
+def parse_size(value):
+    """
+    Parse a byte size like "1048576", "512K", "100M" or "2G".
+    """
+    multipliers = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    value = value.strip().upper()
+    multiplier = multipliers.get(value[-1:], 1)
+    if multiplier != 1:
+        value = value[:-1]
+    return int(value) * multiplier
+
+
+class CaptureFile(object):
+    """
+    A single `.bin` and `.ts` pair. Data is buffered in memory and written
+    in large blocks.
+    """
+
+    def __init__(self, path, compress=False, buffer_size=1 << 20, flush_interval=1.0):
+        self.path = path
+        if compress:
+            self.data_path = path + '.bin.gz'
+            self.data = gzip.open(self.data_path, 'wb', compresslevel=1)
+        else:
+            self.data_path = path + '.bin'
+            self.data = open(self.data_path, 'wb')
+        self.timestamps = open(path + '.ts', 'w')
+        self.timestamps.write('# start %s %.6f\n' % (time.strftime('%Y-%m-%dT%H:%M:%S%z'), monotonic()))
+
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.chunks = []
+        self.lines = []
+        self.buffered = 0
+        self.buffered_since = None
+        self.size = 0
+        self.opened = monotonic()
+
+    def write(self, data, timestamp):
+        if self.buffered_since is None:
+            self.buffered_since = timestamp
+        self.lines.append('%d %.6f\n' % (self.size, timestamp))
+        self.chunks.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.buffered >= self.buffer_size or \
+           timestamp - self.buffered_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.data.write(''.join(self.chunks))
+            self.timestamps.write(''.join(self.lines))
+            self.data.flush()
+            self.timestamps.flush()
+        self.chunks = []
+        self.lines = []
+        self.buffered = 0
+        self.buffered_since = None
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.timestamps.close()
+
+
+class Capture(object):
+    """
+    Record everything read into `directory`, starting a new file when the
+    current one reaches `max_size` bytes or `max_age` seconds.
+    """
+
+    def __init__(self, directory, prefix='capture', max_size=None, max_age=None, compress=False):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.max_age = max_age
+        self.compress = compress
+        self.current = None
+        self.files = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def new_path(self, name=None):
+        base = os.path.join(self.directory, '%s-%s' % (name or self.prefix, time.strftime('%Y%m%d-%H%M%S')))
+        path, n = base, 1
+        while os.path.exists(path + '.ts'):
+            path = '%s-%d' % (base, n)
+            n += 1
+        return path
+
+    def open_file(self, name=None):
+        f = CaptureFile(self.new_path(name), self.compress)
+        self.files.append(f.data_path)
+        return f
+
+    def rotation_due(self, timestamp):
+        return (self.max_size and self.current.size >= self.max_size) or \
+               (self.max_age and timestamp - self.current.opened >= self.max_age)
+
+    def __call__(self, data, timestamp):
+        if self.current is not None and self.rotation_due(timestamp):
+            self.current.close()
+            self.current = None
+        if self.current is None:
+            self.current = self.open_file()
+        self.current.write(data, timestamp)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+class TriggeredCapture(Capture):
+    """
+    Keep the last `window` seconds of the stream, but at most `ring_size`
+    bytes, in a ring buffer and record only what is around matches of
+    `pattern`: `window` seconds before a match and `window` seconds after
+    it. A match while recording extends the recording, which is rotated
+    to new files the same way Capture does.
+    """
+
+    # matches split between chunks are found if they are shorter than this
+    overlap = 256
+
+    def __init__(self, directory, pattern, window=10.0, ring_size=16 << 20, **kwargs):
+        super(TriggeredCapture, self).__init__(directory, **kwargs)
+        self.pattern = re.compile(pattern)
+        self.window = window
+        self.ring_size = ring_size
+        self.ring = deque()
+        self.ring_bytes = 0
+        self.tail = ''
+        self.recording_until = None
+        self.triggers = 0
+
+    def matches(self, data):
+        # a match that is entirely in the tail has been seen already
+        tail_size = len(self.tail)
+        text = self.tail + data
+        self.tail = text[-self.overlap:]
+        return any(m.end() > tail_size for m in self.pattern.finditer(text))
+
+    def __call__(self, data, timestamp):
+        triggered = self.matches(data)
+
+        if self.recording_until is not None:
+            if triggered:
+                self.recording_until = timestamp + self.window
+            if self.rotation_due(timestamp):
+                self.current.close()
+                self.current = self.open_file('%s-trigger' % self.prefix)
+            self.current.write(data, timestamp)
+            if timestamp >= self.recording_until:
+                self.close()
+            return
+
+        self.ring.append((timestamp, data))
+        self.ring_bytes += len(data)
+        # the last chunk is kept whatever its size, it could be the trigger
+        while len(self.ring) > 1 and (self.ring[0][0] < timestamp - self.window or
+                                      self.ring_bytes > self.ring_size):
+            self.ring_bytes -= len(self.ring.popleft()[1])
+
+        if triggered:
+            self.triggers += 1
+            self.current = self.open_file('%s-trigger' % self.prefix)
+            for chunk_timestamp, chunk in self.ring:
+                self.current.write(chunk, chunk_timestamp)
+            self.ring.clear()
+            self.ring_bytes = 0
+            self.recording_until = timestamp + self.window
+
+    def close(self):
+        super(TriggeredCapture, self).close()
+        self.recording_until = None
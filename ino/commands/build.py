@@ -1,10 +1,13 @@
 # -*- coding: utf-8; -*-
 
-import re
 import os.path
+import sys
+import hashlib
 import inspect
-import subprocess
 import platform
+import traceback
+import subprocess
+import multiprocessing
 import jinja2
 import shlex
 
@@ -12,13 +15,41 @@ from jinja2.runtime import StrictUndefined
 
 import ino.filters
 
+from ino.builddb import BuildDB, Manifest
+from ino.cache import open_cache
 from ino.commands.base import Command
+from ino.commands.preproc import Preprocess
 from ino.environment import Version
-from ino.filters import colorize
-from ino.utils import SpaceList, list_subdirs
+from ino.filters import colorize, glob, glob_cache, filemap
+from ino.hexfile import read_elf, read_hex, write_hex, HexError
+from ino.utils import SpaceList, list_subdirs, call, monotonic, format_available_options, counters
 from ino.exc import Abort
 
 
+def find_projects(root):
+    """
+    Return project directories under `root', i.e. ones with a `src'
+    subdirectory. Projects and hidden directories are not looked into.
+    """
+    projects = []
+    for dirpath, dirnames, _ in os.walk(root):
+        if 'src' in dirnames:
+            projects.append(dirpath)
+            dirnames[:] = []
+        else:
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+    return projects
+
+
+# (build, args) of a workspace build, set before worker processes fork
+_workspace_build = None
+
+
+def _build_workspace_project(project):
+    build, args = _workspace_build
+    return build.build_project(args, project)
+
+
 class Build(Command):
     """
     Build a project in the current directory and produce a ready-to-upload
@@ -40,6 +71,15 @@ class Build(Command):
     name = 'build'
     help_line = "Build firmware from the current directory project"
 
+    # absolute, so that templates are found after a chdir
+    templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'make')
+
+    # recipes echo `<marker> start <target> <message>' and `<marker> done
+    # <target>' lines, so that ino times every job
+    marker = '::ino::'
+
+    build_db = None
+
     default_make = 'make'
     default_cc = 'avr-gcc'
     default_cxx = 'avr-g++'
@@ -82,9 +122,10 @@ class Build(Command):
 
         parser.add_argument('--objcopy', metavar='OBJCOPY',
                             default='',
-                            help='Specifies the OBJCOPY to use. If a full path '
-                            'is not given, searches in Arduino directories '
-                            'before PATH. Default: "%(default)s".')
+                            help='Specifies the OBJCOPY to use if the firmware '
+                            'can\'t be converted to .hex by ino itself. If a '
+                            'full path is not given, searches in Arduino '
+                            'directories before PATH. Default: "%(default)s".')
 
         parser.add_argument('-f', '--cppflags', metavar='FLAGS',
                             default=self.default_cppflags,
@@ -114,13 +155,65 @@ class Build(Command):
                             'being invoked directly (i.e. the `-Wl,\' prefix '
                             'should be omitted). Default: "%(default)s".')
 
+        parser.add_argument('--archives', metavar='MODE', default='update',
+                            choices=['update', 'thin', 'none'],
+                            help='How library objects get linked: "update" '
+                            'keeps an archive per library replacing only '
+                            'changed members, "thin" keeps thin archives '
+                            'referring to objects instead of copying them, '
+                            '"none" links library objects directly, which '
+                            'may pull in objects an archive wouldn\'t. '
+                            'Default: "%(default)s".')
+
+        parser.add_argument('--deterministic-archives', default=False, action='store_true',
+                            help='Create archives without timestamps, so that '
+                            'an archive with unchanged members keeps its bytes '
+                            'and doesn\'t cause a relink. Needs binutils 2.20 '
+                            'or later')
+
+        parser.add_argument('--reproducible', default=False, action='store_true',
+                            help='Build the same bytes from the same sources '
+                            'wherever they are checked out: map the project '
+                            'and Arduino directories in debug info (and '
+                            '__FILE__ with GCC 8 or later), create '
+                            'deterministic archives and leave absolute paths '
+                            'out of build cache keys')
+
+        parser.add_argument('--cache', metavar='URL', default='',
+                            help='Build cache served by `ino cache-server\' or '
+                            'a directory to fetch objects, archives and firmware '
+                            'from instead of building them and to upload built '
+                            'ones to')
+
+        parser.add_argument('--cache-read-only', default=False, action='store_true',
+                            help='Only fetch from the build cache, never upload')
+
         parser.add_argument('--menu', metavar='OPTIONS', default='',
                             help='"key:val,key:val" formatted string of '
                             'build menu items and their desired values')
 
+        parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                            help='Number of jobs to run simultaneously while '
+                            'preprocessing sketches and running make. '
+                            'Default: %(default)s.')
+
         parser.add_argument('-v', '--verbose', default=False, action='store_true',
                             help='Verbose make output')
 
+        parser.add_argument('--workspace', metavar='DIR', default='',
+                            help='Build all projects found in DIR at once '
+                            'instead of the current directory project. Tools, '
+                            'the board database and templates are set up once, '
+                            'the Arduino core and libraries are built once and '
+                            'shared through the build cache, which is '
+                            'DIR/.build/cache unless --cache is given. Output of '
+                            'each build goes to .build/build.log of its project.')
+
+        parser.add_argument('--projects', metavar='N', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='Number of workspace projects to build '
+                            'simultaneously. Default: %(default)s.')
+
     # Merges one dictionary into another, overwriting non-dict entries and
     # recursively merging dictionaries mapped to the same key.
     def _mergeDicts(self,dest,src):
@@ -324,10 +417,72 @@ class Build(Command):
             'deps': '%s.d',
         }
 
+    def setup_archives(self, args):
+        self.e['archives'] = args.archives
+        self.e['arflags'] = 'rcs'
+        if args.archives == 'thin':
+            self.e['arflags'] += 'T'
+        if args.deterministic_archives or args.reproducible:
+            self.e['arflags'] += 'D'
+
+    def prefix_map_option(self):
+        """
+        Return the option of the compiler that maps paths it embeds.
+        -ffile-prefix-map covers __FILE__ too but needs GCC 8, older ones
+        only map debug info paths.
+        """
+        options = self.e.get('prefix_map_options', {})
+        if self.e.cc not in options:
+            with open(os.devnull, 'w') as devnull:
+                ret = call([self.e.cc, '-ffile-prefix-map=/=/', '-E', '-x', 'c', os.devnull],
+                           stdout=devnull, stderr=devnull)
+            options[self.e.cc] = '-ffile-prefix-map' if ret == 0 else '-fdebug-prefix-map'
+            self.e['prefix_map_options'] = options
+        return options[self.e.cc]
+
+    def arduino_dist_dir(self):
+        dist_dir = self.e.get('arduino_dist_dir')
+        places = [dist_dir] if dist_dir else self.e.arduino_dist_dir_guesses
+        for place in places:
+            place = os.path.abspath(place)
+            if self.e.arduino_core_dir.startswith(place + os.path.sep):
+                return place
+        return None
+
+    def setup_reproducible(self, args):
+        """
+        Map the project and Arduino directories to relative names in what
+        the compiler embeds and in target signatures, so that builds in
+        different checkouts produce the same bytes and share the cache.
+        """
+        self.path_map = []
+        if not args.reproducible:
+            return
+        self.path_map.append((os.getcwd(), '.'))
+        dist_dir = self.arduino_dist_dir()
+        if dist_dir:
+            self.path_map.append((dist_dir, 'arduino'))
+        option = self.prefix_map_option()
+        for dirname, name in self.path_map:
+            self.e['cppflags'].append('%s=%s=%s' % (option, dirname, name))
+
+    def setup_cache(self, args):
+        """
+        Connect to the build cache if any. Keys of its artifacts are salted
+        with digests of the tools, so that a toolchain update invalidates
+        them.
+        """
+        self.cache = None
+        if not args.cache:
+            return
+        h = hashlib.sha1()
+        for tool in (self.e.cc, self.e.cxx, self.e.ar):
+            h.update('%s\0%s\n' % (os.path.basename(tool), self.build_db.digest(tool)))
+        self.cache = open_cache(args.cache, salt=h.hexdigest(), read_only=args.cache_read_only)
+
     def create_jinja(self, verbose):
-        templates_dir = os.path.join(os.path.dirname(__file__), '..', 'make')
         self.jenv = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(templates_dir),
+            loader=jinja2.FileSystemLoader(self.templates_dir),
             undefined=StrictUndefined, # bark on Undefined render
             extensions=['jinja2.ext.do'])
 
@@ -340,21 +495,177 @@ class Build(Command):
         self.jenv.globals['v'] = '' if verbose else '@'
         self.jenv.globals['slash'] = os.path.sep
         self.jenv.globals['SpaceList'] = SpaceList
+        self.jenv.globals['marker'] = self.marker
+        self.jenv.globals['longest_first'] = self.longest_first
+
+    def longest_first(self, targets):
+        """
+        Sort `targets` by how long they took to build last time, longest
+        first. Targets never built keep their order after the rest.
+        """
+        if self.build_db is None:
+            return targets
+        return SpaceList(sorted(targets, key=lambda t: -self.build_db.timing(t, 0)))
 
     def render_template(self, source, target, **ctx):
         template = self.jenv.get_template(source)
-        contents = template.render(**ctx)
         out_path = os.path.join(self.e.build_dir, target)
         with open(out_path, 'wt') as f:
-            f.write(contents)
+            f.writelines(template.generate(**ctx))
 
         return out_path
 
-    def make(self, makefile, **kwargs):
-        makefile = self.render_template(makefile + '.jinja', makefile, **kwargs)
-        ret = subprocess.call([self.e.make, '-f', makefile, 'all'])
+    def make(self, makefile, message=None, **kwargs):
+        """
+        Render `makefile` template and run make on it. Targets registered in
+        the manifest by the template are rebuilt only if contents of their
+        inputs or their commands change, see ino.builddb. `message` is
+        printed if anything is going to be rebuilt. Return the manifest.
+        """
+        manifest = Manifest(self.cache, self.path_map)
+        makefile = self.render_template(makefile + '.jinja', makefile, manifest=manifest, **kwargs)
+        stale = []
+        if manifest:
+            stale = manifest.prepare(self.build_db)[Manifest.STALE]
+            if stale and message:
+                print colorize(message, 'cyan')
+        try:
+            ret = self.run_make(makefile, stale + sorted(manifest.affected))
+        finally:
+            self.build_db.commit()
         if ret != 0:
             raise Abort("Make failed with code %s" % ret)
+        if manifest:
+            manifest.record(self.build_db)
+        return manifest
+
+    def run_make(self, makefile, stale):
+        """
+        Run make on `makefile` recording how long every job takes. Jobs
+        print an estimate of the time left based on how long `stale`
+        targets, ones expected to be rebuilt, took last time. Return make
+        exit code.
+        """
+        expected = dict((t, self.build_db.timing(t)) for t in stale
+                        if self.build_db.timing(t) is not None)
+        started = {}
+        args = [self.e.make, '-f', makefile, '-j', str(self.jobs), 'all']
+        with counters.timed('subprocess ' + os.path.basename(args[0])):
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+            for line in iter(proc.stdout.readline, ''):
+                if not line.startswith(self.marker + ' '):
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+                    continue
+
+                _, event, target, message = (line.rstrip('\n').split(' ', 3) + [''])[:4]
+                now = monotonic()
+                if event == 'start':
+                    started[target] = now
+                    left = [max(seconds - (now - started.get(t, now)), 0)
+                            for t, seconds in expected.iteritems()]
+                    # jobs run in parallel, but no faster than the longest
+                    eta = max([sum(left) / self.jobs] + left)
+                    if eta >= 1:
+                        message += colorize('  ETA %d s' % (eta + 0.5), 'cyan')
+                    print message
+                elif event == 'done' and target in started:
+                    self.build_db.set_timing(target, now - started.pop(target))
+                    expected.pop(target, None)
+            return proc.wait()
+
+    def preprocess_sketches(self):
+        """
+        Turn *.ino and *.pde sketches into *.cpp sources in-process, all in
+        one pass. Only sketches whose contents changed since their output
+        was made are processed, as told by the build database, and only
+        outputs whose contents changed are rewritten.
+        """
+        src_build_dir = os.path.join(self.e.build_dir, os.path.basename(self.e.src_dir))
+        sketches = filemap(glob(self.e.src_dir, '*.pde', '*.ino'),
+                           src_build_dir, self.e.names['cpp'])
+
+        preprocess = Preprocess(self.e)
+        header = preprocess.header()
+        stale = []
+        signatures = {}
+        for source, target in sketches.iterpaths():
+            # the output is made of the sketch, its path and the header
+            signature = '%s\0%s\0%s' % (header, source, self.build_db.digest(source))
+            if os.path.exists(target) and self.build_db.signature(target) == signature:
+                continue
+            stale.append((source, target))
+            signatures[target] = signature
+
+        if stale:
+            written = preprocess.process_many(stale, jobs=self.jobs)
+            for source, target in stale:
+                if target in written:
+                    print colorize(source, 'yellow')
+            for target, signature in signatures.iteritems():
+                self.build_db.set_signature(target, signature)
+            self.build_db.commit()
+
+    def make_hex(self, board):
+        """
+        Convert firmware.elf to Intel HEX in-process, the same way as
+        `objcopy -O ihex -R .eeprom' does. objcopy is still used for ELF
+        files that can't be read. Conversion is skipped if the ELF file
+        contents didn't change since the last one.
+
+        Firmware size is checked against upload.maximum_size of the board
+        whichever way the .hex is made.
+        """
+        elf = os.path.join(self.e.build_dir, 'firmware.elf')
+        hex_path = self.e.hex_path
+        elf_digest = self.build_db.digest(elf)
+        if os.path.exists(hex_path) and self.build_db.signature(hex_path) == elf_digest:
+            return
+
+        # the .hex is recorded only once its size is checked, so that
+        # an oversized firmware fails the next build as well
+        self.build_db.set_signature(hex_path, None)
+        try:
+            key = self.cache and self.cache.key('hex\0' + elf_digest)
+            if key and self.cache.get(key, hex_path):
+                image = read_hex(hex_path)
+            else:
+                image = self.convert_elf(elf, hex_path)
+                if key:
+                    self.cache.put(key, hex_path)
+
+            self.check_size(board, image)
+            self.build_db.set_signature(hex_path, elf_digest)
+        finally:
+            self.build_db.commit()
+
+    def convert_elf(self, elf, hex_path):
+        """
+        Write `elf` as Intel HEX to `hex_path` and return its Image.
+        """
+        print colorize('Converting to ' + self.e.hex_filename, 'green')
+        try:
+            image = read_elf(elf, exclude=['.eeprom'])
+        except HexError as e:
+            print colorize('%s, falling back to objcopy' % e, 'yellow')
+            ret = call([self.e.objcopy, '-O', 'ihex', '-R', '.eeprom', elf, hex_path])
+            if ret != 0:
+                raise Abort("objcopy failed with code %s" % ret)
+            return read_hex(hex_path)
+
+        write_hex(image, hex_path)
+        return image
+
+    def check_size(self, board, image):
+        maximum_size = board.get('upload', {}).get('maximum_size')
+        if not maximum_size:
+            return
+        size, maximum_size = len(image), int(maximum_size)
+        color = 'red' if size > maximum_size else 'green'
+        print colorize('Firmware size: %d of %d bytes (%d%%)' % 
+                       (size, maximum_size, 100 * size / maximum_size), color)
+        if size > maximum_size:
+            raise Abort("Firmware is too big for %s" % board['name'])
 
     def recursive_inc_lib_flags(self, dashcmd, libdirs):
         flags = SpaceList()
@@ -364,27 +675,25 @@ class Build(Command):
         return flags
 
     def _scan_dependencies(self, dir, lib_dirs, inc_flags):
-        output_filepath = os.path.join(self.e.build_dir, os.path.basename(dir), 'dependencies.d')
-        self.make('Makefile.deps', inc_flags=inc_flags, src_dir=dir, output_filepath=output_filepath)
-        self.e['deps'].append(output_filepath)
-
-        # search for dependencies on libraries
-        # for this scan dependency file generated by make
-        # with regexes to find entries that start with
-        # libraries dirname
-        regexes = dict((lib, re.compile(r'\s' + lib + re.escape(os.path.sep))) for lib in lib_dirs)
+        manifest = self.make('Makefile.deps', inc_flags=inc_flags, src_dir=dir,
+                             message='Scanning dependencies of ' + os.path.basename(dir))
+
+        # search for dependencies on libraries: headers included by the
+        # sources, as kept in the build database, that are located in
+        # library dirs
+        prefixes = dict((lib, lib + os.path.sep) for lib in lib_dirs if lib != dir)
         used_libs = set()
-        with open(output_filepath) as f:
-            for line in f:
-                for lib, regex in regexes.iteritems():
-                    if regex.search(line) and lib != dir:
+        for source in manifest.dependency_files.itervalues():
+            for header in self.build_db.headers(source):
+                for lib, prefix in prefixes.iteritems():
+                    if header.startswith(prefix):
                         used_libs.add(lib)
         return used_libs
 
     def scan_dependencies(self):
-        self.e['deps'] = SpaceList()
-
-        lib_dirs = [self.e.arduino_core_dir] + list_subdirs(self.e.lib_dir) + list_subdirs(self.e.arduino_libraries_dir)
+        lib_dirs = [self.e.arduino_core_dir] + list_subdirs(self.e.arduino_libraries_dir)
+        if os.path.isdir(self.e.lib_dir):
+            lib_dirs[1:1] = list_subdirs(self.e.lib_dir)
         inc_flags = self.recursive_inc_lib_flags(self.e.incflag, lib_dirs)
 
         # If lib A depends on lib B it have to appear before B in final
@@ -415,12 +724,116 @@ class Build(Command):
                 scanned_libs.add(lib)
 
         self.e['used_libs'] = used_libs
+        # the core doesn't include libraries, so it is compiled without
+        # their flags the same way for all projects and can be shared
+        self.e['core_cppflags'] = self.e['cppflags'] + \
+            self.recursive_inc_lib_flags(self.e.incflag, [self.e.arduino_core_dir])
         self.e['cppflags'].extend(self.recursive_inc_lib_flags(self.e.incflag, used_libs))
 
+    def build(self, args):
+        """
+        Build the current directory project with tools and flags set up.
+        """
+        self.setup_reproducible(args)
+        self.build_db = BuildDB(os.path.join(self.e.build_dir, 'build.db'))
+        try:
+            self.preprocess_sketches()
+            self.setup_cache(args)
+            with glob_cache():
+                self.scan_dependencies()
+                self.make('Makefile')
+            self.make_hex(self.e.board_model(args.board_model))
+        finally:
+            self.build_db.close()
+
+    def build_project(self, args, project):
+        """
+        Build workspace `project` in a worker process, writing output to its
+        build log. Return (project, error or None, seconds).
+        """
+        started = monotonic()
+        os.chdir(project)
+        if not os.path.isdir(self.e.build_dir):
+            os.makedirs(self.e.build_dir)
+
+        error = None
+        with open(os.path.join(self.e.output_dir, 'build.log'), 'w') as log:
+            sys.stdout.flush()
+            os.dup2(log.fileno(), sys.stdout.fileno())
+            os.dup2(log.fileno(), sys.stderr.fileno())
+            try:
+                self.build(args)
+            except Abort as e:
+                error = str(e)
+            except Exception as e:
+                traceback.print_exc()
+                error = '%s: %s' % (type(e).__name__, e)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+        self.e.dump()
+        return project, error, monotonic() - started
+
+    def run_workspace(self, args):
+        root = os.path.abspath(args.workspace)
+        projects = find_projects(root)
+        if not projects:
+            raise Abort('No projects found in %s' % root)
+        if not args.cache:
+            args.cache = os.path.join(root, self.e.output_dir, 'cache')
+
+        # compiled and probed once here rather than in every worker
+        for template in ('Makefile.jinja', 'Makefile.deps.jinja'):
+            self.jenv.get_template(template)
+        if args.reproducible:
+            self.prefix_map_option()
+
+        global _workspace_build
+        _workspace_build = (self, args)
+
+        print 'Building %d projects in %s' % (len(projects), root)
+        started = monotonic()
+        # every project gets a fresh copy of the shared state. Projects of
+        # a workspace are built for the same board, so their core objects
+        # and core archive are the same cache entries. The first project
+        # is built alone to put them to the cache, the rest fetch them
+        # instead of compiling the core in every worker at the same time
+        pool = multiprocessing.Pool(max(args.projects, 1), maxtasksperchild=1)
+        forever = 365 * 24 * 3600
+        try:
+            results = [pool.apply_async(_build_workspace_project, (projects[0],)).get(forever)]
+            results += pool.map_async(_build_workspace_project, projects[1:], chunksize=1).get(forever)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        items = []
+        for project, error, seconds in results:
+            status = colorize('failed', 'red') if error else colorize('ok    ', 'green')
+            items.append((os.path.relpath(project, root),
+                          '%s %8.1f s  %s' % (status, seconds, error or '')))
+        print format_available_options(items, head_width=max(len(name) for name, _ in items))
+
+        failed = [project for project, error, _ in results if error]
+        print 'Built %d projects in %.1f s' % (len(projects), monotonic() - started)
+        if failed:
+            raise Abort('%d of %d projects failed, see .build/build.log of each' %
+                        (len(failed), len(projects)))
+
     def run(self, args):
+        self.jobs = max(int(args.jobs), 1)
+        if args.workspace and self.e.get('arduino_dist_dir'):
+            # workers change directories
+            self.e['arduino_dist_dir'] = os.path.abspath(self.e['arduino_dist_dir'])
         self.discover(args)
         self.setup_flags(args)
+        self.setup_archives(args)
         self.create_jinja(verbose=args.verbose)
-        self.make('Makefile.sketch')
-        self.scan_dependencies()
-        self.make('Makefile')
+        if args.workspace:
+            self.run_workspace(args)
+        else:
+            self.build(args)
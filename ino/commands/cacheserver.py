@@ -0,0 +1,52 @@
+# -*- coding: utf-8; -*-
+
+import os.path
+
+from ino.cache import CacheHTTPServer
+from ino.commands.base import Command
+
+
+class CacheServer(Command):
+    """
+    Serve a build cache over HTTP, so that builds on many machines share
+    compiled objects, library archives and firmware.
+
+    Artifacts are kept in a directory under keys derived from the
+    toolchain, the flags and the sources they were built from. Point
+    builds to the server with `ino build --cache http://HOST:PORT/'.
+    """
+
+    name = 'cache-server'
+    help_line = "Serve a build cache shared by builds over HTTP"
+
+    def setup_arg_parser(self, parser):
+        super(CacheServer, self).setup_arg_parser(parser)
+        parser.add_argument('--bind', metavar='ADDRESS', default='127.0.0.1',
+                            help='Address to listen on. Default: "%(default)s".')
+
+        parser.add_argument('--port', metavar='PORT', type=int, default=8417,
+                            help='Port to listen on. Default: %(default)s.')
+
+        parser.add_argument('--dir', metavar='DIR', default='~/.ino/cache',
+                            help='Directory to keep artifacts in. '
+                            'Default: "%(default)s".')
+
+        parser.add_argument('--read-only', default=False, action='store_true',
+                            help='Refuse uploads, serve what is in the '
+                            'directory already')
+
+        parser.add_argument('-v', '--verbose', default=False, action='store_true',
+                            help='Log requests')
+
+    def run(self, args):
+        root = os.path.abspath(os.path.expanduser(args.dir))
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        server = CacheHTTPServer((args.bind, args.port), root,
+                                 read_only=args.read_only, verbose=args.verbose)
+        host, port = server.server_address
+        print 'Serving build cache in %s at http://%s:%d/' % (root, host, port)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
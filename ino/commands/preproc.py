@@ -2,9 +2,13 @@
 
 import sys
 import re
+import hashlib
+
+from multiprocessing import Pool
 
 from ino.commands.base import Command
 from ino.exc import Abort
+from ino.utils import write_if_changed
 
 
 class Preprocess(Command):
@@ -16,6 +20,12 @@ class Preprocess(Command):
 
         * Either #include <Arduino.h> or <WProgram.h> is prepended
         * Function prototypes are added at the beginning of file
+
+    Several sketches could be processed at once. In that case pass an
+    -o option for each of them, outputs are matched to sketches in order.
+
+    An output file is left untouched if its contents would not change, so
+    that its modification time is preserved and nothing is recompiled.
     """
 
     name = 'preproc'
@@ -24,31 +34,91 @@ class Preprocess(Command):
     def setup_arg_parser(self, parser):
         super(Preprocess, self).setup_arg_parser(parser)
         self.e.add_arduino_dist_arg(parser)
-        parser.add_argument('sketch', help='Input sketch file name')
-        parser.add_argument('-o', '--output', default='-', help='Output source file name (default: use stdout)')
+        parser.add_argument('sketch', nargs='+', help='Input sketch file name(s)')
+        parser.add_argument('-o', '--output', action='append', default=[],
+                            help='Output source file name (default: use stdout).\n'
+                            'Could be given several times, once per sketch')
 
     def run(self, args):
-        if args.output == '-':
-            out = sys.stdout
-        else:
-            out = open(args.output, 'wt')
+        outputs = args.output or ['-'] * len(args.sketch)
+        if len(outputs) != len(args.sketch):
+            raise Abort("%d sketches are given, but %d outputs" % 
+                        (len(args.sketch), len(outputs)))
 
-        sketch = open(args.sketch, 'rt').read()
-        prototypes = self.prototypes(sketch)
-        lines = sketch.split('\n')
-        includes, lines = self.extract_includes(lines)
+        self.process_many(zip(args.sketch, outputs))
 
-        header = 'Arduino.h' if self.e.arduino_lib_version.major else 'WProgram.h'
-        out.write('#include <%s>\n' % header)
+    def header(self):
+        return 'Arduino.h' if self.e.arduino_lib_version.major else 'WProgram.h'
 
-        out.write('\n'.join(includes))
-        out.write('\n')
+    def process_many(self, pairs, jobs=1):
+        """
+        Preprocess every (sketch, output) pair from `pairs`. Pairs are
+        processed in `jobs` worker processes if there are more than one.
 
-        out.write('\n'.join(prototypes))
-        out.write('\n')
+        Prototypes extracted from a sketch are cached in the environment by
+        the sketch contents hash. Return a list of outputs actually written.
+        """
+        header = self.header()
+        cache = self.e.get('prototypes_cache', {})
+
+        tasks = []
+        digests = []
+        for sketch_path, output in pairs:
+            with open(sketch_path, 'rt') as f:
+                sketch = f.read()
+            digest = hashlib.sha1(sketch).hexdigest()
+            tasks.append((sketch_path, output, header, sketch, cache.get(digest)))
+            digests.append(digest)
+
+        if jobs > 1 and len(tasks) > 1:
+            pool = Pool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(_process_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_process_task, tasks)
+
+        # keep entries for the sketches just seen only so that the
+        # cache doesn't grow forever
+        new_cache = {}
+        written = []
+        for (_, output), digest, (prototypes, changed) in zip(pairs, digests, results):
+            new_cache[digest] = prototypes
+            if changed:
+                written.append(output)
+        self.e['prototypes_cache'] = new_cache
+        return written
+
+    def process(self, sketch_path, output, header, sketch, prototypes=None):
+        """
+        Preprocess `sketch` source and write the result to `output`. Use
+        `prototypes` if they are already known. Return a tuple of
+        prototypes and a flag telling whether `output` was written.
+        """
+        if prototypes is None:
+            prototypes = self.prototypes(sketch)
+        contents = self.render(sketch, sketch_path, header, prototypes)
+        if output == '-':
+            sys.stdout.write(contents)
+            return prototypes, True
+
+        return prototypes, write_if_changed(output, contents)
+
+    def render(self, sketch, sketch_path, header, prototypes):
+        lines = sketch.split('\n')
+        includes, lines = self.extract_includes(lines)
 
-        out.write('#line 1 "%s"\n' % args.sketch)
-        out.write('\n'.join(lines))
+        return ''.join([
+            '#include <%s>\n' % header,
+            '\n'.join(includes),
+            '\n',
+            '\n'.join(prototypes),
+            '\n',
+            '#line 1 "%s"\n' % sketch_path,
+            '\n'.join(lines),
+        ])
 
     def prototypes(self, src):
         src = self.collapse_braces(self.strip(src))
@@ -111,3 +181,8 @@ class Preprocess(Command):
 
         regex = re.compile(p, re.MULTILINE)
         return regex.sub(' ', src)
+
+
+def _process_task(task):
+    # top-level function so that it could be pickled by multiprocessing
+    return Preprocess(None).process(*task)
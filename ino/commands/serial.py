@@ -1,16 +1,42 @@
 # -*- coding: utf-8; -*-
 
-import subprocess
+import os.path
+import sys
+import signal
+import struct
 
+from ino.capture import Capture, TriggeredCapture, parse_size
 from ino.commands.base import Command
+from ino.decoders import Decoding, decoders, make_decoder, make_writer
+from ino.exc import Abort
+from ino.monitor import Monitor
+from ino.utils import call
 
 
 class Serial(Command):
     """
     Open a serial monitor to communicate with the device.
 
-    At the moment `picocom' is used as a program started by this command.
-    Use Ctrl+A Ctrl+X to exit.
+    Keys pressed are sent to the device. Use Ctrl+A Ctrl+X to exit.
+    If standard input is not a terminal it is sent to the device as is,
+    so the monitor could be run headless.
+
+    Several ports could be monitored at once, each with its own baud rate
+    given as PORT@RATE. Their output is merged line by line with port name
+    prefixes and keys are sent to every port.
+
+    With --capture the stream is recorded to a directory as raw `.bin`
+    files along with `.ts` files of monotonic timestamps of every chunk.
+    Files of several ports are named after the ports.
+    With --trigger only WINDOW seconds around matches of the pattern are
+    recorded.
+
+    With --decode the stream is parsed into records which are stored to a
+    .csv or .npy file given with --records. Text formats are lines of comma
+    separated numbers (csv) or key=value pairs (kv). Binary formats are
+    frames with a 16-bit little endian length prefix (length) or COBS
+    encoded frames delimited with zero bytes (cobs), their payload is
+    described with --record-format as a Python struct format, e.g. '<Hhf'.
     """
 
     name = 'serial'
@@ -18,22 +44,146 @@ class Serial(Command):
 
     def setup_arg_parser(self, parser):
         super(Serial, self).setup_arg_parser(parser)
-        parser.add_argument('-p', '--serial-port', metavar='PORT',
-                            help='Serial port to communicate with\nTry to guess if not specified')
-        parser.add_argument('-b', '--baud-rate', metavar='RATE', type=int, default=9600, 
+        parser.add_argument('-p', '--serial-port', metavar='PORT', nargs='+',
+                            help='Serial port(s) or USB serial number(s) of boards to communicate with,\n'
+                            'optionally followed by @RATE\nTry to guess if not specified')
+        parser.add_argument('-m', '--board-model', metavar='MODEL',
+                            help='Prefer boards of this model when guessing serial port')
+        parser.add_argument('-b', '--baud-rate', metavar='RATE', type=int, default=9600,
                             help='Communication baud rate, should match value set in Serial.begin() on Arduino')
+        parser.add_argument('--reconnect', default=False, action='store_true',
+                            help='Wait for ports that go away to come back')
+        parser.add_argument('-q', '--quiet', default=False, action='store_true',
+                            help="Don't print the stream, useful with --capture")
+        parser.add_argument('--duration', metavar='SECONDS', type=float,
+                            help='Exit after this many seconds')
+        parser.add_argument('--capture', metavar='DIR',
+                            help='Record the stream to files in DIR')
+        parser.add_argument('--rotate-size', metavar='SIZE', type=parse_size,
+                            help='Start a new capture file after SIZE bytes, e.g. 100M')
+        parser.add_argument('--rotate-time', metavar='SECONDS', type=float,
+                            help='Start a new capture file after this many seconds')
+        parser.add_argument('--compress', default=False, action='store_true',
+                            help='Compress capture files with gzip')
+        parser.add_argument('--trigger', metavar='REGEX',
+                            help='Record only around matches of REGEX')
+        parser.add_argument('--window', metavar='SECONDS', type=float, default=10.0,
+                            help='Seconds to record before and after a trigger match\n'
+                            '(default: %(default)s)')
+        parser.add_argument('--decode', metavar='FORMAT', choices=sorted(decoders),
+                            help='Decode the stream into records: %s' % ', '.join(sorted(decoders)))
+        parser.add_argument('--records', metavar='FILE',
+                            help='File to store decoded records to, .csv or .npy')
+        parser.add_argument('--record-format', metavar='FMT',
+                            help='struct format of binary records, e.g. <Hhf')
+        parser.add_argument('--fields', metavar='NAMES',
+                            help='Comma separated names of record fields')
+        parser.add_argument('--picocom', default=False, action='store_true',
+                            help='Run picocom instead of the built-in monitor')
         parser.add_argument('remainder', nargs='*', metavar='ARGS',
                             help='Extra picocom args that are passed as is')
 
-        parser.usage = "%(prog)s [-h] [-p PORT] [-b RATE] [-- ARGS]"
+        parser.usage = "%(prog)s [-h] [-p PORT[@RATE] ...] [-m MODEL] [-b RATE] [--reconnect]\n" \
+                       "       [-q] [--duration SECONDS]\n" \
+                       "       [--capture DIR [--rotate-size SIZE] [--rotate-time SECONDS] [--compress]\n" \
+                       "       [--trigger REGEX [--window SECONDS]]]\n" \
+                       "       [--decode FORMAT --records FILE [--record-format FMT] [--fields NAMES]]\n" \
+                       "       [--picocom [-- ARGS]]"
 
     def run(self, args):
-        serial_monitor = self.e.find_tool('serial', ['picocom'], human_name='Serial monitor (picocom)')
-        serial_port = args.serial_port or self.e.guess_serial_port()
+        ports = self.serial_ports(args)
+
+        if args.picocom:
+            if len(ports) > 1:
+                raise Abort("picocom can't monitor several ports")
+            self.run_picocom(ports[0][0], ports[0][1], args)
+            return
+
+        # before any port is opened or file is created
+        self.check_decoding(args)
+
+        output = None if args.quiet else sys.stdout
+        monitor = Monitor(input=sys.stdin, output=output, reconnect=args.reconnect)
+        handlers = []
+        try:
+            for port, baud_rate in ports:
+                name = os.path.basename(port) if len(ports) > 1 else None
+                connection = monitor.add(port, baud_rate, name and '[%s] ' % name)
+                for handler in (self.capture(args, name or 'capture'), self.decoding(args, name)):
+                    if handler:
+                        connection.handlers.append(handler)
+                        handlers.append(handler)
+
+            signal.signal(signal.SIGTERM, lambda signum, frame: monitor.stop())
+            monitor.run(args.duration)
+        finally:
+            for handler in handlers:
+                handler.close()
+
+        if monitor.disconnected:
+            raise Abort("%s disconnected" % ', '.join(monitor.disconnected))
 
-        subprocess.call([
+    def serial_ports(self, args):
+        """
+        Return a list of (port, baud rate) to monitor.
+        """
+        if not args.serial_port:
+            board = self.e.board_model(args.board_model) if args.board_model else None
+            return [(self.e.guess_serial_port(board), args.baud_rate)]
+
+        # a value from config file is a plain string
+        specs = args.serial_port
+        if isinstance(specs, basestring):
+            specs = specs.split()
+
+        ports = []
+        for spec in specs:
+            port, _, baud_rate = spec.partition('@')
+            if baud_rate and not baud_rate.isdigit():
+                raise Abort("Invalid baud rate in %s" % spec)
+            ports.append((self.e.resolve_serial_port(port), int(baud_rate or args.baud_rate)))
+        return ports
+
+    def capture(self, args, prefix):
+        if not args.capture:
+            return None
+        options = dict(prefix=prefix, max_size=args.rotate_size, max_age=args.rotate_time,
+                       compress=args.compress)
+        if args.trigger:
+            return TriggeredCapture(args.capture, args.trigger, args.window, **options)
+        return Capture(args.capture, **options)
+
+    def check_decoding(self, args):
+        """
+        Raise Abort if decoding options are incomplete or invalid.
+        """
+        if not args.decode:
+            return
+        if not args.records:
+            raise Abort("--records FILE is required to store decoded records")
+        try:
+            make_decoder(args.decode, args.record_format, self.fields(args))
+        except struct.error as e:
+            raise Abort("Invalid record format %s: %s" % (args.record_format, e))
+
+    def fields(self, args):
+        return args.fields.split(',') if args.fields else None
+
+    def decoding(self, args, name=None):
+        if not args.decode:
+            return None
+        decoder = make_decoder(args.decode, args.record_format, self.fields(args))
+        path = args.records
+        if name:
+            base, ext = os.path.splitext(path)
+            path = '%s-%s%s' % (base, name, ext)
+        return Decoding(decoder, make_writer(path))
+
+    def run_picocom(self, serial_port, baud_rate, args):
+        serial_monitor = self.e.find_tool('serial', ['picocom'], human_name='Serial monitor (picocom)')
+        call([
             serial_monitor,
             serial_port,
-            '-b', str(args.baud_rate),
+            '-b', str(baud_rate),
             '-l'
         ] + args.remainder)
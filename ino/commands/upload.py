@@ -5,13 +5,20 @@ from __future__ import absolute_import
 import os.path
 import subprocess
 import platform
+import threading
+import termios
+import tempfile
 
-from time import sleep
-from serial import Serial
-from serial.serialutil import SerialException
+from time import time
 
 from ino.commands.base import Command
 from ino.exc import Abort
+from ino.filters import colorize
+from ino.flashlog import FlashLog
+from ino.hexfile import read_hex, write_hex, Image
+from ino.ports import set_hupcl, pulse_dtr, touch, wait_for_new_port
+from ino.programmers import find_programmer, page_size, ProgrammerError
+from ino.utils import file_digest, format_available_options, Timings, call, counters
 
 
 class Upload(Command):
@@ -22,26 +29,75 @@ class Upload(Command):
     device firmare reads/writes serial port extensively, upload may fail. In
     that case try to retry few times or upload just after pushing Reset button
     on Arduino board.
+
+    Digests of uploaded firmwares are recorded per device USB serial number
+    in ~/.ino/flashlog.json. If the device is known to run exactly the same
+    firmware already, upload is skipped unless --force is given. Devices
+    without a serial number can't be told apart, the whole firmware is
+    always uploaded to them.
+
+    Firmware is programmed by ino itself for boards with stk500v1 (Optiboot)
+    and avr109 (Caterina) bootloaders, avrdude is used for the rest.
+
+    With --incremental only flash pages that differ from the firmware the
+    device is known to run are written. The whole firmware is verified
+    after that, in case something else has flashed the device since.
+
+    Several boards could be flashed at once: pass a list of ports to
+    --serial-port or use --all to upload to every connected board of the
+    model. --all works only for models with USB VID/PID in boards.txt.
+    Boards are reset and programmed concurrently and a summary is printed
+    in the end.
+
+    With --timings wall time of upload phases is printed: discovery,
+    hupcl, dtr, touch (1200 bps touch and waiting for the bootloader port),
+    programming and flashlog. Phases of concurrent uploads are summed up.
     """
 
     name = 'upload'
     help_line = "Upload built firmware to the device"
 
+    def __init__(self, environment):
+        super(Upload, self).__init__(environment)
+        self.timings = Timings()
+
     def setup_arg_parser(self, parser):
         super(Upload, self).setup_arg_parser(parser)
-        parser.add_argument('-p', '--serial-port', metavar='PORT',
-                            help='Serial port to upload firmware to\nTry to guess if not specified')
+        parser.add_argument('-p', '--serial-port', metavar='PORT', nargs='+',
+                            help='Serial port(s) or USB serial number(s) of boards\n'
+                            'to upload firmware to\nTry to guess if not specified')
+        parser.add_argument('--timings', default=False, action='store_true',
+                            help='Print wall time of upload phases')
+        parser.add_argument('--all', default=False, action='store_true',
+                            help='Upload to all connected boards matching the board model')
+        parser.add_argument('--incremental', default=False, action='store_true',
+                            help='Write only flash pages that changed since the last\n'
+                            'upload to the device')
+        parser.add_argument('--programmer', choices=['auto', 'native', 'avrdude'],
+                            default='auto',
+                            help='Programmer to use. Native one talks to stk500v1 and\n'
+                            'avr109 bootloaders directly. auto uses it if it supports\n'
+                            'the board and falls back to avrdude. Default: %(default)s')
+        parser.add_argument('-j', '--jobs', metavar='N', type=int, default=0,
+                            help='Maximum number of boards to upload to simultaneously\n'
+                            '(default: all at once)')
+        parser.add_argument('--force', default=False, action='store_true',
+                            help='Upload even if the device is known to run the same firmware')
+        parser.add_argument('--readback', default=False, action='store_true',
+                            help='Read device flash back before uploading and\n'
+                            'skip programming if it already matches the firmware')
 
         self.e.add_board_model_arg(parser)
         self.e.add_arduino_dist_arg(parser)
 
     def discover(self,model):
         board = self.e.board_model(model)
-        self.e.find_tool('stty', ['stty'])
         if model.startswith('teensy'):
             self.e.find_arduino_tool(board['build']['post_compile_script'], ['hardware', 'tools'])
             self.e.find_arduino_tool(board['upload']['avrdude_wrapper'], ['hardware','tools'])
-        elif platform.system() == 'Linux':
+
+    def discover_avrdude(self):
+        if platform.system() == 'Linux':
             self.e.find_arduino_tool('avrdude', ['hardware', 'tools'])
 
             conf_places = self.e.arduino_dist_places(['hardware', 'tools'])
@@ -52,131 +108,447 @@ class Upload(Command):
             self.e.find_arduino_file('avrdude.conf', ['hardware', 'tools', 'avr', 'etc'])
     
     def run(self, args):
+        try:
+            self.run_phases(args)
+        finally:
+            if args.timings:
+                print self.timings.format()
+
+    def run_phases(self, args):
+        with self.timings.phase('discovery'):
+            board = self.prepare(args)
+        if board is None:
+            return
+
+        if len(self.ports) == 1:
+            self.upload(board, self.protocol, self.ports[0], self.digest, args)
+            return
+
+        self.upload_many(board, self.protocol, self.ports, self.digest, args)
+
+    def prepare(self, args):
+        """
+        Discover tools, the board model and ports to upload to. Set up
+        `protocol`, `ports`, `digest` and `programmer` and return the board.
+        """
         self.discover(args.board_model)
         board = self.e.board_model(args.board_model)
 
         if args.board_model.startswith('teensy'):
-            post_compile = self.e[board['build']['post_compile_script']]
-            reboot = self.e[board['upload']['avrdude_wrapper']]
-            # post_compile script requires:
-            #  .hex filename w/o the extension
-            filename = os.path.splitext(self.e.hex_filename)[0]
-            #  full path to directory with the compiled .hex file 
-            fullpath = os.path.realpath(self.e.build_dir)
-            #  full path to the tools directory
-            tooldir = self.e.find_arduino_dir('', ['hardware', 'tools'])
-            subprocess.call([
-                post_compile,
-                '-file=' + filename,
-                '-path=' + fullpath, 
-                '-tools=' + tooldir
-            ])
-            # reboot to complete the upload
-            # NOTE: this will warn the user if they need to press the reset button
-            subprocess.call([
-                reboot
-            ])
-            exit(0)
+            self.upload_teensy(board)
+            return None
+
         protocol = board['upload']['protocol']
+        if protocol == 'stk500':
+            # if v1 is not specifid explicitly avrdude will
+            # try v2 first and fail
+            protocol = 'stk500v1'
+
         if protocol == 'usbtiny':
             # something maybe?
-            i = 0
-            port = None
+            ports = [None]
+        elif args.all:
+            ports = self.e.board_serial_ports(board)
+            if not ports:
+                raise Abort("No connected %s boards found" % board['name'])
+        elif args.serial_port:
+            # a value from config file is a plain string
+            ports = args.serial_port
+            if isinstance(ports, basestring):
+                ports = ports.split()
+            ports = map(self.e.resolve_serial_port, ports)
         else:
-            port = args.serial_port or self.e.guess_serial_port()
-            if protocol == 'stk500':
-                # if v1 is not specifid explicitly avrdude will
-                # try v2 first and fail
-                protocol = 'stk500v1'
-
-            if not os.path.exists(port):
-                raise Abort("%s doesn't exist. Is Arduino connected?" % port)
-
-            # send a hangup signal when the last process closes the tty
-            file_switch = '-f' if platform.system() == 'Darwin' else '-F'
-            ret = subprocess.call([self.e['stty'], file_switch, port, 'hupcl'])
-            if ret:
-                raise Abort("stty failed")
-
-            # pulse on DTR
+            ports = [self.e.guess_serial_port(board)]
+
+        # the same port could be given twice, keep the order though
+        ports = [p for i, p in enumerate(ports) if p not in ports[:i]]
+
+        digest = file_digest(self.e['hex_path'])
+        if digest is None:
+            raise Abort("%s not found. Run `ino build' first." % self.e['hex_path'])
+
+        programmer = find_programmer(protocol, board['build']['mcu'])
+        if args.programmer == 'avrdude' or not programmer or ports == [None]:
+            if args.programmer == 'native':
+                raise Abort("No native programmer for %s protocol and %s" % 
+                            (protocol, board['build']['mcu']))
+            self.programmer = None
+            self.discover_avrdude()
+        else:
+            self.programmer = programmer
+
+        if self.programmer or args.incremental:
+            self.image = read_hex(self.e['hex_path'])
+
+        self.flashlog = FlashLog()
+        self.protocol, self.ports, self.digest = protocol, ports, digest
+        return board
+
+    def upload_many(self, board, protocol, ports, digest, args):
+        """
+        Upload to all `ports` concurrently in separate threads, at most
+        `args.jobs` at a time. Programmer output is collected per port and
+        shown only for failed uploads.
+        """
+        results = {}
+        slots = threading.Semaphore(args.jobs or len(ports))
+
+        def worker(port):
+            with slots:
+                started = time()
+                try:
+                    status = self.upload(board, protocol, port, digest, args, quiet=True)
+                    results[port] = (status, None, time() - started)
+                except Abort as e:
+                    results[port] = ('FAILED', str(e), time() - started)
+                except Exception as e:
+                    results[port] = ('FAILED', repr(e), time() - started)
+
+        print 'Uploading to %d boards ...' % len(ports)
+        threads = [threading.Thread(target=worker, args=(port,)) for port in ports]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # join with timeout so that Ctrl+C is not blocked
+            while t.is_alive():
+                t.join(0.5)
+
+        items = []
+        for port in ports:
+            status, error, elapsed = results[port]
+            color = 'red' if error else 'green'
+            line = '%s %5.1fs' % (colorize('%-8s' % status, color), elapsed)
+            if error:
+                line += '  ' + error
+            items.append((port, line))
+
+        head_width = max(len(port) for port in ports)
+        print format_available_options(items, head_width=head_width)
+
+        failed = sum(1 for status, _, _ in results.itervalues() if status == 'FAILED')
+        if failed:
+            raise Abort("%d of %d uploads failed" % (failed, len(ports)))
+
+    def upload(self, board, protocol, port, digest, args, quiet=False):
+        """
+        Upload the firmware with `digest` to a device on `port`. Return
+        status: 'uploaded', 'verified' or 'skipped'. If `quiet` is True
+        programmer output is shown only if it fails.
+        """
+        info = self.e.port_usb_info(port) if port else None
+        serial = info.serial if info else None
+
+        # a programmer like usbtiny doesn't tell us which device is
+        # connected and a port could have had another board plugged in
+        # since the last upload, so only devices with serial numbers
+        # are recorded
+        flashlog = self.flashlog if serial else None
+
+        if flashlog and not args.force:
+            last = flashlog.lookup(serial)
+            if last and last['digest'] == digest:
+                if not quiet:
+                    print colorize('%s already runs this firmware, upload skipped. '
+                                   'Use --force to upload anyway.' % port, 'green')
+                return 'skipped'
+
+        pages = None
+        if args.incremental and flashlog:
+            pages = self.changed_pages(board, flashlog.lookup(serial))
+            if pages is not None and not quiet:
+                print '%d flash pages changed since the last upload' % len(pages)
+
+        prog_port = self.reset(board, port, info)
+
+        def reset_again(session_port):
+            return self.reset_again(board, port, info, session_port)
+
+        try:
+            with self.timings.phase('programming'):
+                status = self.program(board, protocol, prog_port, args, pages, quiet,
+                                      reset_again)
+        except Abort:
+            if flashlog:
+                # device state is unknown now
+                flashlog.forget(serial)
+                flashlog.save()
+            raise
+
+        if flashlog:
+            with self.timings.phase('flashlog'):
+                flashlog.record(serial, digest, board['build']['mcu'])
+                flashlog.store_image(digest, self.e['hex_path'])
+                flashlog.save()
+
+        return status
+
+    def changed_pages(self, board, last):
+        """
+        Return a list of (address, data) flash pages of the firmware which
+        differ from the firmware of `last` flashlog record. Return None if
+        they can't be told.
+        """
+        mcu = board['build']['mcu']
+        size = page_size(mcu)
+        if not last or last.get('mcu') != mcu or not size:
+            return None
+
+        base_path = self.flashlog.image_path(last['digest'])
+        if not base_path:
+            return None
+        return self.image.changed_pages(read_hex(base_path), size)
+
+    def program(self, board, protocol, port, args, pages=None, quiet=False, reset=None):
+        """
+        Program the firmware to the device on `port` which is in bootloader
+        already. If `pages` list is given only those (address, data) pages
+        are written. Return status: 'uploaded' or 'verified' if --readback
+        is given and device flash already matches.
+
+        `reset` is called with the port of a finished programmer session to
+        get the device into bootloader again, it returns a port to reach the
+        bootloader on.
+        """
+        if self.programmer:
+            try:
+                return self.program_native(board, port, args.readback, pages, quiet)
+            except ProgrammerError as e:
+                if args.programmer == 'native':
+                    raise
+                print colorize('Native programmer failed on %s: %s\n'
+                               'Falling back to avrdude.' % (port, e), 'yellow')
+                self.discover_avrdude()
+                if reset:
+                    # the bootloader has timed out or was left in
+                    # the middle of a session, get into it anew
+                    port = reset(port)
+                try:
+                    return self.program_avrdude_pages(board, protocol, port, args,
+                                                      pages, quiet, reset)
+                except Abort as avrdude_error:
+                    raise Abort("%s, native programmer failed before with: %s" %
+                                (avrdude_error, e))
+
+        return self.program_avrdude_pages(board, protocol, port, args, pages, quiet, reset)
+
+    def program_avrdude_pages(self, board, protocol, port, args, pages=None, quiet=False,
+                              reset=None):
+        """
+        Program the firmware or only `pages` of it with avrdude, see
+        `program`.
+        """
+        if pages is None:
+            return self.program_avrdude(board, protocol, port, self.e['hex_path'], 
+                                        args.readback, quiet, reset)
+
+        # avrdude writes only pages that have any data in
+        # the input file, so give it changed pages only
+        fd, hex_path = tempfile.mkstemp(suffix='.hex', prefix='ino-pages-')
+        os.close(fd)
+        try:
+            write_hex(Image.from_pages(pages), hex_path)
+            status = self.program_avrdude(board, protocol, port, hex_path, 
+                                          args.readback, quiet, reset)
+        finally:
+            os.remove(hex_path)
+
+        # avrdude verifies only the pages it wrote, the rest differ if
+        # something else flashed the device since the last upload
+        if reset:
+            port = reset(port)
+            ret, _ = self.avrdude(board, protocol, port, 'v', self.e['hex_path'], quiet=True)
+            if ret != 0:
+                raise Abort("Device flash on %s differs from the firmware outside of "
+                            "changed pages. Upload without --incremental" % port)
+        return status
+
+    def program_native(self, board, port, readback, pages=None, quiet=False):
+        started = time()
+        with self.programmer(port, board['upload']['speed'], board['build']['mcu']) as prog:
+            image_pages = list(self.image.pages(prog.page_size))
+            if pages is None:
+                pages = image_pages
+            if readback:
+                if not quiet:
+                    print 'Reading back device flash ...'
+                if not prog.verify(image_pages):
+                    if not quiet:
+                        print colorize('Device flash matches the firmware, programming skipped.', 'green')
+                    return 'verified'
+
+            prog.write(pages)
+            # the whole image is verified: pages an incremental upload
+            # didn't write differ if something else flashed the device
+            # since the last upload, they are written then
+            mismatched = prog.verify(image_pages)
+            if mismatched and pages is not image_pages:
+                contents = dict(image_pages)
+                pages = pages + [(address, contents[address]) for address in mismatched]
+                prog.write((address, contents[address]) for address in mismatched)
+                mismatched = prog.verify(image_pages)
+            if mismatched:
+                raise ProgrammerError("Verification failed at 0x%04x on %s" % 
+                                      (mismatched[0], port))
+
+        if not quiet:
+            print colorize('%d pages written to %s and verified in %.1fs' % 
+                           (len(pages), port, time() - started), 'green')
+        return 'uploaded'
+
+    def program_avrdude(self, board, protocol, port, hex_path, readback, quiet=False,
+                        reset=None):
+        """
+        Program `hex_path` with avrdude, it verifies flash as part of the
+        write. With `readback` flash is verified in a separate session first
+        and the device is reset into bootloader with `reset` before writing,
+        because bootloaders leave programming mode at the end of a session.
+        """
+        if readback and reset:
+            if not quiet:
+                print 'Reading back device flash ...'
+            ret, _ = self.avrdude(board, protocol, port, 'v', hex_path, quiet=True)
+            if ret == 0:
+                if not quiet:
+                    print colorize('Device flash matches the firmware, programming skipped.', 'green')
+                return 'verified'
+            port = reset(port)
+
+        ret, output = self.avrdude(board, protocol, port, 'w', hex_path, quiet=quiet)
+        if ret != 0:
+            if output:
+                print colorize('avrdude output for %s:' % port, 'red')
+                print output
+            raise Abort("avrdude failed with code %s" % ret)
+        return 'uploaded'
+
+    def upload_teensy(self, board):
+        post_compile = self.e[board['build']['post_compile_script']]
+        reboot = self.e[board['upload']['avrdude_wrapper']]
+        # post_compile script requires:
+        #  .hex filename w/o the extension
+        filename = os.path.splitext(self.e.hex_filename)[0]
+        #  full path to directory with the compiled .hex file 
+        fullpath = os.path.realpath(self.e.build_dir)
+        #  full path to the tools directory
+        tooldir = self.e.find_arduino_dir('', ['hardware', 'tools'])
+        call([
+            post_compile,
+            '-file=' + filename,
+            '-path=' + fullpath, 
+            '-tools=' + tooldir
+        ])
+        # reboot to complete the upload
+        # NOTE: this will warn the user if they need to press the reset button
+        call([
+            reboot
+        ])
+
+    def reset(self, board, port, info=None):
+        """
+        Reset the device on `port` into bootloader. Return a port the
+        bootloader could be reached on, it differs from `port` for boards
+        that re-enumerate like Leonardo. `info` is UsbInfo of the device,
+        it is used to tell the bootloader port among ports of other boards
+        that re-enumerate at the same time.
+        """
+        if port:
             try:
-                s = Serial(port, 115200)
-            except SerialException as e:
-                raise Abort(str(e))
-            s.setDTR(False)
-            sleep(0.1)
-            s.setDTR(True)
-            s.close()
+                # send a hangup signal when the last process closes the tty
+                with self.timings.phase('hupcl'):
+                    set_hupcl(port)
+                with self.timings.phase('dtr'):
+                    pulse_dtr(port)
+            except (OSError, IOError, termios.error) as e:
+                raise Abort("Failed to reset %s: %s" % (port, e))
 
         # Need to do a little dance for Leonardo and derivatives:
         # open then close the port at the magic baudrate (usually 1200 bps) first
         # to signal to the sketch that it should reset into bootloader. after doing
-        # this wait a moment for the bootloader to enumerate. On Windows, also must
+        # this wait for the bootloader to enumerate. On Windows, also must
         # deal with the fact that the COM port number changes from bootloader to
         # sketch.
-        touch_port = \
-                board['upload'].get('use_1200bps_touch') == 'true' or \
-                board['upload']['protocol'] == 'avr109'
+        if not self.touches_port(board):
+            return port
 
-        if touch_port:
-            new_port = None
+        with self.timings.phase('touch'):
             before = self.e.list_serial_ports()
             if port in before:
-                ser = Serial()
-                ser.port = port
-                ser.baudrate = 1200
-                ser.open()
-                ser.close()
-
-                # Scanning for available ports seems to open the port or
-                # otherwise assert DTR, which would cancel the WDT reset if
-                # it happened within 250 ms. So we wait until the reset should
-                # have already occured before we start scanning.
-                if platform.system() != 'Darwin':
-                    sleep(0.3)
-
-            elapsed = 0
-            enum_delay = 0.25
-            while elapsed < 10:
-                now = self.e.list_serial_ports()
-                diff = list(set(now) - set(before))
-                if diff:
-                    new_port = diff[0]
-                    break
-
-                before = now
-                sleep(enum_delay)
-                elapsed += enum_delay
-
-            if not new_port:
-                raise Abort("Couldn’t find a board on the selected port. "
-                            "Check that you have the correct port selected. "
-                            "If it is correct, try pressing the board's reset "
-                            "button after initiating the upload.")
-
-            port = new_port
-
-        # call avrdude to upload .hex
+                try:
+                    touch(port, 1200)
+                except (OSError, IOError, termios.error) as e:
+                    raise Abort("Failed to touch %s: %s" % (port, e))
+
+            # other boards could re-enumerate at the same time,
+            # look for a new port at the same USB location only
+            location = info.location if info else None
+            dirnames = set(os.path.dirname(p) for p in self.e.serial_port_patterns())
+            new_port = wait_for_new_port(self.e.list_serial_ports, before,
+                                         timeout=10, location=location, dirnames=dirnames)
+        if not new_port:
+            raise Abort("Couldn’t find a board on the selected port. "
+                        "Check that you have the correct port selected. "
+                        "If it is correct, try pressing the board's reset "
+                        "button after initiating the upload.")
+
+        return new_port
+
+    def touches_port(self, board):
+        return board['upload'].get('use_1200bps_touch') == 'true' or \
+                board['upload']['protocol'] == 'avr109'
+
+    def reset_again(self, board, port, info, session_port):
+        """
+        Get the device on `port` into bootloader once more after a programmer
+        session on `session_port` has ended. Return a port the bootloader
+        could be reached on, see `reset`.
+        """
+        if not self.touches_port(board):
+            return self.reset(board, port, info)
+
+        # a bootloader that re-enumerates stays until it times out if the
+        # session failed, but starts the sketch right away if it was ended
+        if session_port in self.e.list_serial_ports():
+            if session_port != port:
+                return session_port
+            current = self.e.port_usb_info(session_port)
+            if info and current and current.pid != info.pid:
+                return session_port
+
+        # wait for the sketch port to come back to touch it again
+        with self.timings.phase('touch'):
+            dirnames = set(os.path.dirname(p) for p in self.e.serial_port_patterns())
+            wait_for_new_port(lambda: [p for p in self.e.list_serial_ports() if p == port],
+                              [], timeout=10, dirnames=dirnames)
+        return self.reset(board, port, info)
+
+    def avrdude(self, board, protocol, port, operation, hex_path, quiet=False):
+        """
+        Run avrdude to perform `operation` on the flash memory with the
+        `hex_path` file: 'w' to write it or 'v' to verify device flash
+        against it.
+        Return a tuple of avrdude exit code and its output. Output is
+        captured only if `quiet` is True, otherwise it goes to the terminal
+        as is and None is returned.
+        """
+        cmd = [
+            self.e['avrdude'],
+            '-C', self.e['avrdude.conf'],
+            '-p', board['build']['mcu'],
+        ]
         if port:
-            subprocess.call([
-                self.e['avrdude'],
-                '-C', self.e['avrdude.conf'],
-                '-p', board['build']['mcu'],
-                '-P', port,
-                '-c', protocol,
-                '-b', board['upload']['speed'],
-                '-D',
-                '-U', 'flash:w:%s:i' % self.e['hex_path'],
-            ])
-        else:
-            subprocess.call([
-                self.e['avrdude'],
-                '-C', self.e['avrdude.conf'],
-                '-p', board['build']['mcu'],
-            #    '-P', port,
-                '-c', protocol,
-                '-b', board['upload']['speed'],
-                '-D',
-                '-U', 'flash:w:%s:i' % self.e['hex_path'],
-            ])
+            cmd += ['-P', port]
+        cmd += [
+            '-c', protocol,
+            '-b', board['upload']['speed'],
+            '-D',
+            '-U', 'flash:%s:%s:i' % (operation, hex_path),
+        ]
+        if not quiet:
+            return call(cmd), None
 
+        cmd += ['-q', '-q']
+        with counters.timed('subprocess ' + os.path.basename(cmd[0])):
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = p.communicate()[0]
+        return p.returncode, output
@@ -0,0 +1,408 @@
+# -*- coding: utf-8; -*-
+
+"""
+Decoding of device telemetry streams into records. A decoder turns bytes
+into batches of records, a writer stores batches to CSV or NPY files and
+`Decoding` ties them together as a Monitor handler.
+
+Batches are numpy arrays if numpy is installed and lists of tuples
+otherwise. Numeric CSV and fixed size binary records are decoded with a
+single numpy call per batch.
+"""
+
+import re
+import csv
+import struct
+
+from ino.exc import Abort
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DecodeError(Abort):
+    pass
+
+
+def cobs_encode(data):
+    out = []
+    for block in data.split('\0'):
+        while len(block) >= 0xfe:
+            out.append('\xff' + block[:0xfe])
+            block = block[0xfe:]
+        out.append(chr(len(block) + 1) + block)
+    return ''.join(out)
+
+
+def cobs_decode(frame):
+    out = []
+    i, size = 0, len(frame)
+    while i < size:
+        code = ord(frame[i])
+        end = i + code
+        if code == 0 or end > size:
+            raise ValueError("Malformed COBS frame")
+        out.append(frame[i + 1:end])
+        i = end
+        if code != 0xff and i < size:
+            out.append('\0')
+    return ''.join(out)
+
+
+# struct format characters with standard sizes and their numpy equivalents
+numpy_codes = {
+    'b': 'i1', 'B': 'u1', '?': 'b1',
+    'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8',
+    'f': 'f4', 'd': 'f8',
+}
+
+
+def struct_descr(fmt, fields=None):
+    """
+    Return NPY/numpy record description for struct format `fmt` with
+    explicit byte order, e.g. '<Hhf'.
+    """
+    if fmt[:1] not in '<>!':
+        raise DecodeError("Record format %s must start with byte order: < or >" % fmt)
+    order = '>' if fmt[0] in '>!' else '<'
+    codes = []
+    for count, code in re.findall(r'(\d*)(\D)', fmt[1:]):
+        if code not in numpy_codes:
+            raise DecodeError("Unsupported record format character '%s'" % code)
+        codes.extend([order + numpy_codes[code]] * int(count or 1))
+    fields = fields or ['f%d' % i for i in range(len(codes))]
+    if len(fields) != len(codes):
+        raise DecodeError("%d fields are given, but record has %d" % (len(fields), len(codes)))
+    return zip(fields, codes)
+
+
+class Decoder(object):
+    """
+    Base class for decoders. `decode` takes a chunk of a stream and returns
+    a batch of records that are complete by now, the rest is kept until
+    more data comes.
+
+    `fields` are names of record fields and `descr` is a numpy style
+    description of a record, both could be unknown until the first record
+    is decoded. `errors` counts records that were skipped as malformed.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = fields
+        self.descr = None
+        self.buffer = ''
+        self.errors = 0
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def empty(self):
+        return [] if numpy is None else None
+
+
+class LineDecoder(Decoder):
+    def split(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        return [line.rstrip('\r') for line in lines if line.strip()]
+
+
+class CsvDecoder(LineDecoder):
+    """
+    Lines of comma separated numbers. Every record gets as many values as
+    the first one has, malformed lines are skipped.
+    """
+
+    def __init__(self, fields=None, delimiter=','):
+        super(CsvDecoder, self).__init__(fields)
+        self.delimiter = delimiter
+
+    def set_width(self, width):
+        self.fields = self.fields or ['f%d' % i for i in range(width)]
+        if len(self.fields) != width:
+            raise DecodeError("%d fields are given, but records have %d" % (len(self.fields), width))
+        self.descr = '<f8'
+
+    def decode(self, data):
+        lines = self.split(data)
+        if not lines:
+            return self.empty()
+        if self.descr is None:
+            self.set_width(lines[0].count(self.delimiter) + 1)
+        width = len(self.fields)
+
+        delimiters = width - 1
+        if numpy is not None and all(line.count(self.delimiter) == delimiters for line in lines):
+            values = numpy.fromstring(self.delimiter.join(lines), sep=self.delimiter)
+            if values.size == len(lines) * width:
+                return values.reshape(-1, width)
+
+        # a malformed line is in the batch, go line by line
+        rows = []
+        for line in lines:
+            try:
+                row = tuple(float(v) for v in line.split(self.delimiter))
+            except ValueError:
+                row = ()
+            if len(row) == width:
+                rows.append(row)
+            else:
+                self.errors += 1
+        if numpy is not None:
+            return numpy.array(rows, dtype=float).reshape(-1, width)
+        return rows
+
+
+class KeyValueDecoder(LineDecoder):
+    """
+    Lines of key=value pairs separated by spaces or commas. Keys of the
+    first record are the fields unless `fields` are given. Missing and non
+    numeric values are NaN.
+    """
+
+    pair_re = re.compile(r'([^\s,=]+)=([^\s,]*)')
+
+    def decode(self, data):
+        rows = []
+        for line in self.split(data):
+            pairs = self.pair_re.findall(line)
+            if not pairs:
+                self.errors += 1
+                continue
+            if self.fields is None:
+                self.fields = [key for key, _ in pairs]
+            self.descr = '<f8'
+            values = dict(pairs)
+            rows.append(tuple(self.number(values.get(field)) for field in self.fields))
+        if not rows:
+            return self.empty()
+        if numpy is not None:
+            return numpy.array(rows, dtype=float).reshape(-1, len(self.fields or ()))
+        return rows
+
+    def number(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float('nan')
+
+
+class BinaryDecoder(Decoder):
+    """
+    Base class for binary framing. Frame payloads are records packed as
+    struct `record_format`, e.g. '<Hhf'.
+    """
+
+    def __init__(self, record_format, fields=None):
+        super(BinaryDecoder, self).__init__(fields)
+        self.descr = struct_descr(record_format, fields)
+        self.struct = struct.Struct(record_format)
+        self.fields = [name for name, _ in self.descr]
+
+    def frames(self, data):
+        raise NotImplementedError
+
+    def decode(self, data):
+        frames = self.frames(data)
+        size = self.struct.size
+        good = [frame for frame in frames if len(frame) == size]
+        self.errors += len(frames) - len(good)
+
+        if not good:
+            return self.empty()
+        if numpy is not None:
+            return numpy.frombuffer(''.join(good), dtype=self.descr)
+        unpack = self.struct.unpack
+        return [unpack(frame) for frame in good]
+
+
+class LengthPrefixedDecoder(BinaryDecoder):
+    """
+    Frames are payloads preceded by their length packed as struct
+    `length_format`. A length over `max_size` means the stream is out of
+    sync, a byte is dropped then and the next one is tried.
+    """
+
+    def __init__(self, record_format, fields=None, length_format='<H', max_size=1024):
+        super(LengthPrefixedDecoder, self).__init__(record_format, fields)
+        self.length = struct.Struct(length_format)
+        self.max_size = max_size
+
+    def frames(self, data):
+        buf = self.buffer + data
+        frames = []
+        offset, header = 0, self.length.size
+        unpack_from = self.length.unpack_from
+        while len(buf) - offset >= header:
+            size, = unpack_from(buf, offset)
+            if size > self.max_size:
+                self.errors += 1
+                offset += 1
+                continue
+            end = offset + header + size
+            if end > len(buf):
+                break
+            frames.append(buf[offset + header:end])
+            offset = end
+        self.buffer = buf[offset:]
+        return frames
+
+
+class CobsDecoder(BinaryDecoder):
+    """
+    COBS encoded frames delimited by zero bytes.
+    """
+
+    def frames(self, data):
+        chunks = (self.buffer + data).split('\0')
+        self.buffer = chunks.pop()
+        frames = []
+        for chunk in chunks:
+            if not chunk:
+                continue
+            try:
+                frames.append(cobs_decode(chunk))
+            except ValueError:
+                self.errors += 1
+        return frames
+
+
+decoders = {
+    'csv': CsvDecoder,
+    'kv': KeyValueDecoder,
+    'length': LengthPrefixedDecoder,
+    'cobs': CobsDecoder,
+}
+
+
+def make_decoder(name, record_format=None, fields=None):
+    cls = decoders[name]
+    if issubclass(cls, BinaryDecoder):
+        if not record_format:
+            raise DecodeError("Record format is required to decode %s frames" % name)
+        return cls(record_format, fields)
+    return cls(fields)
+
+
+def to_rows(batch):
+    return batch.tolist() if numpy is not None else batch
+
+
+class CsvWriter(object):
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.writer = csv.writer(self.file)
+        self.header = False
+
+    def write(self, batch, decoder):
+        if not self.header:
+            self.writer.writerow(decoder.fields)
+            self.header = True
+        self.writer.writerows(to_rows(batch))
+
+    def close(self):
+        self.file.close()
+
+
+class NpyWriter(object):
+    """
+    Stream records to a .npy file. The number of records isn't known until
+    the end, so the header is reserved up front and rewritten on close.
+    Works without numpy as well.
+    """
+
+    magic = '\x93NUMPY\x01\x00'
+    header_size = 256
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.count = 0
+        self.descr = None
+        self.width = None
+        self.file.write(' ' * self.header_size)
+
+    def header(self):
+        if isinstance(self.descr, list):
+            descr, shape = repr(self.descr), '(%d,)' % self.count
+        else:
+            descr, shape = repr(self.descr), '(%d, %d)' % (self.count, self.width)
+        header = "{'descr': %s, 'fortran_order': False, 'shape': %s, }" % (descr, shape)
+        size = self.header_size - len(self.magic) - 2
+        if len(header) >= size:
+            raise DecodeError("Too many fields to write NPY file")
+        return self.magic + struct.pack('<H', size) + header.ljust(size - 1) + '\n'
+
+    def write(self, batch, decoder):
+        if self.descr is None:
+            self.descr = decoder.descr
+            self.width = len(decoder.fields)
+        if not len(batch):
+            return
+
+        if numpy is not None:
+            self.file.write(batch.tobytes())
+        elif isinstance(self.descr, list):
+            pack = decoder.struct.pack
+            self.file.write(''.join(pack(*row) for row in batch))
+        else:
+            pack = struct.Struct('<%dd' % self.width).pack
+            self.file.write(''.join(pack(*row) for row in batch))
+        self.count += len(batch)
+
+    def close(self):
+        if self.descr is not None:
+            self.file.seek(0)
+            self.file.write(self.header())
+        self.file.close()
+
+
+def make_writer(path):
+    if path.endswith('.npy'):
+        return NpyWriter(path)
+    if path.endswith('.csv'):
+        return CsvWriter(path)
+    raise DecodeError("Unknown output format of %s, should be .csv or .npy" % path)
+
+
+class Decoding(object):
+    """
+    Monitor handler that collects chunks and decodes them in batches of at
+    least `batch_size` bytes or every `batch_interval` seconds.
+    """
+
+    def __init__(self, decoder, writer, batch_size=1 << 16, batch_interval=0.5):
+        self.decoder = decoder
+        self.writer = writer
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.chunks = []
+        self.size = 0
+        self.since = None
+        self.records = 0
+
+    def __call__(self, data, timestamp):
+        if self.since is None:
+            self.since = timestamp
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.batch_size or timestamp - self.since >= self.batch_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.chunks:
+            return
+        batch = self.decoder.decode(''.join(self.chunks))
+        self.chunks = []
+        self.size = 0
+        self.since = None
+        if batch is not None and len(batch):
+            self.writer.write(batch, self.decoder)
+            self.records += len(batch)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
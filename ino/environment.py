@@ -8,6 +8,7 @@ import pickle
 import platform
 import hashlib
 import re
+import threading
 
 try:
     from collections import OrderedDict
@@ -19,7 +20,8 @@ from collections import namedtuple
 from glob2 import glob
 
 from ino.filters import colorize
-from ino.utils import format_available_options
+from ino.ports import UsbInfoCache, board_usb_ids
+from ino.utils import format_available_options, counters
 from ino.exc import Abort
 
 
@@ -84,7 +86,13 @@ class Environment(dict):
     default_board_model = 'uno'
     ino = sys.argv[0]
 
+    _usb_info_cache = None
+    _usb_info_cache_lock = threading.Lock()
+
     def dump(self):
+        if self._usb_info_cache:
+            self._usb_info_cache.save()
+
         if not os.path.isdir(self.output_dir):
             return
         with open(self.dump_filepath, 'wb') as f:
@@ -136,7 +144,9 @@ class Environment(dict):
 
         Raise `Abort` if no matches were found.
         """
+        counters.count('find')
         if key in self:
+            counters.count('find cached')
             return self[key]
 
         human_name = human_name or key
@@ -145,6 +155,7 @@ class Environment(dict):
         places = itertools.chain.from_iterable(os.path.expandvars(p).split(os.pathsep) for p in places)
         places = map(os.path.expanduser, places)
 
+        counters.count('glob', len(places))
         glob_places = itertools.chain.from_iterable(glob(p) for p in places)
         
         print 'Searching for', human_name, '...',
@@ -152,6 +163,7 @@ class Environment(dict):
         for p in glob_places:
             for i in items:
                 path = os.path.join(p, i)
+                counters.count('stat')
                 if os.path.exists(path):
                     result = path if join else p
                     if not multi:
@@ -291,16 +303,73 @@ class Environment(dict):
         ports = []
         for p in self.serial_port_patterns():
             matches = glob(p)
-            ports.extend(matches)
+            ports.extend(sorted(matches))
         return ports
 
-    def guess_serial_port(self):
+    def port_usb_info(self, port):
+        """
+        Return UsbInfo of a device on `port` or None. Results are cached
+        across runs in ~/.ino/ports.json until the device is replugged.
+        """
+        # ports are looked up by threads uploading to several boards
+        with self._usb_info_cache_lock:
+            if self._usb_info_cache is None:
+                self._usb_info_cache = UsbInfoCache()
+        return self._usb_info_cache.get(port)
+
+    def board_serial_ports(self, board):
+        """
+        Return serial ports of connected devices that have USB VID/PID of the
+        `board` model. Raise `Abort` if the board model has no IDs in
+        boards.txt: other boards, modems or adapters could be connected,
+        so ports have to be listed explicitly then.
+        """
+        ids = board_usb_ids(board)
+        if not ids:
+            raise Abort("%s has no USB IDs in boards.txt to find connected "
+                        "boards by. List their ports with -p PORT [PORT ...]" %
+                        board['name'])
+
+        result = []
+        for port in self.list_serial_ports():
+            info = self.port_usb_info(port)
+            if info and (info.vid, info.pid) in ids:
+                result.append(port)
+        return result
+
+    def resolve_serial_port(self, name):
+        """
+        Return serial port `name` if it exists. Otherwise treat `name` as
+        USB serial number and return a port of the device that has it.
+        """
+        if os.path.exists(name):
+            return name
+
+        for port in self.list_serial_ports():
+            info = self.port_usb_info(port)
+            if info and info.serial == name:
+                return port
+
+        raise Abort("%s is neither a serial port nor a serial number of "
+                    "a connected device. Is Arduino connected?" % name)
+
+    def guess_serial_port(self, board=None):
+        """
+        Return a serial port of the first connected device. If `board` model
+        is given, devices with its USB VID/PID are preferred.
+        """
         print 'Guessing serial port ...',
 
         ports = self.list_serial_ports()
+        if board is not None and board_usb_ids(board):
+            ports = self.board_serial_ports(board) or ports
+
         if ports:
             result = ports[0]
-            print colorize(result, 'yellow')
+            if len(ports) > 1:
+                print colorize('%s (one of %d, use -p to choose)' % (result, len(ports)), 'yellow')
+            else:
+                print colorize(result, 'yellow')
             return result
 
         print colorize('FAILED', 'red')
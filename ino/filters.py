@@ -1,21 +1,27 @@
 # -*- coding: utf-8; -*-
 
+import re
 import sys
 import os.path
 import fnmatch
 import functools
 
-from ino.utils import FileMap, SpaceList
+from contextlib import contextmanager
+
+from ino.utils import FileMap, SpaceList, counters
+
+
+def intern_path(path):
+    return intern(path) if type(path) is str else path
 
 
 class GlobFile(object):
+    __slots__ = ('filename', 'dirname', 'path')
+
     def __init__(self, filename, dirname):
         self.filename = filename
-        self.dirname = dirname
-
-    @property
-    def path(self):
-        return os.path.join(self.dirname, self.filename)
+        self.dirname = intern_path(dirname)
+        self.path = intern_path(os.path.join(dirname, filename))
 
     def __repr__(self):
         return '<%s + %s>' % (self.dirname, self.filename)
@@ -29,26 +35,75 @@ def filter(f):
     return f
 
 
+# directory -> files found under it, shared by glob calls within glob_cache()
+_walks = None
+
+# glob patterns -> compiled matcher
+_matchers = {}
+
+
+@contextmanager
+def glob_cache():
+    """
+    Walk every directory once for all glob calls in the block. The
+    directories are assumed not to change meanwhile.
+    """
+    global _walks
+    saved = _walks
+    if _walks is None:
+        _walks = {}
+    try:
+        yield
+    finally:
+        _walks = saved
+
+
+def walk(dir, recursive=True):
+    """
+    Return (path relative to `dir`, basename) pairs of files in `dir`
+    sorted by name in every directory, so that file lists and Makefiles
+    don't depend on the file system listing order.
+    """
+    if recursive and _walks is not None and dir in _walks:
+        return _walks[dir]
+
+    files = []
+    counters.count('stat')
+    if os.path.isdir(dir):
+        _walk(dir, '', recursive, files)
+    if recursive and _walks is not None:
+        _walks[dir] = files
+    return files
+
+
+def _walk(dir, subdir, recursive, files):
+    scan_dir = os.path.join(dir, subdir)
+    entries = sorted(os.listdir(scan_dir))
+    counters.count('listdir')
+    counters.count('stat', len(entries))
+    for entry in entries:
+        path = os.path.join(scan_dir, entry)
+        if os.path.isdir(path):
+            if recursive:
+                _walk(dir, os.path.join(subdir, entry), recursive, files)
+        elif os.path.isfile(path):
+            files.append((os.path.join(subdir, entry), entry))
+
+
+def matcher(patterns):
+    if patterns not in _matchers:
+        regex = '|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns)
+        _matchers[patterns] = re.compile(regex).match if patterns else lambda name: None
+    return _matchers[patterns]
+
+
 @filter
 def glob(dir, *patterns, **kwargs):
     recursive = kwargs.get('recursive', True)
-    subdir = kwargs.get('subdir', '')
-
-    result = SpaceList()
-    scan_dir = os.path.join(dir, subdir)
-    if not os.path.isdir(scan_dir):
-        return result
-
-    for entry in os.listdir(scan_dir):
-        path = os.path.join(scan_dir, entry)
-        if os.path.isdir(path) and recursive:
-            subglob = glob(dir, *patterns, recursive=True,
-                           subdir=os.path.join(subdir, entry))
-            result.extend(subglob)
-        elif os.path.isfile(path) and any(fnmatch.fnmatch(entry, p) for p in patterns):
-            result.append(GlobFile(os.path.join(subdir, entry), dir))
-
-    return result
+    counters.count('glob')
+    match = matcher(patterns)
+    return SpaceList(GlobFile(relpath, dir) for relpath, name in walk(dir, recursive)
+                     if match(name))
 
 
 @filter
@@ -0,0 +1,152 @@
+# -*- coding: utf-8; -*-
+
+import os
+import os.path
+import json
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+
+class FlashLog(object):
+    """
+    Persistent record of firmware images last flashed to devices.
+
+    Uploads are recorded by the USB serial number of the device. A serial
+    number identifies a board wherever it is plugged in. A serial port
+    doesn't: another board could have been plugged in to it since the last
+    upload, so uploads to devices without a serial number are not recorded.
+
+    A copy of every recorded firmware is kept in `images` directory next
+    to the log, named by its digest. It lets an upload to write only flash
+    pages which differ from what the device has.
+
+    The log could be shared by threads uploading to several devices and
+    by several `ino upload' processes: records are saved under a lock file
+    and merged with ones other processes saved in the meantime.
+    """
+
+    default_path = '~/.ino/flashlog.json'
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or self.default_path)
+        self.images_dir = os.path.join(os.path.dirname(self.path), 'images')
+        self.lock = threading.Lock()
+        self.records = self.read()
+        # records changed by this process, None for forgotten ones
+        self.changes = {}
+        # firmwares to store by digest
+        self.new_images = {}
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        # older logs have records by serial port as well
+        return dict((key, entry) for key, entry in records.iteritems()
+                    if key.startswith('serial:'))
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold an exclusive lock on the log shared by processes.
+        """
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def lookup(self, serial):
+        """
+        Return a record of the image last flashed to a device with USB
+        `serial` number or None if nothing is known. Record is a dict with
+        `digest`, `mcu` and `time` keys.
+        """
+        with self.lock:
+            return self.records.get('serial:' + serial)
+
+    def record(self, serial, digest, mcu):
+        entry = {'digest': digest, 'mcu': mcu, 'time': time.time()}
+        with self.lock:
+            self.records['serial:' + serial] = entry
+            self.changes['serial:' + serial] = entry
+
+    def store_image(self, digest, hex_path):
+        """
+        Keep a copy of firmware `hex_path` with `digest`. It is stored on
+        `save` along with the records.
+        """
+        with self.lock:
+            self.new_images[digest] = hex_path
+
+    def _store_images(self):
+        if not os.path.isdir(self.images_dir):
+            os.makedirs(self.images_dir)
+        for digest, hex_path in self.new_images.iteritems():
+            path = os.path.join(self.images_dir, digest + '.hex')
+            if os.path.exists(path):
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir=self.images_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f, open(hex_path, 'rb') as source:
+                    shutil.copyfileobj(source, f)
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        self.new_images = {}
+
+    def image_path(self, digest):
+        """
+        Return path of a stored firmware copy with `digest` or None.
+        """
+        path = os.path.join(self.images_dir, digest + '.hex')
+        return path if os.path.exists(path) else None
+
+    def forget(self, serial):
+        with self.lock:
+            self.records.pop('serial:' + serial, None)
+            self.changes['serial:' + serial] = None
+
+    def save(self):
+        with self.lock:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            with self.locked():
+                records = self.read()
+                for key, entry in self.changes.iteritems():
+                    if entry is None:
+                        records.pop(key, None)
+                    else:
+                        records[key] = entry
+                self._store_images()
+
+                # write to a temporary file first so that a crash wouldn't
+                # leave a truncated log behind
+                fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='flashlog-', suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(records, f, indent=1, sort_keys=True)
+                    os.rename(tmp_path, self.path)
+                except:
+                    os.remove(tmp_path)
+                    raise
+                self.records = records
+                self.changes = {}
+
+                # images are dropped under the lock as well, so that one
+                # just saved by another process isn't taken for unused
+                used = set(r['digest'] + '.hex' for r in self.records.itervalues())
+                for name in os.listdir(self.images_dir):
+                    if name.endswith('.hex') and name not in used:
+                        os.remove(os.path.join(self.images_dir, name))
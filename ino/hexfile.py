@@ -0,0 +1,336 @@
+# -*- coding: utf-8; -*-
+
+import mmap
+import struct
+import binascii
+
+from ino.exc import Abort
+
+
+class HexError(Abort):
+    pass
+
+
+class Image(object):
+    """
+    Memory image made of non-overlapping contiguous segments. Each segment
+    is a start address and a bytearray with its contents. Addresses are
+    byte addresses, not AVR word addresses.
+
+    Images are read from Intel HEX, ELF and raw binary files and written to
+    Intel HEX and raw binary, so the module could stand for objcopy.
+    """
+
+    def __init__(self):
+        self.segments = []
+
+    def __len__(self):
+        return sum(len(data) for _, data in self.segments)
+
+    def __eq__(self, other):
+        return isinstance(other, Image) and self.segments == other.segments
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add(self, address, data):
+        """
+        Put `data` at `address` overwriting anything that was there before.
+        """
+        data = bytearray(data)
+        if not data:
+            return
+
+        end = address + len(data)
+        segments = []
+        for seg_start, seg_data in self.segments:
+            seg_end = seg_start + len(seg_data)
+            if seg_end < address or seg_start > end:
+                # disjoint and not adjacent
+                segments.append((seg_start, seg_data))
+                continue
+            # join overlapping or adjacent segment, new data wins
+            if seg_start < address:
+                data = seg_data[:address - seg_start] + data
+                address = seg_start
+            if seg_end > end:
+                data = data + seg_data[end - seg_start:]
+                end = seg_end
+
+        segments.append((address, data))
+        segments.sort(key=lambda seg: seg[0])
+        self.segments = segments
+
+    def pages(self, page_size, fill=0xff):
+        """
+        Yield (address, bytearray) for every page of `page_size` bytes that
+        has any data. Gaps within a page are filled with `fill` byte.
+        """
+        pages = {}
+        for start, data in self.segments:
+            offset = 0
+            while offset < len(data):
+                address = start + offset
+                page_address = address - address % page_size
+                chunk = data[offset:offset + page_size - (address - page_address)]
+
+                page = pages.get(page_address)
+                if page is None:
+                    page = pages[page_address] = bytearray([fill]) * page_size
+                begin = address - page_address
+                page[begin:begin + len(chunk)] = chunk
+                offset += len(chunk)
+
+        for address in sorted(pages):
+            yield address, pages[address]
+
+    def changed_pages(self, base, page_size, fill=0xff):
+        """
+        Return a list of (address, bytearray) pages of the image that differ
+        from the same pages of `base` image.
+        """
+        base_pages = dict(base.pages(page_size, fill))
+        return [(address, data) for address, data in self.pages(page_size, fill)
+                if base_pages.get(address) != data]
+
+    @property
+    def start(self):
+        return self.segments[0][0] if self.segments else 0
+
+    @property
+    def end(self):
+        if not self.segments:
+            return 0
+        address, data = self.segments[-1]
+        return address + len(data)
+
+    def merge(self, other, overwrite=False):
+        """
+        Add all data of `other` image to this one, e.g. to combine a sketch
+        with a bootloader. Raise HexError if images overlap unless
+        `overwrite` is True.
+        """
+        if not overwrite:
+            for start, data in other.segments:
+                end = start + len(data)
+                for seg_start, seg_data in self.segments:
+                    if start < seg_start + len(seg_data) and seg_start < end:
+                        raise HexError("Images overlap at 0x%x" % max(start, seg_start))
+        for start, data in other.segments:
+            self.add(start, data)
+
+    def to_bin(self, fill=0xff):
+        """
+        Return image contents from its start to end as a bytearray with gaps
+        filled with `fill` byte. Use `start` to know the base address.
+        """
+        result = bytearray([fill]) * (self.end - self.start)
+        for address, data in self.segments:
+            offset = address - self.start
+            result[offset:offset + len(data)] = data
+        return result
+
+    @classmethod
+    def from_pages(cls, pages):
+        image = cls()
+        for address, data in pages:
+            image.add(address, data)
+        return image
+
+
+def parse_hex(lines):
+    """
+    Parse Intel HEX records from iterable `lines` into an Image.
+    """
+    image = Image()
+    base = 0
+    # collect contiguous records before adding them to the image,
+    # otherwise large images are slow to build
+    run_start, run = None, bytearray()
+
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(':'):
+            raise HexError("Intel HEX line %d doesn't start with ':'" % lineno)
+
+        try:
+            record = bytearray(binascii.unhexlify(line[1:]))
+        except (TypeError, binascii.Error):
+            raise HexError("Intel HEX line %d is malformed" % lineno)
+
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise HexError("Intel HEX line %d has wrong length" % lineno)
+        if sum(record) & 0xff:
+            raise HexError("Intel HEX line %d has wrong checksum" % lineno)
+
+        count, rectype = record[0], record[3]
+        offset = (record[1] << 8) | record[2]
+        payload = record[4:4 + count]
+
+        if rectype == 0x00:
+            address = base + offset
+            if run_start is not None and run_start + len(run) == address:
+                run += payload
+            else:
+                if run_start is not None:
+                    image.add(run_start, run)
+                run_start, run = address, bytearray(payload)
+        elif rectype == 0x01:
+            break
+        elif rectype == 0x02:
+            base = ((payload[0] << 8) | payload[1]) << 4
+        elif rectype == 0x04:
+            base = ((payload[0] << 8) | payload[1]) << 16
+        elif rectype in (0x03, 0x05):
+            # start address records are not interesting for flashing
+            pass
+        else:
+            raise HexError("Intel HEX line %d has unknown record type %02x" %
+                           (lineno, rectype))
+
+    if run_start is not None:
+        image.add(run_start, run)
+    return image
+
+
+def _hex_record(rectype, offset, payload):
+    record = bytearray([len(payload), (offset >> 8) & 0xff, offset & 0xff, rectype])
+    record += payload
+    record.append(-sum(record) & 0xff)
+    return ':' + binascii.hexlify(record).upper() + '\n'
+
+
+def format_hex(image, record_size=16):
+    """
+    Yield Intel HEX lines for `image`.
+    """
+    base = 0
+    for start, data in image.segments:
+        offset = 0
+        while offset < len(data):
+            address = start + offset
+            if address >> 16 != base:
+                base = address >> 16
+                yield _hex_record(0x04, 0, bytearray([base >> 8, base & 0xff]))
+            # a record must not cross 64K boundary
+            size = min(record_size, len(data) - offset, 0x10000 - (address & 0xffff))
+            yield _hex_record(0x00, address & 0xffff, data[offset:offset + size])
+            offset += size
+    yield _hex_record(0x01, 0, bytearray())
+
+
+def write_hex(image, path):
+    with open(path, 'w') as f:
+        f.writelines(format_hex(image))
+
+
+def write_bin(image, path, fill=0xff):
+    with open(path, 'wb') as f:
+        f.write(image.to_bin(fill))
+
+
+def read_bin(path, address=0):
+    image = Image()
+    try:
+        with open(path, 'rb') as f:
+            image.add(address, f.read())
+    except IOError as e:
+        raise HexError("Can't read %s: %s" % (path, e.strerror))
+    return image
+
+
+def read_hex(path):
+    try:
+        with open(path) as f:
+            return parse_hex(f)
+    except IOError as e:
+        raise HexError("Can't read %s: %s" % (path, e.strerror))
+
+
+# ELF constants
+PT_LOAD = 1
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+
+elf_formats = {
+    # EI_CLASS: (header, program header, section header)
+    1: ('HHIIIIIHHHHHH', 'IIIIIIII', 'IIIIIIIIII'),
+    2: ('HHIQQQIHHHHHH', 'IIQQQQQQ', 'IIQQQQIIQQ'),
+}
+
+
+def parse_elf(data, exclude=('.eeprom',)):
+    """
+    Build an Image of loadable sections of ELF file contents `data` (a
+    string, buffer or mmap) the way `objcopy -O ihex` does: every allocated
+    section with contents is placed at its load address (LMA). Sections
+    named in `exclude` are skipped.
+    """
+    if data[:4] != '\x7fELF':
+        raise HexError("Not an ELF file")
+
+    elf_class, elf_data = ord(data[4]), ord(data[5])
+    if elf_class not in elf_formats or elf_data not in (1, 2):
+        raise HexError("Unsupported ELF class %d or data encoding %d" % (elf_class, elf_data))
+
+    endian = '<' if elf_data == 1 else '>'
+    header_fmt, ph_fmt, sh_fmt = [endian + f for f in elf_formats[elf_class]]
+
+    def unpack(fmt, offset):
+        return struct.unpack(fmt, data[offset:offset + struct.calcsize(fmt)])
+
+    (_, _, _, _, phoff, shoff, _, _,
+     phentsize, phnum, shentsize, shnum, shstrndx) = unpack(header_fmt, 16)
+
+    segments = []
+    for i in range(phnum):
+        ph = unpack(ph_fmt, phoff + i * phentsize)
+        if elf_class == 1:
+            p_type, p_offset, _, p_paddr, p_filesz = ph[:5]
+        else:
+            p_type, _, p_offset, _, p_paddr, p_filesz = ph[:6]
+        if p_type == PT_LOAD:
+            segments.append((p_offset, p_filesz, p_paddr))
+
+    sections = [unpack(sh_fmt, shoff + i * shentsize) for i in range(shnum)]
+    if not sections:
+        raise HexError("ELF file has no sections")
+
+    strtab_offset = sections[shstrndx][4]
+
+    def section_name(offset):
+        start = strtab_offset + offset
+        return data[start:data.find('\0', start)]
+
+    image = Image()
+    for name, sh_type, sh_flags, sh_addr, sh_offset, sh_size in (s[:6] for s in sections):
+        if not sh_flags & SHF_ALLOC or sh_type == SHT_NOBITS or not sh_size:
+            continue
+        if section_name(name) in exclude:
+            continue
+
+        # load address is derived from the segment the section is in
+        lma = sh_addr
+        for p_offset, p_filesz, p_paddr in segments:
+            if p_offset <= sh_offset < p_offset + p_filesz:
+                lma = p_paddr + sh_offset - p_offset
+                break
+        image.add(lma, data[sh_offset:sh_offset + sh_size])
+
+    return image
+
+
+def read_elf(path, exclude=('.eeprom',)):
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return parse_elf(data, exclude)
+            finally:
+                data.close()
+    except (IOError, EnvironmentError) as e:
+        raise HexError("Can't read %s: %s" % (path, e.strerror))
+    except struct.error:
+        raise HexError("%s is a malformed ELF file" % path)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8; -*-
+
+from __future__ import absolute_import
+
+import os
+import errno
+import select
+import termios
+
+from contextlib import contextmanager
+
+from serial import Serial
+from serial.serialutil import SerialException
+
+from ino.exc import Abort
+from ino.utils import monotonic
+
+
+class Connection(object):
+    """
+    A serial port watched by Monitor. Every chunk read from it is passed to
+    `handlers` as `handler(data, timestamp)` where timestamp is the
+    monotonic time of the read. That is the hook for scripting, capturing
+    and decoding.
+
+    If `prefix` is set, output of the port is shown line by line with the
+    prefix, so that output of several ports could be told apart.
+    """
+
+    def __init__(self, port, baudrate, prefix=None):
+        self.port = port
+        self.baudrate = int(baudrate)
+        self.prefix = prefix
+        self.handlers = []
+        self.serial = None
+        self.bytes_read = 0
+        self.line = ''
+        self.line_since = None
+        self.reopen_at = None
+
+    def open(self):
+        try:
+            self.serial = Serial(self.port, self.baudrate, timeout=0)
+        except (SerialException, ValueError) as e:
+            raise Abort("Can't open %s: %s" % (self.port, e))
+
+    def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    @property
+    def is_open(self):
+        return self.serial is not None
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def send(self, data):
+        self.serial.write(data)
+
+    def format(self, data, timestamp, max_age, force=False):
+        """
+        Return `data` as it should be shown. With prefix only complete
+        lines are returned, the rest is kept until a line end comes, it
+        is older than `max_age` seconds or `force` is True.
+        """
+        if not self.prefix:
+            return data
+
+        text = self.line + data
+        end = text.rfind('\n') + 1
+        self.line = text[end:]
+        if end or self.line_since is None:
+            self.line_since = timestamp if self.line else None
+
+        if self.line and (force or timestamp - self.line_since >= max_age):
+            text += '\n'
+            end = len(text)
+            self.line = ''
+            self.line_since = None
+
+        return ''.join('%s%s\n' % (self.prefix, line)
+                       for line in text[:end].splitlines())
+
+
+class Monitor(object):
+    """
+    Serial monitor pumping data between one or more devices and a terminal
+    in a single select() loop.
+
+    Devices are read in chunks as large as the kernel has buffered, so
+    1-2 Mbaud streams are kept up with. Terminal writes are batched: output
+    is flushed when `flush_size` bytes are pending or `flush_interval`
+    seconds have passed since the oldest pending byte was read.
+
+    A port that goes away is closed. With `reconnect` the monitor tries to
+    open it again every `reconnect_interval` seconds, otherwise it keeps on
+    with the rest of the ports and stops when none are left.
+
+    If `input` is a terminal it is switched to raw mode and keys are sent
+    to every device, Ctrl+A Ctrl+X stops the monitor and Ctrl+A Ctrl+A
+    sends Ctrl+A. Any other `input` is sent as is until its end. `output`
+    may be None to run without terminal output.
+    """
+
+    read_size = 1 << 16
+    flush_size = 1 << 16
+    flush_interval = 0.05
+    reconnect_interval = 1.0
+
+    escape_key = '\x01'     # Ctrl+A
+    exit_key = '\x18'       # Ctrl+X
+
+    def __init__(self, input=None, output=None, reconnect=False):
+        self.input = input
+        self.output = output
+        self.reconnect = reconnect
+        self.connections = []
+        self.disconnected = []
+        self.running = False
+        self.escaped = False
+        self.pending = []
+        self.pending_size = 0
+        self.pending_since = None
+
+    def add(self, port, baudrate, prefix=None):
+        connection = Connection(port, baudrate, prefix)
+        self.connections.append(connection)
+        return connection
+
+    def open(self):
+        """
+        Open all ports. If there are several of them, ports that fail to
+        open are skipped or, with `reconnect`, retried later.
+        """
+        for connection in self.connections:
+            if connection.is_open:
+                continue
+            try:
+                connection.open()
+            except Abort as e:
+                if len(self.connections) == 1 and not self.reconnect:
+                    raise
+                self.notice(str(e))
+                self.lost(connection, monotonic())
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+    def send(self, data):
+        """
+        Write `data` to every open device.
+        """
+        for connection in self.connections:
+            if connection.is_open:
+                connection.send(data)
+
+    def stop(self):
+        """
+        Make the loop exit. Safe to call from handlers and signal handlers.
+        """
+        self.running = False
+
+    def notice(self, message):
+        if self.output is not None:
+            self.pending.append('\n*** %s\n' % message)
+            self.pending_size += len(self.pending[-1])
+            self.flush()
+
+    def lost(self, connection, now):
+        connection.close()
+        if self.reconnect:
+            connection.reopen_at = now + self.reconnect_interval
+        else:
+            self.disconnected.append(connection.port)
+            if not any(c.is_open for c in self.connections):
+                self.stop()
+
+    @contextmanager
+    def terminal_mode(self):
+        """
+        Switch input terminal to raw mode for the duration of the block.
+        Output processing is kept, so line ends are shown properly.
+        """
+        if self.input is None or not self.input.isatty():
+            yield
+            return
+
+        fd = self.input.fileno()
+        original = termios.tcgetattr(fd)
+        mode = termios.tcgetattr(fd)
+        mode[0] &= ~(termios.IXON | termios.ICRNL | termios.INLCR | termios.ISTRIP)
+        mode[3] &= ~(termios.ICANON | termios.ECHO | termios.ISIG | termios.IEXTEN)
+        mode[6][termios.VMIN] = 1
+        mode[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, mode)
+        try:
+            yield
+        finally:
+            termios.tcsetattr(fd, termios.TCSAFLUSH, original)
+
+    def run(self, duration=None):
+        """
+        Pump data until stopped, devices go away or `duration` seconds
+        have passed.
+        """
+        self.open()
+
+        input_fd = self.input.fileno() if self.input is not None else None
+        deadline = monotonic() + duration if duration else None
+        self.running = bool(self.reconnect or any(c.is_open for c in self.connections))
+        try:
+            with self.terminal_mode():
+                while self.running:
+                    by_fd = dict((c.fileno(), c) for c in self.connections if c.is_open)
+                    rlist = by_fd.keys()
+                    if input_fd is not None:
+                        rlist.append(input_fd)
+
+                    try:
+                        ready, _, _ = select.select(rlist, [], [], self.timeout(deadline))
+                    except select.error as e:
+                        if e.args[0] == errno.EINTR:
+                            continue
+                        raise
+
+                    now = monotonic()
+                    for fd in ready:
+                        if fd in by_fd:
+                            self.read_device(by_fd[fd], now)
+                    if input_fd in ready and not self.read_input(input_fd):
+                        input_fd = None
+
+                    self.reopen(now)
+                    self.flush_lines(now)
+                    if self.pending_since is not None and \
+                       (self.pending_size >= self.flush_size or
+                        now - self.pending_since >= self.flush_interval):
+                        self.flush()
+                    if deadline is not None and now >= deadline:
+                        break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            self.flush_lines(monotonic(), force=True)
+            self.flush()
+            self.close()
+
+    def timeout(self, deadline):
+        now = monotonic()
+        timeouts = [c.reopen_at - now for c in self.connections if c.reopen_at is not None]
+        timeouts.extend(c.line_since + self.flush_interval - now
+                        for c in self.connections if c.line_since is not None)
+        if self.pending_since is not None:
+            timeouts.append(self.pending_since + self.flush_interval - now)
+        if deadline is not None:
+            timeouts.append(deadline - now)
+        return max(0, min(timeouts)) if timeouts else None
+
+    def reopen(self, now):
+        for connection in self.connections:
+            if connection.reopen_at is None or connection.reopen_at > now:
+                continue
+            connection.reopen_at = None
+            if not os.path.exists(connection.port):
+                connection.reopen_at = now + self.reconnect_interval
+                continue
+            try:
+                connection.open()
+                self.notice('%s is connected' % connection.port)
+            except Abort:
+                connection.reopen_at = now + self.reconnect_interval
+
+    def read_device(self, connection, timestamp):
+        try:
+            data = os.read(connection.fileno(), self.read_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+
+        if not data:
+            # select reports a gone device as readable with nothing to read
+            self.emit(connection, connection.format('', timestamp, 0, force=True), timestamp)
+            self.notice('%s is disconnected' % connection.port)
+            self.lost(connection, timestamp)
+            return
+
+        connection.bytes_read += len(data)
+        for handler in connection.handlers:
+            handler(data, timestamp)
+
+        self.emit(connection, connection.format(data, timestamp, self.flush_interval), timestamp)
+
+    def flush_lines(self, now, force=False):
+        # partial lines of prefixed ports are shown if nothing follows soon
+        for connection in self.connections:
+            if connection.line:
+                self.emit(connection, connection.format('', now, self.flush_interval, force), now)
+
+    def emit(self, connection, text, timestamp):
+        if self.output is None or not text:
+            return
+        if self.pending_since is None:
+            self.pending_since = timestamp
+        self.pending.append(text)
+        self.pending_size += len(text)
+
+    def read_input(self, fd):
+        """
+        Send input to devices. Return False when the input is over.
+        """
+        data = os.read(fd, 1024)
+        if not data:
+            return False
+        if not self.input.isatty():
+            self.send(data)
+            return True
+
+        out = []
+        for key in data:
+            if self.escaped:
+                self.escaped = False
+                if key == self.exit_key:
+                    self.stop()
+                    break
+                if key == self.escape_key:
+                    out.append(key)
+            elif key == self.escape_key:
+                self.escaped = True
+            else:
+                out.append(key)
+        if out:
+            self.send(''.join(out))
+        return True
+
+    def flush(self):
+        if self.pending and self.output is not None:
+            data = ''.join(self.pending)
+            fd = self.output.fileno()
+            while data:
+                try:
+                    written = os.write(fd, data)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                data = data[written:]
+        self.pending = []
+        self.pending_size = 0
+        self.pending_since = None
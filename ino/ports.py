@@ -0,0 +1,337 @@
+# -*- coding: utf-8; -*-
+
+import os
+import os.path
+import platform
+import errno
+import fcntl
+import select
+import struct
+import termios
+import json
+import ctypes
+import threading
+
+from collections import namedtuple
+from time import sleep
+
+from ino.utils import monotonic, load_library
+
+
+class UsbInfo(namedtuple('UsbInfo', 'vid pid serial location')):
+    """
+    USB attributes of a device behind a serial port. `vid` and `pid` are
+    lowercase hex strings without a prefix, e.g. '2341'. `serial` is None
+    if the device has no serial number. `location` identifies a physical
+    USB port the device is plugged in, e.g. '1-1.2'. It stays the same when
+    a board re-enumerates into bootloader with another PID.
+    """
+
+
+sysfs_tty_dir = '/sys/class/tty'
+
+
+def _read_attr(dirname, attr):
+    try:
+        with open(os.path.join(dirname, attr)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def usb_info(port):
+    """
+    Return UsbInfo for a serial `port` or None if it is not a USB device or
+    attributes can't be found.
+
+    On Linux attributes are read from sysfs. `port` could be a symlink like
+    /dev/serial/by-id/usb-Arduino...
+    """
+    if platform.system() == 'Linux':
+        return _sysfs_usb_info(port)
+    return _pyserial_usb_info(port)
+
+
+def _sysfs_usb_info(port):
+    name = os.path.basename(os.path.realpath(port))
+    device = os.path.join(sysfs_tty_dir, name, 'device')
+    if not os.path.exists(device):
+        return None
+
+    # `device` points to a USB interface (ttyACM*) or to a child of it
+    # (ttyUSB*); walk up to the USB device directory that has idVendor
+    dirname = os.path.realpath(device)
+    for _ in range(4):
+        vid = _read_attr(dirname, 'idVendor')
+        if vid:
+            return UsbInfo(vid.lower(), 
+                           (_read_attr(dirname, 'idProduct') or '').lower(),
+                           _read_attr(dirname, 'serial'),
+                           os.path.basename(dirname))
+        dirname = os.path.dirname(dirname)
+    return None
+
+
+def _pyserial_usb_info(port):
+    try:
+        from serial.tools.list_ports import comports
+    except ImportError:
+        return None
+
+    for info in comports():
+        # the port is the first item of tuples older pyserial yields as
+        # well, they have no USB attributes though
+        if info[0] == port and getattr(info, 'vid', None) is not None:
+            return UsbInfo('%04x' % info.vid, '%04x' % info.pid,
+                           info.serial_number, getattr(info, 'location', None))
+    return None
+
+
+class UsbInfoCache(object):
+    """
+    Persistent cache of UsbInfo by serial port.
+
+    An entry stays valid as long as the device node is the same one. When a
+    board is unplugged and plugged back its node is created anew and gets
+    another inode and ctime, so the entry is invalidated.
+    """
+
+    default_path = '~/.ino/ports.json'
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or self.default_path)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.records = {}
+        try:
+            with open(self.path) as f:
+                self.records = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def _node(self, port):
+        st = os.stat(port)
+        return [st.st_rdev, st.st_ino, st.st_ctime]
+
+    def get(self, port):
+        """
+        Return UsbInfo for `port` or None, see `usb_info`.
+        """
+        try:
+            node = self._node(port)
+        except OSError:
+            return None
+
+        with self.lock:
+            record = self.records.get(port)
+            if record and record['node'] == node:
+                return UsbInfo(*record['info']) if record['info'] else None
+
+        info = usb_info(port)
+        with self.lock:
+            self.records[port] = {'node': node, 'info': list(info) if info else None}
+            self.dirty = True
+        return info
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            # forget unplugged devices
+            for port in self.records.keys():
+                if not os.path.exists(port):
+                    del self.records[port]
+
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.records, f)
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+
+
+def _hex_id(s):
+    return '%04x' % int(s, 16)
+
+
+def board_usb_ids(board):
+    """
+    Return a set of (vid, pid) pairs a `board` model is known to have. IDs
+    are taken from `build.vid`/`build.pid` and `vid.N`/`pid.N` entries of
+    boards.txt. Empty set is returned for boards without IDs, e.g. ones
+    with generic USB-to-serial chips.
+    """
+    ids = set()
+    build = board.get('build', {})
+    if 'vid' in build and 'pid' in build:
+        ids.add((_hex_id(build['vid']), _hex_id(build['pid'])))
+
+    vids, pids = board.get('vid', {}), board.get('pid', {})
+    if isinstance(vids, dict) and isinstance(pids, dict):
+        for n, vid in vids.iteritems():
+            if n in pids:
+                ids.add((_hex_id(vid), _hex_id(pids[n])))
+    return ids
+
+
+def _open_tty(port):
+    # O_NONBLOCK so that open doesn't wait for carrier detect
+    return os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+
+
+def set_hupcl(port):
+    """
+    Make the tty drop DTR (send a hangup) when the last process closes it.
+    The same as `stty hupcl` but without spawning a process.
+    """
+    fd = _open_tty(port)
+    try:
+        attrs = termios.tcgetattr(fd)
+        if not attrs[2] & termios.HUPCL:
+            attrs[2] |= termios.HUPCL
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    finally:
+        os.close(fd)
+
+
+def _set_modem_bits(fd, request, bits):
+    try:
+        fcntl.ioctl(fd, request, struct.pack('I', bits))
+    except IOError as e:
+        # pseudo terminals have no modem control lines, they
+        # are used to emulate devices so don't fail on them
+        if e.errno not in (errno.ENOTTY, errno.EINVAL):
+            raise
+
+
+def pulse_dtr(port, duration=0.1):
+    """
+    Pull DTR (and RTS) low for `duration` seconds and release it. On
+    Arduino boards DTR is wired to RESET through a capacitor.
+    """
+    bits = termios.TIOCM_DTR | termios.TIOCM_RTS
+    fd = _open_tty(port)
+    try:
+        _set_modem_bits(fd, termios.TIOCMBIC, bits)
+        sleep(duration)
+        _set_modem_bits(fd, termios.TIOCMBIS, bits)
+    finally:
+        os.close(fd)
+
+
+def touch(port, baudrate=1200):
+    """
+    Open and close `port` at `baudrate`. Boards like Leonardo reset into
+    bootloader when the port opened at 1200 bps gets closed.
+    """
+    speed = getattr(termios, 'B%d' % baudrate)
+    fd = _open_tty(port)
+    try:
+        attrs = termios.tcgetattr(fd)
+        attrs[4] = attrs[5] = speed
+        attrs[2] |= termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    finally:
+        os.close(fd)
+
+
+class DevWatcher(object):
+    """
+    Wait for entries to be created, removed or changed in directories
+    (/dev by default) with Linux inotify. Raise OSError on construction if
+    inotify isn't available.
+    """
+
+    IN_ATTRIB = 0x004
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = os.O_NONBLOCK
+
+    def __init__(self, dirnames=('/dev',)):
+        if platform.system() != 'Linux':
+            raise OSError(errno.ENOSYS, 'inotify is available on Linux only')
+
+        libc = load_library('c', 'libc.so.6')
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        mask = self.IN_CREATE | self.IN_DELETE | self.IN_ATTRIB | self.IN_MOVED_TO
+        for dirname in dirnames:
+            if libc.inotify_add_watch(self.fd, dirname, mask) < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, os.strerror(err))
+
+    def wait(self, timeout):
+        """
+        Wait for changes at most `timeout` seconds. Return True if any.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+
+        # drain pending events, their details are not interesting
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def wait_for_new_port(list_ports, before, timeout=10, location=None, poll_interval=0.05,
+                      dirnames=('/dev',)):
+    """
+    Wait for a serial port that is not in `before` to appear and return it.
+    `list_ports` is a function returning currently available ports. If
+    `location` is given, only a port of USB device at that location
+    is accepted. Return None if nothing appears within `timeout` seconds.
+
+    Changes in `dirnames` ports appear in are watched with inotify where
+    available, otherwise ports are polled every `poll_interval` seconds.
+    """
+    try:
+        watcher = DevWatcher(dirnames)
+    except OSError:
+        watcher = None
+
+    before = set(before)
+    deadline = monotonic() + timeout
+    try:
+        while True:
+            now = list_ports()
+            for port in now:
+                if port in before:
+                    continue
+                if location and getattr(usb_info(port), 'location', None) != location:
+                    # a port of another board that re-enumerates
+                    continue
+                if not os.access(port, os.R_OK | os.W_OK):
+                    # udev hasn't set permissions yet
+                    continue
+                return port
+
+            # forget ports that disappeared so that a port
+            # reappearing under the same name is noticed
+            before &= set(now)
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            if watcher:
+                watcher.wait(remaining)
+            else:
+                sleep(min(poll_interval, remaining))
+    finally:
+        if watcher:
+            watcher.close()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8; -*-
+
+from __future__ import absolute_import
+
+import struct
+
+from serial import Serial
+from serial.serialutil import SerialException
+
+from ino.exc import Abort
+
+
+class ProgrammerError(Abort):
+    pass
+
+
+# Flash page size in bytes and signature of MCUs programmers know about
+mcus = {
+    'atmega8':      (64,  '\x1e\x93\x07'),
+    'atmega168':    (128, '\x1e\x94\x06'),
+    'atmega168p':   (128, '\x1e\x94\x0b'),
+    'atmega328':    (128, '\x1e\x95\x14'),
+    'atmega328p':   (128, '\x1e\x95\x0f'),
+    'atmega32u4':   (128, '\x1e\x95\x87'),
+    'atmega644p':   (256, '\x1e\x96\x0a'),
+    'atmega1280':   (256, '\x1e\x97\x03'),
+    'atmega1284p':  (256, '\x1e\x97\x05'),
+    'atmega2560':   (256, '\x1e\x98\x01'),
+}
+
+
+def page_size(mcu):
+    """
+    Return flash page size of `mcu` or None if it is unknown.
+    """
+    try:
+        return mcus[mcu][0]
+    except KeyError:
+        return None
+
+
+class Programmer(object):
+    """
+    Base class for programmers talking to a bootloader over a serial port.
+
+    Commands are pipelined: up to `window` transactions are sent ahead
+    before waiting for replies, so a slow round trip over USB is not paid
+    for every flash page.
+    """
+
+    protocols = ()
+    window = 1
+    sync_attempts = 10
+
+    def __init__(self, port, baudrate, mcu, timeout=1.0):
+        self.port = port
+        self.baudrate = int(baudrate)
+        self.mcu = mcu
+        self.page_size, self.signature = mcus[mcu]
+        self.timeout = timeout
+        self.serial = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close(leave=exc_info[0] is None)
+
+    def open(self):
+        try:
+            self.serial = Serial(self.port, self.baudrate, timeout=self.timeout)
+        except SerialException as e:
+            raise ProgrammerError(str(e))
+
+        try:
+            self.sync()
+            self.enter()
+            signature = self.read_signature()
+            if signature != self.signature:
+                raise ProgrammerError("Device signature %s doesn't match %s" %
+                                      (signature.encode('hex'), self.mcu))
+        except:
+            self.close(leave=False)
+            raise
+
+    def close(self, leave=True):
+        if self.serial is None:
+            return
+        try:
+            if leave:
+                self.leave()
+        finally:
+            self.serial.close()
+            self.serial = None
+
+    def read(self, size):
+        data = self.serial.read(size)
+        if len(data) != size:
+            raise ProgrammerError("Timeout while waiting for %s bootloader on %s" %
+                                  (self.protocols[0], self.port))
+        return data
+
+    def transact(self, request, reply_size):
+        self.serial.write(request)
+        return self.read(reply_size)
+
+    def pipeline(self, transactions):
+        """
+        Perform (request, reply_size) `transactions` keeping at most
+        `window` of them in flight. Return a list of parsed replies.
+        """
+        replies = []
+        in_flight = []
+        for request, reply_size in transactions:
+            if len(in_flight) >= self.window:
+                sent, size = in_flight.pop(0)
+                replies.append(self.parse_reply(sent, self.read(size)))
+            self.serial.write(request)
+            in_flight.append((request, reply_size))
+        for sent, size in in_flight:
+            replies.append(self.parse_reply(sent, self.read(size)))
+        return replies
+
+    def write(self, pages):
+        """
+        Write (address, data) `pages` to flash. Addresses must be page
+        aligned and data must be exactly one page long.
+        """
+        self.pipeline(self.write_page_request(address, data) for address, data in pages)
+
+    def read_pages(self, addresses):
+        """
+        Read flash pages at `addresses`. Return a list of page contents.
+        """
+        return self.pipeline(self.read_page_request(address) for address in addresses)
+
+    def verify(self, pages):
+        """
+        Return a list of addresses of (address, data) `pages` which don't
+        match device flash.
+        """
+        pages = list(pages)
+        actual = self.read_pages(address for address, _ in pages)
+        return [address for (address, data), contents in zip(pages, actual)
+                if contents != str(data)]
+
+    def sync(self):
+        raise NotImplementedError
+
+    def enter(self):
+        raise NotImplementedError
+
+    def leave(self):
+        raise NotImplementedError
+
+    def read_signature(self):
+        raise NotImplementedError
+
+    def write_page_request(self, address, data):
+        raise NotImplementedError
+
+    def read_page_request(self, address):
+        raise NotImplementedError
+
+    def parse_reply(self, request, reply):
+        raise NotImplementedError
+
+
+class Stk500v1(Programmer):
+    """
+    STK500 version 1 protocol spoken by Optiboot and ATmegaBOOT found on
+    Uno, Duemilanove, Nano, Mini and others.
+
+    The bootloader doesn't read the UART while a page is being written
+    and the UART buffer is tiny, so only one load-address and program-page
+    pair is in flight at a time. Both are sent in a single write though.
+    """
+
+    protocols = ('arduino', 'stk500v1')
+
+    STK_OK = '\x10'
+    STK_INSYNC = '\x14'
+    CRC_EOP = '\x20'
+    GET_SYNC = '\x30'
+    ENTER_PROGMODE = '\x50'
+    LEAVE_PROGMODE = '\x51'
+    LOAD_ADDRESS = '\x55'
+    PROG_PAGE = '\x64'
+    READ_PAGE = '\x74'
+    READ_SIGN = '\x75'
+
+    def parse_reply(self, request, reply):
+        # pipelined transactions are load-address followed by another
+        # command, each reply is INSYNC [data] OK
+        if reply[:2] != self.STK_INSYNC + self.STK_OK:
+            raise ProgrammerError("Not in sync with bootloader on %s" % self.port)
+        return self._unwrap(reply[2:])
+
+    def _unwrap(self, reply):
+        if reply[:1] != self.STK_INSYNC:
+            raise ProgrammerError("Not in sync with bootloader on %s" % self.port)
+        if reply[-1:] != self.STK_OK:
+            raise ProgrammerError("Bootloader on %s didn't confirm a command" % self.port)
+        return reply[1:-1]
+
+    def command(self, cmd, reply_size=0):
+        self.serial.write(cmd + self.CRC_EOP)
+        return self._unwrap(self.read(reply_size + 2))
+
+    def sync(self):
+        original_timeout = self.serial.timeout
+        self.serial.timeout = 0.2
+        try:
+            for _ in range(self.sync_attempts):
+                self.serial.reset_input_buffer()
+                self.serial.write(self.GET_SYNC + self.CRC_EOP)
+                if self.serial.read(2) == self.STK_INSYNC + self.STK_OK:
+                    self.serial.reset_input_buffer()
+                    return
+        finally:
+            self.serial.timeout = original_timeout
+        raise ProgrammerError("Can't get in sync with bootloader on %s" % self.port)
+
+    def enter(self):
+        self.command(self.ENTER_PROGMODE)
+
+    def leave(self):
+        self.command(self.LEAVE_PROGMODE)
+
+    def read_signature(self):
+        return self.command(self.READ_SIGN, 3)
+
+    def _load_address(self, address):
+        # flash is addressed by 16-bit words
+        return self.LOAD_ADDRESS + struct.pack('<H', address >> 1) + self.CRC_EOP
+
+    def write_page_request(self, address, data):
+        request = self._load_address(address) + \
+                  self.PROG_PAGE + struct.pack('>H', len(data)) + 'F' + \
+                  str(data) + self.CRC_EOP
+        return request, 4
+
+    def read_page_request(self, address):
+        request = self._load_address(address) + \
+                  self.READ_PAGE + struct.pack('>H', self.page_size) + 'F' + \
+                  self.CRC_EOP
+        return request, 4 + self.page_size
+
+
+class Avr109(Programmer):
+    """
+    AVR109 (butterfly) protocol spoken by Caterina bootloader of Leonardo,
+    Micro and other ATmega32u4 boards.
+
+    The bootloader talks over USB CDC which has flow control, so several
+    pages are sent ahead without waiting for replies.
+    """
+
+    protocols = ('avr109',)
+    window = 8
+
+    CR = '\r'
+
+    def parse_reply(self, request, reply):
+        # pipelined transactions are set-address confirmed with CR
+        # followed by a block write confirmed with CR or a block read,
+        # a failed command is answered with '?' instead of CR
+        confirmations = 2 if request[3:4] == 'B' else 1
+        if reply[:confirmations] != self.CR * confirmations:
+            raise ProgrammerError("Bootloader on %s didn't confirm a command" % self.port)
+        return reply[confirmations:]
+
+    def sync(self):
+        self.serial.reset_input_buffer()
+        for _ in range(self.sync_attempts):
+            self.serial.write('S')
+            software_id = self.serial.read(7)
+            if len(software_id) == 7:
+                return
+        raise ProgrammerError("Can't get in sync with bootloader on %s" % self.port)
+
+    def enter(self):
+        if self.transact('P', 1) != self.CR:
+            raise ProgrammerError("Bootloader on %s refused to enter programming mode" % self.port)
+
+    def leave(self):
+        self.transact('L', 1)
+        self.transact('E', 1)
+
+    def read_signature(self):
+        # signature bytes come in reverse order
+        return self.transact('s', 3)[::-1]
+
+    def _set_address(self, address):
+        return 'A' + struct.pack('>H', address >> 1)
+
+    def write_page_request(self, address, data):
+        request = self._set_address(address) + \
+                  'B' + struct.pack('>H', len(data)) + 'F' + str(data)
+        return request, 2
+
+    def read_page_request(self, address):
+        request = self._set_address(address) + \
+                  'g' + struct.pack('>H', self.page_size) + 'F'
+        return request, 1 + self.page_size
+
+
+programmers = [Stk500v1, Avr109]
+
+
+def find_programmer(protocol, mcu):
+    """
+    Return a Programmer subclass for `protocol` or None if there is no
+    native programmer for the protocol or `mcu` is unknown.
+    """
+    if mcu not in mcus:
+        return None
+    for cls in programmers:
+        if protocol in cls.protocols:
+            return cls
+    return None
@@ -19,6 +19,8 @@ import sys
 import os.path
 import argparse
 import inspect
+import cProfile
+import pstats
 
 import ino.commands
 
@@ -28,6 +30,27 @@ from ino.exc import Abort
 from ino.filters import colorize
 from ino.environment import Environment
 from ino.argparsing import FlexiFormatter
+from ino.utils import counters
+
+
+def run_profiled(func, args, path):
+    """
+    Run `func(args)` under cProfile. Print counters and the profile sorted
+    by cumulative time to stderr, or save the profile to `path` for pstats.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(func, args)
+    finally:
+        if counters.counts:
+            print >>sys.stderr, colorize('Counters:', 'cyan')
+            print >>sys.stderr, counters.format()
+        if path == '-':
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(30)
+        else:
+            profiler.dump_stats(path)
+            print >>sys.stderr, 'Profile is written to %s, view it with `python -m pstats %s\'' % (path, path)
 
 
 def main():
@@ -36,12 +59,21 @@ def main():
 
     conf = configure()
 
-    try:
-        current_command = sys.argv[1]
-    except IndexError:
-        current_command = None
+    argv = sys.argv[1:]
+    commands_args = [arg for arg in argv if not arg.startswith('-')]
+    current_command = commands_args[0] if commands_args else None
+
+    # `--profile' takes an optional value, so tell it from a subcommand.
+    # Arguments after the subcommand are its own and are left as is
+    n = argv.index(current_command) if current_command else len(argv)
+    argv = ['--profile=-' if arg == '--profile' else arg for arg in argv[:n]] + argv[n:]
 
     parser = argparse.ArgumentParser(prog='ino', formatter_class=FlexiFormatter, description=__doc__)
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='-',
+                        help='Profile the command. Print counters of searches, '
+                        'globs, stats and subprocesses along with functions '
+                        'taking most time. If FILE is given as --profile=FILE '
+                        'the profile is saved to it for pstats.')
     subparsers = parser.add_subparsers()
     is_command = lambda x: inspect.isclass(x) and issubclass(x, Command) and x != Command
     commands = [cls(e) for _, cls in inspect.getmembers(ino.commands, is_command)]
@@ -52,18 +84,19 @@ def main():
         cmd.setup_arg_parser(p)
         p.set_defaults(func=cmd.run, **conf.as_dict(cmd.name))
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     try:
-        run_anywhere = "init clean list-models serial"
+        run_anywhere = "init clean list-models serial cache-server"
 
         in_project_dir = os.path.isdir(e.src_dir)
-        if not in_project_dir and current_command not in run_anywhere:
+        in_workspace = bool(getattr(args, 'workspace', None))
+        if not in_project_dir and not in_workspace and current_command not in run_anywhere:
             raise Abort("No project found in this directory.")
 
         e.process_args(args)
 
-        if current_command not in run_anywhere:
+        if current_command not in run_anywhere and not in_workspace:
             # For valid projects create .build & lib
             if not os.path.isdir(e.build_dir):                
                 os.makedirs(e.build_dir)
@@ -73,7 +106,10 @@ def main():
                 with open('lib/.holder', 'w') as f:
                     f.write("")
 
-        args.func(args)
+        if args.profile:
+            run_profiled(args.func, args, args.profile)
+        else:
+            args.func(args)
     except Abort as exc:
         print colorize(str(exc), 'red')
         sys.exit(1)
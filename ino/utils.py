@@ -2,18 +2,21 @@
 
 import os.path
 import itertools
+import hashlib
+import time
+import ctypes
+import ctypes.util
+import threading
+import subprocess
 
-
-try:
-    from collections import OrderedDict
-except ImportError:
-    # Python < 2.7
-    from ordereddict import OrderedDict
+from contextlib import contextmanager
 
 
 class SpaceList(list):
     def __add__(self, other):
-        return SpaceList(super(SpaceList, self).__add__(other))
+        result = SpaceList(self)
+        result.extend(other)
+        return result
 
     def __str__(self):
         return ' '.join(map(str, self))
@@ -22,7 +25,42 @@ class SpaceList(list):
         return SpaceList(getattr(x, 'path', x) for x in self)
 
 
-class FileMap(OrderedDict):
+class FileMap(object):
+    """
+    Ordered mapping of source files to target files with a read-only dict
+    interface. Sources are distinct objects, so pairs are kept in a plain
+    list rather than a much heavier OrderedDict.
+    """
+
+    __slots__ = ('pairs',)
+
+    def __init__(self, pairs=()):
+        self.pairs = list(pairs)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def items(self):
+        return self.pairs
+
+    def iteritems(self):
+        return iter(self.pairs)
+
+    def iterkeys(self):
+        return (source for source, _ in self.pairs)
+
+    def itervalues(self):
+        return (target for _, target in self.pairs)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
     def sources(self):
         return SpaceList(self.iterkeys())
 
@@ -30,16 +68,62 @@ class FileMap(OrderedDict):
         return SpaceList(self.itervalues())
 
     def iterpaths(self):
-        for source, target in self.iteritems():
+        for source, target in self.pairs:
             yield (source.path, target.path)
 
     def target_paths(self):
-        return SpaceList(x.path for x in self.targets())
+        return SpaceList(target.path for _, target in self.pairs)
+
+
+def load_library(name, soname):
+    """
+    Load a C library by its usual `soname`. ctypes.util.find_library spawns
+    ldconfig or gcc, so it is used only if the soname is not found.
+    """
+    try:
+        return ctypes.CDLL(soname, use_errno=True)
+    except OSError:
+        path = ctypes.util.find_library(name)
+        if not path:
+            raise
+        return ctypes.CDLL(path, use_errno=True)
+
+
+def _clock_gettime_monotonic():
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = load_library('rt', 'librt.so.1')
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+
+# Clock that never goes backwards, for measuring intervals
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2
+    try:
+        monotonic = _clock_gettime_monotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
 
 
 def list_subdirs(dirname, recursive=False, exclude=[]):
     entries = [e for e in os.listdir(dirname) if e not in exclude and not e.startswith('.')]
     paths = [os.path.join(dirname, e) for e in entries]
+    counters.count('listdir')
+    counters.count('stat', len(paths))
     dirs = filter(os.path.isdir, paths)
     if recursive:
         sub = itertools.chain.from_iterable(
@@ -48,6 +132,34 @@ def list_subdirs(dirname, recursive=False, exclude=[]):
     return dirs
 
 
+def file_digest(path):
+    """
+    Return hex SHA-1 digest of `path` contents or None if it doesn't exist.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def write_if_changed(path, contents):
+    """
+    Write `contents` to `path` unless the file already has exactly the same
+    contents. An untouched file keeps its mtime, so make doesn't consider
+    its dependents outdated. Return True if the file was written.
+    """
+    if file_digest(path) == hashlib.sha1(contents).hexdigest():
+        return False
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return True
+
+
 def format_available_options(items, head_width, head_color='cyan', 
                              default=None, default_mark="[DEFAULT]", 
                              default_mark_color='red'):
@@ -58,3 +170,87 @@ def format_available_options(items, head_width, head_color='cyan',
                            val) 
              for key, val in items]
     return '\n'.join(lines)
+
+
+class Timings(object):
+    """
+    Wall time spent in named phases. Time of a phase repeated or run in
+    several threads at once is summed up.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic() - started)
+
+    def add(self, name, seconds):
+        with self.lock:
+            if name not in self.totals:
+                self.names.append(name)
+                self.totals[name] = 0.0
+            self.totals[name] += seconds
+
+    def items(self):
+        return [(name, self.totals[name]) for name in self.names]
+
+    def format(self):
+        if not self.names:
+            return ''
+        items = [(name, '%8.1f ms' % (seconds * 1000)) for name, seconds in self.items()]
+        return format_available_options(items, head_width=max(len(n) for n in self.names))
+
+
+class Counters(object):
+    """
+    Counts of things ino does on hot paths: searches, directory listings,
+    stats and subprocesses. Counting is cheap and always on, `ino
+    --profile' prints the counts. Wall time is kept for counted phases.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.timings = Timings()
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    @contextmanager
+    def timed(self, name):
+        self.count(name)
+        with self.timings.phase(name):
+            yield
+
+    def reset(self):
+        self.__init__()
+
+    def format(self):
+        if not self.counts:
+            return ''
+        items = []
+        for name in sorted(self.counts):
+            value = '%8d' % self.counts[name]
+            if name in self.timings.totals:
+                value += '  %8.1f ms' % (self.timings.totals[name] * 1000)
+            items.append((name, value))
+        return format_available_options(items, head_width=max(len(n) for n in self.counts))
+
+
+counters = Counters()
+
+
+def call(args, **kwargs):
+    """
+    subprocess.call that is counted and timed in `counters` by tool name.
+    """
+    with counters.timed('subprocess ' + os.path.basename(args[0])):
+        return subprocess.call(args, **kwargs)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ino.builddb import BuildDB, Manifest, read_deps
+
+from tests.tempdir import TempDirTest
+
+
+class TestManifest(TempDirTest):
+    def setup(self):
+        super(TestManifest, self).setup()
+        self.source = self.path('a.cpp', 'int a;\n')
+        self.header = self.path('a.h', 'int b;\n')
+        self.obj = self.path('a.o', 'object')
+        self.lib = self.path('liba.a', 'archive')
+        self.deps = self.path('a.d', '%s: %s \\\n %s\n' % (self.obj, self.source, self.header))
+        # files older than the racy interval get their digests cached
+        for name in os.listdir(self.dir):
+            os.utime(self.path(name), (1000, 1000))
+        self.db = BuildDB(self.path('build.db'))
+        self.db.set_headers(self.source, [self.header])
+
+    def teardown(self):
+        self.db.close()
+        super(TestManifest, self).teardown()
+
+    def manifest(self, command='cc'):
+        manifest = Manifest()
+        manifest.add(self.lib, [self.obj], 'ar', update=True)
+        manifest.add(self.obj, [self.source], command, headers_of=self.source)
+        return manifest
+
+    def states(self, manifest):
+        by_state = manifest.prepare(self.db)
+        return dict((target, state) for state, targets in by_state.iteritems() for target in targets)
+
+    def test_read_deps(self):
+        assert_equal(read_deps(self.deps), [self.source, self.header])
+
+    def test_unrecorded_targets_rebuild(self):
+        assert_equal(self.states(self.manifest()), {self.lib: 'stale', self.obj: 'stale'})
+        assert_equal(os.path.getmtime(self.obj), 0)
+        # archives are updated in place, so a stale one is started anew
+        assert not os.path.exists(self.lib)
+
+    def test_touched_inputs_dont_rebuild(self):
+        self.manifest().record(self.db)
+        os.utime(self.source, (2000, 2000))
+        assert_equal(self.states(self.manifest()), {self.lib: 'fresh', self.obj: 'fresh'})
+        assert os.path.getmtime(self.obj) > 2000
+        assert os.path.getmtime(self.lib) > os.path.getmtime(self.obj)
+
+    def test_changed_header_rebuilds_object(self):
+        self.manifest().record(self.db)
+        self.path('a.h', 'int c;\n')
+        os.utime(self.header, (3000, 3000))
+        # the archive is left to make, it gets updated if the object
+        # is rebuilt and changes
+        assert_equal(self.states(self.manifest()), {self.lib: 'fresh', self.obj: 'stale'})
+        assert_equal(os.path.getmtime(self.obj), 0)
+        assert os.path.exists(self.lib)
+
+    def test_changed_command_rebuilds(self):
+        self.manifest().record(self.db)
+        assert_equal(self.states(self.manifest('cc -O2')), {self.lib: 'fresh', self.obj: 'stale'})
+
+    def test_changed_members_start_archive_anew(self):
+        self.manifest().record(self.db)
+        manifest = self.manifest()
+        manifest.add(self.lib, [self.obj, self.source], 'ar', update=True)
+        assert_equal(self.states(manifest), {self.lib: 'stale', self.obj: 'fresh'})
+        assert not os.path.exists(self.lib)
+
+    def test_recently_modified_inputs_rebuild_dependents_of_stale(self):
+        def manifest(command='cc'):
+            manifest = self.manifest(command)
+            manifest.add(self.lib, [self.obj, self.header], 'ar', update=True)
+            return manifest
+
+        manifest().record(self.db)
+        os.utime(self.header, None)
+        assert_equal(self.states(manifest()), {self.lib: 'fresh', self.obj: 'fresh'})
+        assert_equal(self.states(manifest('cc -O2')), {self.lib: 'stale', self.obj: 'stale'})
+
+    def test_signatures_persist(self):
+        self.manifest().record(self.db)
+        self.db.close()
+        self.db = BuildDB(self.path('build.db'))
+        assert_equal(self.states(self.manifest()), {self.lib: 'fresh', self.obj: 'fresh'})
+
+    def test_dependency_files_update_headers(self):
+        manifest = Manifest()
+        manifest.add_dependency_file(self.deps, self.source, 'cc -MM')
+        self.db.set_headers(self.source, [])
+        assert_equal(self.states(manifest), {self.deps: 'stale'})
+        manifest.record(self.db)
+        self.db.close()
+        self.db = BuildDB(self.path('build.db'))
+        assert_equal(self.db.headers(self.source), [self.header])
+
+    def test_relocated_signatures_dont_depend_on_directory(self):
+        def signature(dirname):
+            manifest = Manifest(path_map=[(dirname, '.')])
+            manifest.add('a.o', [os.path.join(dirname, 'a.cpp')], 'cc -ffile-prefix-map=%s=.' % dirname)
+            return manifest.signature(self.db, 'a.o', manifest.inputs(self.db, 'a.o'), {})
+
+        other = tempfile.mkdtemp()
+        try:
+            shutil.copy(self.source, other)
+            assert_equal(signature(self.dir), signature(other))
+        finally:
+            shutil.rmtree(other)
+
+    def test_timings_persist(self):
+        self.db.set_timing(self.obj, 2.5)
+        self.db.commit()
+        self.db.close()
+        self.db = BuildDB(self.path('build.db'))
+        assert_equal(self.db.timing(self.obj), 2.5)
+        assert_equal(self.db.timing(self.lib, 0), 0)
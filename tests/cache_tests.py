@@ -0,0 +1,103 @@
+# -*- coding: utf-8; -*-
+
+import os
+import threading
+
+from nose.tools import assert_equal
+
+from ino.builddb import BuildDB, Manifest
+from ino.cache import CacheHTTPServer, LocalCache, RemoteCache, copy_atomically, open_cache
+
+from tests.tempdir import TempDirTest
+
+
+class TestCache(TempDirTest):
+    def setup(self):
+        super(TestCache, self).setup()
+        self.root = os.path.join(self.dir, 'cache')
+        os.makedirs(self.root)
+        self.servers = []
+
+    def teardown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        super(TestCache, self).teardown()
+
+    def serve(self, read_only=False):
+        server = CacheHTTPServer(('127.0.0.1', 0), self.root, read_only=read_only)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    def test_put_and_get(self):
+        cache = RemoteCache(self.serve())
+        key = cache.key('signature')
+        assert not cache.get(key, self.path('fetched.o'))
+        cache.put(key, self.path('a.o', 'object'))
+        assert cache.get(key, self.path('build/fetched.o'))
+        assert_equal(open(self.path('build/fetched.o')).read(), 'object')
+        assert cache.enabled
+
+    def test_read_only(self):
+        url = self.serve(read_only=True)
+        cache = RemoteCache(url, read_only=True)
+        cache.put(cache.key('signature'), self.path('a.o', 'object'))
+        assert_equal(os.listdir(self.root), [])
+        assert cache.enabled
+
+        # refused uploads leave the cache enabled for reading
+        cache = RemoteCache(url)
+        cache.put(cache.key('signature'), self.path('a.o', 'object'))
+        assert cache.enabled
+        assert cache.read_only
+
+        with open(self.path('a.o')) as f:
+            copy_atomically(f, os.path.join(self.root, 'ab', 'ab' * 20))
+        assert cache.get('ab' * 20, self.path('fetched.o'))
+
+    def test_unreachable_cache_is_disabled(self):
+        server = CacheHTTPServer(('127.0.0.1', 0), self.root)
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        server.server_close()
+
+        cache = RemoteCache(url)
+        assert not cache.get(cache.key('signature'), self.path('fetched.o'))
+        assert not cache.enabled
+
+    def test_local_cache(self):
+        cache = open_cache(self.root)
+        assert isinstance(cache, LocalCache)
+        key = cache.key('signature')
+        assert not cache.get(key, self.path('fetched.o'))
+        cache.put(key, self.path('a.o', 'object'))
+        assert cache.get(key, self.path('build/fetched.o'))
+        assert_equal(open(self.path('build/fetched.o')).read(), 'object')
+
+    def test_keys_are_salted(self):
+        assert RemoteCache('', salt='gcc 4.3').key('a') != RemoteCache('', salt='gcc 4.8').key('a')
+
+    def test_manifest_fetches_stale_targets(self):
+        url = self.serve()
+        source = self.path('a.cpp', 'int a;\n')
+        obj = self.path('a.o')
+
+        # built on another machine
+        db = BuildDB(self.path('other.db'))
+        manifest = Manifest(RemoteCache(url))
+        manifest.add(obj, [source], 'cc')
+        self.path('a.o', 'object')
+        manifest.record(db)
+        db.close()
+        os.remove(obj)
+
+        db = BuildDB(self.path('build.db'))
+        try:
+            manifest = Manifest(RemoteCache(url))
+            manifest.add(obj, [source], 'cc')
+            assert_equal(manifest.prepare(db), {'stale': [], 'fresh': [obj]})
+            assert_equal(open(obj).read(), 'object')
+        finally:
+            db.close()
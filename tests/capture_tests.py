@@ -0,0 +1,89 @@
+# -*- coding: utf-8; -*-
+
+import os
+import gzip
+
+from nose.tools import assert_equal
+
+from ino.capture import Capture, TriggeredCapture, parse_size
+
+from tests.tempdir import TempDirTest
+
+
+def read_timestamps(path):
+    with open(path) as f:
+        lines = f.readlines()
+    assert lines[0].startswith('# start ')
+    return [(int(offset), float(timestamp)) for offset, timestamp in
+            (line.split() for line in lines[1:])]
+
+
+class TestCapture(TempDirTest):
+    def test_rotation_by_size(self):
+        capture = Capture(self.dir, max_size=10)
+        for i in range(5):
+            capture('%05d' % i, 100.0 + i)
+        capture.close()
+
+        assert_equal(len(capture.files), 3)
+        with open(capture.files[0], 'rb') as f:
+            assert_equal(f.read(), '0000000001')
+        ts_path = capture.files[1][:-len('.bin')] + '.ts'
+        assert_equal(read_timestamps(ts_path), [(0, 102.0), (5, 103.0)])
+
+    def test_compress(self):
+        capture = Capture(self.dir, compress=True)
+        capture('data', 1.0)
+        capture.close()
+        assert_equal(gzip.open(capture.files[0]).read(), 'data')
+
+    def test_trigger_window(self):
+        capture = TriggeredCapture(self.dir, 'ERR', window=2)
+        for t, data in enumerate(['a', 'b', 'c', 'xxE', 'RRx', 'd', 'e', 'f', 'g']):
+            capture(data, float(t))
+        capture.close()
+
+        assert_equal(capture.triggers, 1)
+        assert_equal(len(capture.files), 1)
+        with open(capture.files[0], 'rb') as f:
+            assert_equal(f.read(), 'cxxERRxde')
+
+    def test_trigger_recording_rotates(self):
+        capture = TriggeredCapture(self.dir, 'ERR', window=10, max_size=4)
+        for t, data in enumerate(['ERR', 'ab', 'cd', 'ef']):
+            capture(data, float(t))
+        capture.close()
+
+        contents = [open(path, 'rb').read() for path in capture.files]
+        assert_equal(contents, ['ERRab', 'cdef'])
+
+    def test_trigger_ring_is_bounded_by_size(self):
+        capture = TriggeredCapture(self.dir, 'ERR', window=100, ring_size=6)
+        for t, data in enumerate(['aaa', 'bbb', 'ccc', 'ERR']):
+            capture(data, float(t))
+        assert_equal(capture.ring_bytes, 0)
+        capture.close()
+
+        with open(capture.files[0], 'rb') as f:
+            assert_equal(f.read(), 'cccERR')
+
+    def test_triggers_on_two_ports(self):
+        captures = [TriggeredCapture(self.dir, 'ERR', window=1, prefix=prefix)
+                    for prefix in ('ttyACM0', 'ttyACM1')]
+        for capture in captures:
+            capture('ERR ' + capture.prefix, 1.0)
+        for capture in captures:
+            capture.close()
+
+        names = [os.path.basename(capture.files[0]) for capture in captures]
+        assert names[0].startswith('ttyACM0-trigger-')
+        assert names[1].startswith('ttyACM1-trigger-')
+        for capture in captures:
+            with open(capture.files[0], 'rb') as f:
+                assert_equal(f.read(), 'ERR ' + capture.prefix)
+
+
+def test_parse_size():
+    assert_equal(parse_size('100'), 100)
+    assert_equal(parse_size('4k'), 4096)
+    assert_equal(parse_size('2M'), 2 << 20)
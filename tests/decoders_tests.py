@@ -0,0 +1,68 @@
+# -*- coding: utf-8; -*-
+
+import ast
+import struct
+
+from nose.tools import assert_equal
+
+from ino.decoders import CsvDecoder, KeyValueDecoder, LengthPrefixedDecoder, \
+    CobsDecoder, NpyWriter, cobs_encode, cobs_decode, to_rows
+
+from tests.tempdir import TempDirTest
+
+
+def rows(batch):
+    return [tuple(row) for row in to_rows(batch)]
+
+
+def test_csv_lines_split_between_chunks():
+    decoder = CsvDecoder()
+    assert_equal(rows(decoder.decode('1,2\r\n3,')), [(1.0, 2.0)])
+    assert_equal(rows(decoder.decode('4\nbad,line\n5,6\n')), [(3.0, 4.0), (5.0, 6.0)])
+    assert_equal(decoder.fields, ['f0', 'f1'])
+    assert_equal(decoder.errors, 1)
+
+
+def test_key_value_lines():
+    decoder = KeyValueDecoder()
+    batch = rows(decoder.decode('t=1 v=2.5\nv=3,t=2\n'))
+    assert_equal(decoder.fields, ['t', 'v'])
+    assert_equal(batch, [(1.0, 2.5), (2.0, 3.0)])
+
+
+def test_length_prefixed_frames():
+    records = [(1, -2, 0.5), (3, 4, 1.5)]
+    stream = ''.join(struct.pack('<H', 8) + struct.pack('<Hhf', *r) for r in records)
+    decoder = LengthPrefixedDecoder('<Hhf', ['a', 'b', 'c'])
+    assert_equal(rows(decoder.decode(stream[:13])), records[:1])
+    assert_equal(rows(decoder.decode(stream[13:])), records[1:])
+
+
+def test_cobs_frames():
+    assert_equal(cobs_encode('\x11\x00\x00\x22'), '\x02\x11\x01\x02\x22')
+    assert_equal(cobs_decode(cobs_encode('a' * 300 + '\0b')), 'a' * 300 + '\0b')
+
+    records = [(0, 1), (256, 0)]
+    stream = ''.join(cobs_encode(struct.pack('<HH', *r)) + '\0' for r in records)
+    decoder = CobsDecoder('<HH')
+    assert_equal(rows(decoder.decode('\x05garbage\0' + stream)), records)
+    assert_equal(decoder.errors, 1)
+
+
+class TestNpyWriter(TempDirTest):
+    def test_write(self):
+        decoder = LengthPrefixedDecoder('<Hh')
+        batch = decoder.decode(struct.pack('<HHh', 4, 1, -1) + struct.pack('<HHh', 4, 2, -2))
+        path = self.path('records.npy')
+        writer = NpyWriter(path)
+        writer.write(batch, decoder)
+        writer.close()
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        assert data.startswith('\x93NUMPY\x01\x00')
+        header_size, = struct.unpack('<H', data[8:10])
+        header = ast.literal_eval(data[10:10 + header_size])
+        assert_equal(header['shape'], (2,))
+        assert_equal(header['descr'], [('f0', '<u2'), ('f1', '<i2')])
+        assert_equal(data[10 + header_size:], struct.pack('<HhHh', 1, -1, 2, -2))
@@ -1,8 +1,12 @@
 # -*- coding: utf-8; -*-
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 
-from ino.environment import Version
+from ino.environment import Environment, Version
+from ino.exc import Abort
+from ino.ports import UsbInfoCache
+
+from tests.fake_sysfs import SysfsTest
 
 
 class TestVersion(object):
@@ -18,3 +22,35 @@ class TestVersion(object):
         assert_equal(Version(1, 0, 0).as_int(), 100)
         assert_equal(Version(1, 0, 5).as_int(), 105)
         assert_equal(Version(1, 5, 1).as_int(), 151)
+
+
+class TestBoardSerialPorts(SysfsTest):
+    leonardo = {'name': 'Arduino Leonardo', 'build': {'vid': '0x2341', 'pid': '0x8036'},
+                'vid': {'0': '0x2341'}, 'pid': {'0': '0x0036'}}
+
+    def setup(self):
+        super(TestBoardSerialPorts, self).setup()
+        self.ports = []
+        self.env = Environment()
+        self.env.list_serial_ports = lambda: self.ports
+        self.env._usb_info_cache = UsbInfoCache(self.path('ports.json'))
+
+    def test_ports_by_usb_ids(self):
+        self.ports = [self.plug('ttyACM0', '2341', '8036', location='1-1'),
+                      self.plug('ttyACM1', '2341', '0043', location='1-2'),
+                      self.plug('ttyACM2', '2341', '0036', location='1-3'),
+                      self.plug('ttyUSB0', '0403', '6001', location='1-4')]
+        assert_equal(self.env.board_serial_ports(self.leonardo),
+                     [self.path('dev/ttyACM0'), self.path('dev/ttyACM2')])
+
+    def test_port_by_serial_number(self):
+        self.ports = [self.plug('ttyACM0', '2341', '0043', 'A1', location='1-1'),
+                      self.plug('ttyACM1', '2341', '0043', 'B2', location='1-2')]
+        assert_equal(self.env.resolve_serial_port('B2'), self.path('dev/ttyACM1'))
+        assert_equal(self.env.resolve_serial_port(self.ports[0]), self.ports[0])
+        assert_raises(Abort, self.env.resolve_serial_port, 'C3')
+
+    def test_board_without_usb_ids(self):
+        # any serial device could be connected, never upload to all of them
+        board = {'name': 'Arduino Pro', 'build': {}, 'upload': {}}
+        assert_raises(Abort, Environment().board_serial_ports, board)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8; -*-
+
+"""
+Bootloader emulators running on a pseudo terminal, so that programmers and
+upload could be exercised without real hardware.
+"""
+
+import os
+import pty
+import tty
+import select
+import struct
+import threading
+
+from ino.programmers import mcus
+
+
+class FakeBootloader(threading.Thread):
+    """
+    Emulate a bootloader on the master side of a pty. Connect to `port`
+    with pyserial like to a real device. `flash` holds device memory and
+    `written` collects addresses of flash pages in the order they were
+    programmed.
+    """
+
+    def __init__(self, mcu='atmega328p', flash_size=32 * 1024):
+        super(FakeBootloader, self).__init__()
+        self.daemon = True
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.page_size, self.signature = mcus[mcu]
+        self.flash = bytearray('\xff') * flash_size
+        self.written = []
+        self.address = 0
+        self.stopped = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def read(self, size):
+        data = ''
+        while len(data) < size:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if self.stopped:
+                raise EOFError
+            if ready:
+                data += os.read(self.master, size - len(data))
+        return data
+
+    def reply(self, data):
+        os.write(self.master, data)
+
+    def run(self):
+        try:
+            while True:
+                self.handle(self.read(1))
+        except EOFError:
+            pass
+
+    def handle(self, cmd):
+        raise NotImplementedError
+
+
+class FakeStk500v1(FakeBootloader):
+    def ok(self, data=''):
+        self.read(1) # CRC_EOP
+        self.reply('\x14' + data + '\x10')
+
+    def handle(self, cmd):
+        if cmd == '\x75':
+            self.ok(self.signature)
+        elif cmd == '\x55':
+            self.address = struct.unpack('<H', self.read(2))[0] * 2
+            self.ok()
+        elif cmd == '\x64':
+            size = struct.unpack('>H', self.read(2))[0]
+            self.read(1) # memory type
+            data = self.read(size)
+            self.flash[self.address:self.address + size] = data
+            self.written.append(self.address)
+            self.ok()
+        elif cmd == '\x74':
+            size = struct.unpack('>H', self.read(2))[0]
+            self.read(1) # memory type
+            self.ok(str(self.flash[self.address:self.address + size]))
+        else:
+            # sync, enter/leave programming mode and the rest
+            self.ok()
+
+
+class FakeAvr109(FakeBootloader):
+    def __init__(self, mcu='atmega32u4', flash_size=28 * 1024, refuse_writes=False):
+        super(FakeAvr109, self).__init__(mcu, flash_size)
+        self.refuse_writes = refuse_writes
+
+    def handle(self, cmd):
+        if cmd == 'S':
+            self.reply('CATERIN')
+        elif cmd == 's':
+            self.reply(self.signature[::-1])
+        elif cmd == 'A':
+            self.address = struct.unpack('>H', self.read(2))[0] * 2
+            self.reply('\r')
+        elif cmd == 'B':
+            size = struct.unpack('>H', self.read(2))[0]
+            self.read(1) # memory type
+            data = self.read(size)
+            if self.refuse_writes:
+                self.reply('?')
+                return
+            self.flash[self.address:self.address + size] = data
+            self.written.append(self.address)
+            self.address += size
+            self.reply('\r')
+        elif cmd == 'g':
+            size = struct.unpack('>H', self.read(2))[0]
+            self.read(1) # memory type
+            self.reply(str(self.flash[self.address:self.address + size]))
+            self.address += size
+        else:
+            self.reply('\r')
@@ -0,0 +1,75 @@
+# -*- coding: utf-8; -*-
+
+"""
+Fake sysfs tree and /dev directory in a temporary directory, so that USB
+serial devices could be plugged and unplugged without real hardware.
+"""
+
+import os
+
+import ino.ports
+
+from tests.tempdir import TempDirTest
+
+
+class SysfsTest(TempDirTest):
+    """
+    Point `ino.ports` to a fake sysfs under `dir`. Ports are regular files
+    in `dev` directory, use `plug` and `unplug` to (re)connect devices.
+    """
+
+    def setup(self):
+        super(SysfsTest, self).setup()
+        self.dev = self.path('dev')
+        self.tty_dir = self.path('sys/class/tty')
+        self.devices_dir = self.path('sys/devices/pci0000:00/usb1')
+        for dirname in (self.dev, self.tty_dir, self.devices_dir):
+            os.makedirs(dirname)
+
+        self.saved = ino.ports.sysfs_tty_dir, ino.ports.usb_info
+        ino.ports.sysfs_tty_dir = self.tty_dir
+        # sysfs is read on Linux only, it is faked on other systems too
+        ino.ports.usb_info = ino.ports._sysfs_usb_info
+
+    def teardown(self):
+        ino.ports.sysfs_tty_dir, ino.ports.usb_info = self.saved
+        super(SysfsTest, self).teardown()
+
+    def plug(self, name, vid, pid, serial=None, location='1-1'):
+        """
+        Connect a device at USB `location` and create its port `name`, e.g.
+        ttyACM0 or ttyUSB0. Return path of the port.
+        """
+        usb_device = os.path.join(self.devices_dir, location)
+        interface = os.path.join(usb_device, '%s:1.0' % location)
+        if not os.path.isdir(interface):
+            os.makedirs(interface)
+        attrs = {'idVendor': vid, 'idProduct': pid, 'serial': serial}
+        for attr, value in attrs.iteritems():
+            if value is not None:
+                with open(os.path.join(usb_device, attr), 'w') as f:
+                    f.write(value + '\n')
+
+        # ttyACM ports belong to an interface, ttyUSB ones are created by
+        # a driver of USB-to-serial chip one level below
+        device = interface
+        if name.startswith('ttyUSB'):
+            device = os.path.join(interface, name)
+            if not os.path.isdir(device):
+                os.mkdir(device)
+        tty = os.path.join(self.tty_dir, name)
+        os.mkdir(tty)
+        os.symlink(device, os.path.join(tty, 'device'))
+
+        # a new node is created while the old one still exists, so that
+        # its inode is not reused like when udev creates a node anew
+        port = os.path.join(self.dev, name)
+        open(port + '.new', 'w').close()
+        os.rename(port + '.new', port)
+        return port
+
+    def unplug(self, name):
+        os.remove(os.path.join(self.dev, name))
+        tty = os.path.join(self.tty_dir, name)
+        os.remove(os.path.join(tty, 'device'))
+        os.rmdir(tty)
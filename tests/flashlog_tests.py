@@ -0,0 +1,57 @@
+# -*- coding: utf-8; -*-
+
+import os
+import json
+
+from nose.tools import assert_equal
+
+from ino.flashlog import FlashLog
+
+from tests.tempdir import TempDirTest
+
+
+class TestFlashLog(TempDirTest):
+    def setup(self):
+        super(TestFlashLog, self).setup()
+        self.log_path = self.path('flashlog.json')
+
+    def test_records_by_serial(self):
+        log = FlashLog(self.log_path)
+        log.record('A1', 'digest', 'atmega328p')
+        log.save()
+
+        log = FlashLog(self.log_path)
+        assert_equal(log.lookup('A1')['digest'], 'digest')
+        assert_equal(log.lookup('B2'), None)
+
+    def test_port_records_are_ignored(self):
+        # another board could have been plugged in to the port since then
+        with open(self.log_path, 'w') as f:
+            json.dump({'port:/dev/ttyACM0': {'digest': 'digest', 'mcu': 'atmega328p'}}, f)
+        log = FlashLog(self.log_path)
+        assert_equal(log.records, {})
+
+    def test_records_of_other_processes_are_kept(self):
+        first, second = FlashLog(self.log_path), FlashLog(self.log_path)
+        first.record('A1', 'a', 'atmega328p')
+        second.record('B2', 'b', 'atmega328p')
+        second.forget('C3')
+        first.save()
+        second.save()
+
+        log = FlashLog(self.log_path)
+        assert_equal(sorted(log.records), ['serial:A1', 'serial:B2'])
+
+    def test_images_of_other_processes_are_kept(self):
+        first, second = FlashLog(self.log_path), FlashLog(self.log_path)
+        for log, serial, digest in ((first, 'A1', 'a'), (second, 'B2', 'b')):
+            log.record(serial, digest, 'atmega328p')
+            log.store_image(digest, self.path(digest + '.hex', ':00000001FF\n'))
+        first.save()
+        second.save()
+        self.path('images/partial.tmp', '')
+        FlashLog(self.log_path).save()
+
+        assert first.image_path('a')
+        assert second.image_path('b')
+        assert os.path.exists(self.path('images/partial.tmp'))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8; -*-
+
+import struct
+
+from nose.tools import assert_equal, assert_raises
+
+from ino.hexfile import Image, HexError, parse_hex, format_hex, parse_elf
+
+
+def make_elf(sections, segments):
+    """
+    Build a little-endian ELF32 file. `sections` are (name, type, flags,
+    addr, contents), `segments` are (file offset, size, paddr) of PT_LOAD
+    program headers. Section contents are laid out right after headers.
+    """
+    names = '\0' + ''.join(name + '\0' for name, _, _, _, _ in sections) + '.shstrtab\0'
+    phoff = 52
+    data_offset = phoff + 32 * len(segments)
+    blob = ''
+    headers = [struct.pack('<10I', *[0] * 10)]
+    name_offset = 1
+    for name, sh_type, flags, addr, contents in sections:
+        headers.append(struct.pack('<10I', name_offset, sh_type, flags, addr,
+                                   data_offset + len(blob), len(contents), 0, 0, 1, 0))
+        name_offset += len(name) + 1
+        if sh_type != 8:
+            blob += contents
+    headers.append(struct.pack('<10I', name_offset, 3, 0, 0,
+                               data_offset + len(blob), len(names), 0, 0, 1, 0))
+    blob += names
+    shoff = data_offset + len(blob)
+
+    elf = '\x7fELF\x01\x01\x01' + '\0' * 9
+    elf += struct.pack('<HHIIIIIHHHHHH', 2, 83, 1, 0, phoff, shoff, 0, 52,
+                       32, len(segments), 40, len(headers), len(headers) - 1)
+    for offset, size, paddr in segments:
+        elf += struct.pack('<8I', 1, data_offset + offset, paddr, paddr, size, size, 5, 1)
+    return elf + blob + ''.join(headers)
+
+
+class TestImage(object):
+    def test_adjacent_data_is_merged(self):
+        image = Image()
+        image.add(0x10, 'bb')
+        image.add(0x00, 'a' * 16)
+        image.add(0x40, 'c')
+        assert_equal(image.segments, [(0x00, bytearray('a' * 16 + 'bb')),
+                                      (0x40, bytearray('c'))])
+
+    def test_pages_are_padded(self):
+        image = Image()
+        image.add(6, 'xy')
+        assert_equal(list(image.pages(4)), [(4, bytearray('\xff\xffxy'))])
+
+    def test_changed_pages(self):
+        base = Image()
+        base.add(0, 'a' * 16)
+        image = Image()
+        image.add(0, 'a' * 8 + 'b' + 'a' * 7 + 'c')
+        assert_equal(image.changed_pages(base, 4),
+                     [(8, bytearray('baaa')), (16, bytearray('c\xff\xff\xff'))])
+
+
+class TestIntelHex(object):
+    def test_round_trip(self):
+        image = Image()
+        image.add(0xfff8, bytearray(range(32)))
+        image.add(0x30000, 'tail')
+        lines = list(format_hex(image))
+        assert_equal(lines[-1], ':00000001FF\n')
+        assert_equal(parse_hex(lines), image)
+
+    def test_merge(self):
+        sketch = Image()
+        sketch.add(0, 'app')
+        bootloader = Image()
+        bootloader.add(8, 'boot')
+        sketch.merge(bootloader)
+        assert_equal(sketch.to_bin(), bytearray('app\xff\xff\xff\xff\xffboot'))
+        with assert_raises(HexError):
+            sketch.merge(bootloader)
+
+
+class TestElf(object):
+    def test_sections_are_placed_at_load_address(self):
+        elf = make_elf([
+            ('.text', 1, 0x6, 0x0, 'code'),
+            # .data lives in RAM but is loaded from flash right after .text
+            ('.data', 1, 0x3, 0x800100, 'dt'),
+            ('.bss', 8, 0x3, 0x800102, 'zzzz'),
+            ('.eeprom', 1, 0x3, 0x810000, 'ee'),
+            ('.comment', 1, 0x0, 0x0, 'gcc'),
+        ], segments=[(0, 4, 0x0), (4, 2, 0x4)])
+        image = parse_elf(elf)
+        assert_equal(image.segments, [(0, bytearray('codedt'))])
+
+    def test_not_elf(self):
+        with assert_raises(HexError):
+            parse_elf(':00000001FF')
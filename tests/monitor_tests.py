@@ -0,0 +1,104 @@
+# -*- coding: utf-8; -*-
+
+import os
+import pty
+import tty
+import tempfile
+import threading
+
+from nose.tools import assert_equal
+
+from ino.monitor import Monitor, Connection
+
+
+class FakeDevice(object):
+    """
+    The other end of a pty the monitor is connected to.
+    """
+
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def stream(self, data, chunk_size=4096):
+        def write():
+            for i in xrange(0, len(data), chunk_size):
+                os.write(self.master, data[i:i + chunk_size])
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class TestMonitor(object):
+    def test_stream_is_not_lost(self):
+        device = FakeDevice()
+        data = os.urandom(1 << 20)
+        output = tempfile.TemporaryFile()
+        try:
+            monitor = Monitor(output=output)
+            connection = monitor.add(device.port, 1000000)
+            chunks = []
+
+            def collect(chunk, timestamp):
+                chunks.append(chunk)
+                if connection.bytes_read >= len(data):
+                    monitor.stop()
+
+            connection.handlers.append(collect)
+            monitor.open()
+            device.stream(data)
+            monitor.run(duration=10)
+
+            assert_equal(''.join(chunks), data)
+            output.seek(0)
+            assert_equal(output.read(), data)
+        finally:
+            output.close()
+            device.close()
+
+    def test_input_is_sent(self):
+        device = FakeDevice()
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, 'hello\n')
+        os.close(write_fd)
+        try:
+            monitor = Monitor(input=os.fdopen(read_fd))
+            monitor.add(device.port, 9600)
+            monitor.run(duration=0.2)
+            assert_equal(os.read(device.master, 100), 'hello\n')
+        finally:
+            device.close()
+
+    def test_prefixed_output_of_several_ports(self):
+        devices = [FakeDevice(), FakeDevice()]
+        output = tempfile.TemporaryFile()
+        try:
+            monitor = Monitor(output=output)
+            for i, device in enumerate(devices):
+                monitor.add(device.port, 115200, prefix='%d: ' % i)
+            monitor.open()
+            os.write(devices[0].master, 'one\ntw')
+            os.write(devices[1].master, 'three\n')
+            monitor.run(duration=0.3)
+
+            output.seek(0)
+            assert_equal(sorted(output.read().splitlines()),
+                         ['0: one', '0: tw', '1: three'])
+        finally:
+            output.close()
+            for device in devices:
+                device.close()
+
+
+def test_partial_lines_wait_for_line_end():
+    connection = Connection('port', 9600, prefix='> ')
+    assert_equal(connection.format('ab', 0.0, 1.0), '')
+    assert_equal(connection.format('c\nd', 0.5, 1.0), '> abc\n')
+    assert_equal(connection.format('', 1.0, 1.0), '')
+    assert_equal(connection.format('', 1.5, 1.0), '> d\n')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8; -*-
+
+import os
+
+from nose.tools import assert_equal
+
+import ino.ports
+from ino.ports import UsbInfo, UsbInfoCache, board_usb_ids, wait_for_new_port
+
+from tests.fake_sysfs import SysfsTest
+
+
+class TestUsbInfo(SysfsTest):
+    def test_acm_port(self):
+        port = self.plug('ttyACM0', '2341', '0043', '75330303035351F0E1A1', '1-1.2')
+        assert_equal(ino.ports.usb_info(port),
+                     UsbInfo('2341', '0043', '75330303035351F0E1A1', '1-1.2'))
+
+    def test_usb_serial_chip(self):
+        # the port is one level deeper than interface
+        port = self.plug('ttyUSB0', '1A86', '7523', location='2-1')
+        assert_equal(ino.ports.usb_info(port), UsbInfo('1a86', '7523', None, '2-1'))
+
+    def test_symlink(self):
+        port = self.plug('ttyACM0', '2341', '0043', 'A1')
+        link = self.path('usb-Arduino_A1')
+        os.symlink(port, link)
+        assert_equal(ino.ports.usb_info(link).serial, 'A1')
+
+    def test_not_usb_device(self):
+        assert_equal(ino.ports.usb_info(self.path('dev/ttyS0', '')), None)
+
+
+class TestUsbInfoCache(SysfsTest):
+    def test_replugged_device(self):
+        cache_path = self.path('ports.json')
+        port = self.plug('ttyACM0', '2341', '0043', 'A1')
+        cache = UsbInfoCache(cache_path)
+        assert_equal(cache.get(port).serial, 'A1')
+        cache.save()
+
+        # the node is the same, attributes are not read again
+        self.path('sys/devices/pci0000:00/usb1/1-1/serial', 'B2\n')
+        cache = UsbInfoCache(cache_path)
+        assert_equal(cache.get(port).serial, 'A1')
+
+        self.unplug('ttyACM0')
+        self.plug('ttyACM0', '2341', '0043', 'B2', location='1-2')
+        assert_equal(cache.get(port), UsbInfo('2341', '0043', 'B2', '1-2'))
+
+    def test_unplugged_devices_are_forgotten(self):
+        cache_path = self.path('ports.json')
+        cache = UsbInfoCache(cache_path)
+        port = self.plug('ttyACM0', '2341', '0043', 'A1')
+        cache.get(port)
+        self.unplug('ttyACM0')
+        assert_equal(cache.get(port), None)
+        cache.save()
+        assert_equal(UsbInfoCache(cache_path).records, {})
+
+
+class TestBoardUsbIds(object):
+    def test_ids(self):
+        board = {
+            'build': {'vid': '0x2341', 'pid': '0x8036'},
+            'vid': {'0': '0x2341', '1': '0x2A03'},
+            'pid': {'0': '0x0036', '1': '0x0036'},
+        }
+        assert_equal(board_usb_ids(board),
+                     set([('2341', '8036'), ('2341', '0036'), ('2a03', '0036')]))
+
+    def test_board_without_ids(self):
+        assert_equal(board_usb_ids({'build': {'mcu': 'atmega328p'}}), set())
+
+
+class TestWaitForNewPort(SysfsTest):
+    def test_port_at_location(self):
+        old = self.plug('ttyACM0', '2341', '0043', location='1-1')
+        other = self.plug('ttyACM1', '2341', '0036', location='1-2')
+        bootloader = self.plug('ttyACM2', '2341', '0036', location='1-3')
+        list_ports = lambda: [old, other, bootloader]
+        assert_equal(wait_for_new_port(list_ports, [old], location='1-3',
+                                       dirnames=(self.dev,)),
+                     bootloader)
+
+    def test_timeout(self):
+        old = self.plug('ttyACM0', '2341', '0043', location='1-1')
+        other = self.plug('ttyACM1', '2341', '0036', location='1-2')
+        list_ports = lambda: [old, other]
+        assert_equal(wait_for_new_port(list_ports, [old], timeout=0.1, location='1-3',
+                                       dirnames=(self.dev,)),
+                     None)
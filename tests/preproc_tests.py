@@ -0,0 +1,65 @@
+# -*- coding: utf-8; -*-
+
+import hashlib
+
+from argparse import Namespace
+from nose.tools import assert_equal, assert_raises
+
+from ino.commands.preproc import Preprocess
+from ino.environment import Environment, Version
+from ino.exc import Abort
+
+from tests.tempdir import TempDirTest
+
+
+class TestPreprocess(TempDirTest):
+    blink = '#include <Servo.h>\nvoid setup() {\n}\nvoid loop() {\n}\n'
+    serial = 'int value;\nvoid setup() {\n}\nint read(int pin) {\n  return 0;\n}\n'
+
+    def setup(self):
+        super(TestPreprocess, self).setup()
+        env = Environment()
+        env['version.txt'] = self.path('version.txt', '1.0.5')
+        env['arduino_lib_version'] = Version(1, 0, 5)
+        self.preproc = Preprocess(env)
+        self.pairs = [(self.path('blink.ino', self.blink), self.path('blink.cpp')),
+                      (self.path('serial.ino', self.serial), self.path('serial.cpp'))]
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def check_outputs(self):
+        assert_equal(self.read('blink.cpp'), ''.join([
+            '#include <Arduino.h>\n',
+            '#include <Servo.h>\n',
+            'void setup();\nvoid loop();\n',
+            '#line 1 "%s"\n' % self.path('blink.ino'),
+            '//#include <Servo.h>\nvoid setup() {\n}\nvoid loop() {\n}\n',
+        ]))
+        assert 'void setup();\nint read(int pin);\n' in self.read('serial.cpp')
+
+        digests = [hashlib.sha1(s).hexdigest() for s in (self.blink, self.serial)]
+        assert_equal(self.preproc.e['prototypes_cache'], {
+            digests[0]: ['void setup();', 'void loop();'],
+            digests[1]: ['void setup();', 'int read(int pin);'],
+        })
+
+    def test_process_many(self):
+        outputs = [output for _, output in self.pairs]
+        assert_equal(self.preproc.process_many(self.pairs), outputs)
+        self.check_outputs()
+
+        # unchanged outputs are not written again
+        assert_equal(self.preproc.process_many(self.pairs), [])
+        self.check_outputs()
+
+    def test_worker_processes(self):
+        outputs = [output for _, output in self.pairs]
+        assert_equal(self.preproc.process_many(self.pairs, jobs=2), outputs)
+        self.check_outputs()
+
+    def test_output_for_every_sketch(self):
+        args = Namespace(sketch=[sketch for sketch, _ in self.pairs],
+                         output=[self.path('blink.cpp')])
+        assert_raises(Abort, self.preproc.run, args)
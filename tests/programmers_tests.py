@@ -0,0 +1,60 @@
+# -*- coding: utf-8; -*-
+
+from nose.tools import assert_equal, assert_raises
+
+from ino.hexfile import Image
+from ino.programmers import Stk500v1, Avr109, ProgrammerError
+
+from tests.fake_bootloaders import FakeStk500v1, FakeAvr109
+
+
+def make_image():
+    image = Image()
+    image.add(0, bytearray(range(256)) * 3)
+    image.add(0x1000, 'tail')
+    return image
+
+
+class TestStk500v1(object):
+    def test_program_and_verify(self):
+        image = make_image()
+        with FakeStk500v1() as device:
+            with Stk500v1(device.port, 115200, 'atmega328p') as prog:
+                pages = list(image.pages(prog.page_size))
+                prog.write(pages)
+                assert_equal(prog.verify(pages), [])
+
+            assert_equal(device.written, [0, 128, 256, 384, 512, 640, 0x1000])
+            assert_equal(device.flash[:768], bytearray(range(256)) * 3)
+            assert_equal(device.flash[0x1000:0x1006], bytearray('tail\xff\xff'))
+
+    def test_verify_reports_mismatched_pages(self):
+        with FakeStk500v1() as device:
+            device.flash[130] = 0
+            with Stk500v1(device.port, 115200, 'atmega328p') as prog:
+                pages = [(0, bytearray('\xff') * 128), (128, bytearray('\xff') * 128)]
+                assert_equal(prog.verify(pages), [128])
+
+    def test_signature_mismatch(self):
+        with FakeStk500v1(mcu='atmega168') as device:
+            with assert_raises(ProgrammerError):
+                Stk500v1(device.port, 115200, 'atmega328p').open()
+
+
+class TestAvr109(object):
+    def test_program_and_verify(self):
+        image = make_image()
+        with FakeAvr109() as device:
+            with Avr109(device.port, 57600, 'atmega32u4') as prog:
+                pages = list(image.pages(prog.page_size))
+                prog.write(pages)
+                assert_equal(prog.verify(pages), [])
+
+            assert_equal(device.written, [0, 128, 256, 384, 512, 640, 0x1000])
+            assert_equal(device.flash[:768], bytearray(range(256)) * 3)
+
+    def test_refused_write(self):
+        with FakeAvr109(refuse_writes=True) as device:
+            with Avr109(device.port, 57600, 'atmega32u4') as prog:
+                with assert_raises(ProgrammerError):
+                    prog.write(make_image().pages(prog.page_size))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8; -*-
+
+"""
+Base class for tests that work with files in a temporary directory.
+"""
+
+import os
+import shutil
+import tempfile
+
+
+class TempDirTest(object):
+    """
+    Create a temporary directory `dir` before every test and remove it
+    after. Subclasses overriding `setup` or `teardown` call them with
+    super.
+    """
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name, contents=None):
+        """
+        Return path of `name` in the directory. If `contents` is given,
+        write them to the file.
+        """
+        path = os.path.join(self.dir, name)
+        if contents is not None:
+            with open(path, 'w') as f:
+                f.write(contents)
+        return path
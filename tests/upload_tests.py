@@ -0,0 +1,33 @@
+# -*- coding: utf-8; -*-
+
+from nose.tools import assert_equal
+
+from ino.commands.upload import Upload
+from ino.environment import Environment
+from ino.hexfile import Image
+from ino.programmers import Stk500v1
+
+from tests.fake_bootloaders import FakeStk500v1
+
+
+class TestIncrementalUpload(object):
+    board = {'upload': {'speed': '115200'}, 'build': {'mcu': 'atmega328p'}}
+
+    def test_pages_flashed_by_others_are_written(self):
+        image = Image()
+        image.add(0, bytearray('\x01') * 256)
+        upload = Upload(Environment())
+        upload.programmer = Stk500v1
+        upload.image = image
+
+        with FakeStk500v1() as device:
+            # the device was known to run the same firmware but the
+            # first page, then something else changed the second one
+            device.flash[128:256] = bytearray('\x01') * 128
+            device.flash[200] = 0
+            pages = [(0, bytearray('\x01') * 128)]
+            assert_equal(upload.program_native(self.board, device.port, False, pages, quiet=True),
+                         'uploaded')
+
+            assert_equal(device.written, [0, 128])
+            assert_equal(device.flash[:256], bytearray('\x01') * 256)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8; -*-
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_true, assert_false
+
+from ino.filters import glob
+from ino.utils import write_if_changed, Timings, counters
+
+from tests.tempdir import TempDirTest
+
+
+class TestWriteIfChanged(TempDirTest):
+    def setup(self):
+        super(TestWriteIfChanged, self).setup()
+        self.output = self.path(os.path.join('sub', 'out.cpp'))
+
+    def test_keeps_mtime_of_same_contents(self):
+        assert_true(write_if_changed(self.output, 'int x;\n'))
+        os.utime(self.output, (1000, 1000))
+        assert_false(write_if_changed(self.output, 'int x;\n'))
+        assert_equal(os.path.getmtime(self.output), 1000)
+
+    def test_rewrites_changed_contents(self):
+        write_if_changed(self.output, 'int x;\n')
+        assert_true(write_if_changed(self.output, 'int y;\n'))
+        assert_equal(open(self.output).read(), 'int y;\n')
+
+
+def test_timings_sum_repeated_phases():
+    timings = Timings()
+    timings.add('discovery', 0.5)
+    timings.add('programming', 1.0)
+    timings.add('discovery', 0.25)
+    assert_equal(timings.items(), [('discovery', 0.75), ('programming', 1.0)])
+
+
+def test_glob_is_counted():
+    dirname = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(dirname, 'sub'))
+        open(os.path.join(dirname, 'a.c'), 'w').close()
+        open(os.path.join(dirname, 'sub', 'b.c'), 'w').close()
+        counters.reset()
+        assert_equal(len(glob(dirname, '*.c')), 2)
+        assert_equal(counters.counts, {'glob': 1, 'listdir': 2, 'stat': 4})
+    finally:
+        shutil.rmtree(dirname)